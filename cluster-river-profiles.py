@@ -11,10 +11,12 @@ import matplotlib
 matplotlib.use('Agg')
 import os
 import sys
-import pandas as pd
+from scipy.cluster.hierarchy import linkage
 import clustering as cl
 import plotting as pl
 import raster_plotting as rpl
+import stage_cache as sc
+import profile_io as pio
 
 #=============================================================================
 # This is just a welcome screen that is displayed if no arguments are provided.
@@ -52,10 +54,23 @@ if __name__ == '__main__':
     parser.add_argument("-m", "--method", type=str, help="The method for clustering, see the scipy linkage docs for more information. The default is 'ward'.", default='ward')
     parser.add_argument("-step", "--step", type=int, help="The regular spacing in metres that you want the profiles to have for the clustering. This should be greater than sqrt(2* DataRes^2).  The default is 2 m which is appropriate for grids with a resolution of 1 m.", default = 2)
     parser.add_argument("-so", "--stream_order", type=int, help="The stream order that you wish to cluster over. Default is 1.", default=1)
+    parser.add_argument("-thr", "--threshold_levels", type=int, nargs='+', default=[0,1], help="The levels at which to cut the dendrogram. Level 0 is where the distance between clusters is largest, level 1 the second largest, etc. You can pass as many levels as you like, e.g. -thr 0 1 2. The clustering is only calculated once. The default is 0 1.")
+    parser.add_argument("-k", "--n_clusters", type=int, nargs='+', default=[], help="Cut the dendrogram to give this number of clusters, in addition to the threshold levels. You can pass several values, e.g. -k 2 3 4. The results are saved in a folder called k_<n_clusters>.")
+    parser.add_argument("-dist", "--distance", type=str, default='euclidian', help="The distance between the profiles for the clustering: 'euclidian' for the average Euclidian difference in slope, 'lag' to allow the profiles to be shifted along-stream to find the best match (see -lag), or 'dtw' for dynamic time warping, which lets knickzones be offset along-stream (see -band). With -approx this is used for the prototypes too. The default is 'euclidian'.")
+    parser.add_argument("-lag", "--max_lag", type=int, default=200, help="The maximum shift in nodes of the regularly spaced profiles for the 'lag' distance. The default is 200.")
+    parser.add_argument("-band", "--dtw_band", type=int, default=10, help="The width of the warping band in nodes for the 'dtw' distance. Larger bands allow bigger offsets but are slower. The default is 10.")
+    parser.add_argument("-lb", "--lb_cutoff", type=float, default=None, help="For the 'dtw' distance, skip the full DTW for pairs of profiles whose lower bound is above this distance. This makes the clustering much faster but only keeps the lower bound for these pairs, so set it above the distance you expect to cut the dendrogram at. Default = None (full DTW for every pair).")
+    parser.add_argument("-nj", "--n_jobs", type=int, help="The number of processes to use for calculating the distance matrix. Set to -1 to use all the cores. The default is 1.", default=1)
+    parser.add_argument("-pj", "--plot_jobs", type=int, default=1, help="The number of processes to use for making the figures for each threshold level. Each figure is made in its own process. Set to -1 to use all the cores. The default is 1 (one figure at a time).")
+    parser.add_argument("-maxmem", "--max_memory", type=float, help="Memory limit in GB for the distance matrix. If the clustering would need more than this, the distances are stored as float32 and clustered in place, or written to a memory-mapped file if you also use -mmap. If neither fits you get an error. This can't be used with -approx. Default = no limit.", default=None)
+    parser.add_argument("-mmap", "--mmap", action="store_true", help="Allow the distance matrix to be written to a memory-mapped file in the base directory if it doesn't fit within the memory limit.")
+    parser.add_argument("-approx", "--n_prototypes", type=int, help="Use the approximate clustering for very large numbers of profiles: the profiles are grouped around this number of prototypes with k-medoids, and the hierarchy is only built for the prototypes. Default = None (exact clustering).", default=None)
+    parser.add_argument("-sample", "--agreement_sample", type=int, help="If you use the approximate clustering, the number of profiles used to check it against the exact clustering. Set to 0 to skip the check. The default is 1000.", default=1000)
     parser.add_argument("-zmax", "--maximum_elevation_for_plotting", type=float, default = 100, help="This is the maximum elevation in the colourbar of the landscape plot.")
 
     # Options for slope area analysis for comparison
     parser.add_argument("-SA", "--slope_area", type=bool, help='Set to true to make slope-area plots', default=False)
+    parser.add_argument("-density", "--density_plots", action="store_true", help="Plot the slope-area data as a density image rather than plotting every point. The time to make the figures and their size then don't depend on the number of points, so use this for large river networks.")
 
     # Options for plotting catchment metrics. You need to have run an additional LSDTopoTools analysis for this
     parser.add_argument("-CM", "--catchment_metrics", type=bool, default=False, help='Set true to make boxplots of catchment metrics. You need to have run an additional LSDTopoTools analysis for this')
@@ -65,10 +80,24 @@ if __name__ == '__main__':
     parser.add_argument("-field", "--lith_field", type=str, help="The field name from the shapefile which contains the lithology information", default="geol")
     parser.add_argument("-geol", "--geol_raster", type=str, help="Pass a raster with the geology for plotting.")
 
+    # Caching of the intermediate stages
+    parser.add_argument("-no_cache", "--no_cache", action="store_true", help="Don't read or write the cache of intermediate results (slopes, profiles, distance matrix and linkage). By default these are stored in a 'cache' folder in the base directory and are recalculated whenever the input file or the parameters change.")
+
+    # Streaming of very large input files
+    parser.add_argument("-stream", "--stream", action="store_true", help="Read the _all_tribs file in chunks rather than loading it all at once, for river networks that are too big for memory. The slopes are calculated chunk by chunk and written straight to the slopes file, and for first order streams the profiles are resampled chunk by chunk too. The trunk channel plot reads the file in chunks too. The maps of the clusters still need the coordinates of every node, but they only read the latitude and longitude columns. The rows for each source id need to be next to each other in the file.")
+    parser.add_argument("-chunk", "--chunk_size", type=int, default=1000000, help="The number of rows to read at once with -stream. The default is 1000000.")
+
+    # Format for the profile tables
+    parser.add_argument("-fmt", "--table_format", type=str, default='csv', help="The format for writing the profile tables: 'csv', 'parquet' or 'feather'. Parquet and feather are much faster to read and write and are smaller, but need pyarrow to be installed. The default is csv.")
+
     # In case you want to switch the colours. Only works for a two cluster case
     parser.add_argument("-sc", "--switch_colours", type=bool, help="Set to true to switch the colours. Only works for a two cluster case", default=False)
 
     args = parser.parse_args()
+    if args.n_prototypes is not None and args.max_memory is not None:
+        parser.error("-maxmem only applies to the exact clustering, it can't be used with -approx")
+    if any(k < 1 for k in args.n_clusters):
+        parser.error("The number of clusters for -k must be at least 1")
 
     if not args.fname_prefix:
         print("WARNING! You haven't supplied your DEM name. Please specify this with the flag '-fname'")
@@ -96,56 +125,129 @@ if __name__ == '__main__':
     # set min and max of colourbar
     cbar_min_max = [0,args.maximum_elevation_for_plotting]
 
-    # check if the slopes file exists
+    pio.set_table_format(args.table_format)
+
+    # set up the cache. Each stage is keyed on the hash of the input file and the
+    # parameters used for it and all the stages before it.
+    tribs_file = DataDirectory+args.fname_prefix+'_all_tribs.csv'
     slope_file = DataDirectory+args.fname_prefix+'_slopes.csv'
-    if os.path.isfile(slope_file):
-        df = pd.read_csv(slope_file)
+    if args.no_cache:
+        CacheDirectory = None
+        input_key = ''
     else:
-        # read in the original csv
-        df = pd.read_csv(DataDirectory+args.fname_prefix+'_all_tribs.csv')
-
-        # remove profiles with short unique section
-        # calculate the slope
-        df = cl.CalculateSlope(DataDirectory, args.fname_prefix, df, args.slope_window)
-        df.to_csv(DataDirectory+args.fname_prefix+'_slopes.csv', index=False)
+        CacheDirectory = DataDirectory+'cache/'
+        input_key = sc.hash_files(pio.find_table(tribs_file))
+
+    # calculate the slope
+    slopes_key = sc.stage_key(input_key, 'slopes', slope_window=args.slope_window)
+    if args.stream:
+        # the slopes go straight to the file, so we don't keep them in memory
+        df = None
+        write_slopes = lambda path: cl.StreamSlopes(tribs_file, path, args.slope_window, args.chunk_size)
+        if CacheDirectory is None:
+            write_slopes(slope_file)
+        else:
+            sc.cached_file_stage(CacheDirectory, args.fname_prefix, 'slopes', slopes_key, write_slopes)
+    else:
+        df, _ = sc.cached_stage(CacheDirectory, args.fname_prefix, 'slopes', slopes_key,
+                                lambda: cl.CalculateSlope(DataDirectory, args.fname_prefix, pio.read_table(tribs_file), args.slope_window))
+        if CacheDirectory is None:
+            pio.write_table(df, slope_file)
+    # the plotting functions read the slopes file, so make sure it matches
+    if CacheDirectory is not None:
+        sc.export_stage(CacheDirectory, args.fname_prefix, 'slopes', slopes_key, slope_file)
 
     # slope-area plotting if required
     if args.slope_area:
-        pl.PlotSlopeArea(DataDirectory, args.fname_prefix)
+        pl.PlotSlopeArea(DataDirectory, args.fname_prefix, density=args.density_plots)
 
-    pl.PlotTrunkChannel(DataDirectory, args.fname_prefix)
+    pl.PlotTrunkChannel(DataDirectory, args.fname_prefix, chunksize=args.chunk_size if args.stream else None)
 
     # get the profiles for the chosen stream order
-    new_df = cl.GetProfilesByStreamOrder(DataDirectory, args.fname_prefix, df, args.step, args.slope_window, args.stream_order)
-    if args.stream_order > 1:
-        new_df = cl.RemoveNonUniqueProfiles(new_df)
-
-    new_df = cl.RemoveProfilesShorterThanThresholdLength(new_df, args.profile_len)
+    def get_profiles():
+        if args.stream and args.stream_order == 1:
+            return cl.StreamProfilesByStreamOrder(DataDirectory, args.fname_prefix, slope_file, args.step, args.stream_order, args.profile_len, args.chunk_size)
+        # the higher stream orders need all the profiles at once
+        slopes_df = pio.read_table(slope_file) if df is None else df
+        new_df = cl.GetProfilesByStreamOrder(DataDirectory, args.fname_prefix, slopes_df, args.step, args.slope_window, args.stream_order)
+        if args.stream_order > 1:
+            new_df = cl.RemoveNonUniqueProfiles(new_df)
+        return cl.RemoveProfilesShorterThanThresholdLength(new_df, args.profile_len)
+
+    profiles_key = sc.stage_key(slopes_key, 'profiles', step=args.step, stream_order=args.stream_order, profile_len=args.profile_len)
+    new_df, _ = sc.cached_stage(CacheDirectory, args.fname_prefix, 'profiles', profiles_key, get_profiles)
+
+    # build the cluster hierarchy. This is the same for every threshold level, so we only do it once.
+    if args.distance == 'lag':
+        distance_params = dict(distance=args.distance, max_lag=args.max_lag)
+    elif args.distance == 'dtw':
+        distance_params = dict(distance=args.distance, band=args.dtw_band, lb_cutoff=args.lb_cutoff)
+    else:
+        distance_params = {}
+    distances_key = sc.stage_key(profiles_key, 'distances', **distance_params)
+    # the linkage with a memory limit might use float32 distances, so keep it apart from the exact one
+    memory_params = {} if args.max_memory is None else dict(max_memory=args.max_memory)
+    linkage_key = sc.stage_key(distances_key, 'linkage', method=args.method, **memory_params)
+    def get_linkage():
+        if args.max_memory is not None:
+            # don't cache the distances as they might not fit in memory
+            mmap_dir = DataDirectory if args.mmap else None
+            return cl.BuildHierarchy(new_df, args.method, args.n_jobs, args.max_memory*1e9, mmap_dir, args.distance, args.max_lag, args.dtw_band, args.lb_cutoff)
+        cc, _ = sc.cached_stage(CacheDirectory, args.fname_prefix, 'distances', distances_key,
+                                lambda: cl.ProfileDistances(new_df, args.n_jobs, args.distance, args.max_lag, args.dtw_band, args.lb_cutoff), kind='array')
+        return linkage(cc, method=args.method)
+    if args.n_prototypes is None:
+        ln, _ = sc.cached_stage(CacheDirectory, args.fname_prefix, 'linkage', linkage_key, get_linkage, kind='array')
+        prototypes = None
+    else:
+        # cluster the prototypes instead of all the profiles
+        approx_key = sc.stage_key(profiles_key, 'approx_linkage', method=args.method, n_prototypes=args.n_prototypes, **distance_params)
+        (ln, prototypes), _ = sc.cached_stage(CacheDirectory, args.fname_prefix, 'approx_linkage', approx_key,
+                                              lambda: cl.BuildApproximateHierarchy(new_df, args.method, args.n_prototypes, n_jobs=args.n_jobs, distance=args.distance,
+                                                                                   max_lag=args.max_lag, band=args.dtw_band, lb_cutoff=args.lb_cutoff), kind='arrays')
     #
-    # do the clustering. We will do this at two threshold levels for the cutoff point.
-    thr_levels = [0,1]
-    for i in thr_levels:
+    # now cut the hierarchy at each threshold level and number of clusters that we want.
+    cuts = [('threshold level {}'.format(i), 'threshold_{}/'.format(i), i, None) for i in args.threshold_levels]
+    cuts += [('{} clusters'.format(k), 'k_{}/'.format(k), 0, k) for k in args.n_clusters]
+    # the distance vs number of clusters is the same for every cut, so plot it once and mark the cuts on it
+    cl.PlotDistanceVsNClusters(DataDirectory, args.fname_prefix, ln, cuts=[(name, i, k) for name, _, i, k in cuts])
+    # the exact hierarchy of a sample of the profiles, to check each cut of the approximate one
+    check_sample = prototypes is not None and args.agreement_sample > 0
+    if check_sample:
+        sample, sample_ln = cl.BuildSampleHierarchy(new_df, args.method, args.agreement_sample, distance=args.distance,
+                                                    max_lag=args.max_lag, band=args.dtw_band, lb_cutoff=args.lb_cutoff)
+    for name, folder, i, k in cuts:
         print("========================================================")
-        print("Running the clustering with threshold level {}".format(i))
+        print("Running the clustering with {}".format(name))
         print("========================================================")
-        new_dir = DataDirectory+'threshold_{}/'.format(str(i))
+        new_dir = DataDirectory+folder
         if not os.path.isdir(new_dir):
              os.makedirs(new_dir)
-        cl.ClusterProfilesVaryingLength(DataDirectory, new_dir, args.fname_prefix, new_df, args.method, args.stream_order, i)
+        clustered_df = cl.ClusterProfilesVaryingLength(DataDirectory, new_dir, args.fname_prefix, new_df, args.method, args.stream_order, i, args.n_jobs, ln, k, prototypes, plot_distance=False)
+        if check_sample:
+            labels = clustered_df.groupby('id', sort=False)['cluster_id'].first().values
+            cl.SampleAgreement(labels, sample, sample_ln)
         if args.switch_colours:
             pl.switch_colours(new_dir, args.fname_prefix, args.stream_order)
-        # these functions make some plots for you.
-        pl.PlotProfilesByCluster(DataDirectory, new_dir, args.fname_prefix, args.stream_order)
-        #rpl.PlotElevationWithClusters(DataDirectory, new_dir, args.fname_prefix, args.stream_order)
-        rpl.PlotHillshadewithClusters(DataDirectory, new_dir, args.fname_prefix, args.stream_order)
+            clustered_df = pio.read_table(new_dir+args.fname_prefix+'_profiles_clustered_SO{}.csv'.format(args.stream_order))
+        else:
+            # same dtypes as the clustered table on disk
+            clustered_df = pio.prepare_table(clustered_df)
+        # these functions make some plots for you. Each one gets the clustered
+        # profiles so they don't need to read them again.
+        common = (DataDirectory, new_dir, args.fname_prefix, args.stream_order)
+        plots = [(pl.PlotProfilesByCluster, common, {'cluster_df': clustered_df}),
+                 #(rpl.PlotElevationWithClusters, common, {}),
+                 (rpl.PlotHillshadewithClusters, common, {'cluster_df': clustered_df})]
         if (args.shp == True):
-            rpl.PlotLithologyWithClusters(DataDirectory, new_dir, args.fname_prefix, args.stream_order, args.shp, args.lith_field)
+            plots.append((rpl.PlotLithologyWithClusters, common+(args.shp, args.lith_field), {'cluster_df': clustered_df}))
         if (args.geol_raster == True):
-            rpl.PlotRasterLithologyWithClusters(DataDirectory, new_dir, args.fname_prefix, args.stream_order, args.geol_raster)
-        pl.PlotSlopeAreaAllProfiles(DataDirectory, new_dir, args.fname_prefix, args.stream_order, orientation='vertical', nbins=10)
-        pl.PlotMedianProfiles(DataDirectory, new_dir, args.fname_prefix, args.stream_order)
-        pl.MakeBoxPlotByCluster(DataDirectory, new_dir, args.fname_prefix, args.stream_order)
+            plots.append((rpl.PlotRasterLithologyWithClusters, common+(args.geol_raster,), {'cluster_df': clustered_df}))
+        plots += [(pl.PlotSlopeAreaAllProfiles, common, {'orientation': 'vertical', 'nbins': 10, 'cluster_df': clustered_df, 'density': args.density_plots}),
+                  (pl.PlotMedianProfiles, common, {'cluster_df': clustered_df}),
+                  (pl.MakeBoxPlotByCluster, common, {'cluster_df': clustered_df})]
         if (args.catchment_metrics == True):
-            pl.MakeCatchmentMetricsBoxPlot(DataDirectory, new_dir, args.fname_prefix, args.stream_order)
+            plots.append((pl.MakeCatchmentMetricsBoxPlot, common, {'cluster_df': clustered_df}))
+        pl.RunPlotJobs(plots, args.plot_jobs)
 
     print('Enjoy your clusters, pal')
@@ -3,10 +3,14 @@ plt.ioff()
 import numpy as np
 import pandas as pd
 from scipy.cluster.hierarchy import dendrogram, linkage, fcluster, set_link_color_palette
-from scipy import stats
+from scipy import ndimage
+import functools
 import math
+import multiprocessing as mp
 import plotting as pl
+import profile_io as pio
 import sys
+import tempfile
 
 #---------------------------------------------------------------------#
 # ANALYSIS FUNCTIONS
@@ -24,6 +28,19 @@ def find_nearest_idx(array,value):
         return idx
 
 
+def find_nearest_indices(array, values):
+    """
+    Array version of find_nearest_idx: for each value, find the index of the
+    point in the sorted array which is closest to that value.
+    """
+    values = np.asarray(values)
+    idx = np.searchsorted(array, values, side="left")
+    prev = np.maximum(idx-1, 0)
+    this = np.minimum(idx, len(array)-1)
+    use_prev = (idx > 0) & ((idx == len(array)) | (np.abs(values - array[prev]) < np.abs(values - array[this])))
+    return np.where(use_prev, idx-1, idx)
+
+
 def find_difference_between_arrays(x, y):
     """
     Function to calculate a difference between two np arrays with the same
@@ -55,7 +72,408 @@ def AverageEuclidianDifference(x, y):
     d = (np.sqrt(np.sum((x - y)*(x - y))))/n
     return d
 
-#def MinimiseLag(x, y, s=200):
+def ProfilesToPaddedArray(df, column='slope'):
+    """
+    Pack the profiles in the dataframe into a 2d array for the distance
+    calculations. Each row is one source, in the same order as df['id'].unique(),
+    and profiles that are shorter than the longest one are padded with zeros.
+
+    Args:
+        df: pandas dataframe with the regularly spaced profiles
+        column (str): name of the column to pack. Default = 'slope'
+
+    Returns: array of size (n_profiles, max_len) and an array with the number of
+    points in each profile
+    """
+    # work with the runs of rows with the same id rather than every row, which
+    # needs much less memory since the rows of each profile are usually together.
+    # The runs are found and the array filled in chunks of rows to limit the
+    # temporary arrays.
+    ids = df['id'].values
+    values = df[column].values
+    chunk = 2**16
+    # find where the id changes
+    changes = [np.zeros(1, dtype=np.int64)]
+    for start in range(1, len(ids), chunk):
+        end = min(start+chunk, len(ids))
+        changes.append(np.flatnonzero(ids[start:end] != ids[start-1:end-1]) + start)
+    run_start = np.concatenate(changes)
+    run_len = np.diff(np.r_[run_start, len(ids)])
+    run_codes, sources = pd.factorize(ids[run_start])
+    lengths = np.bincount(run_codes, weights=run_len, minlength=len(sources)).astype(np.int64)
+    data = np.zeros((len(sources), lengths.max()))
+
+    # keep count of how many points of each profile we have seen so far
+    seen = np.zeros(len(sources), dtype=np.int64)
+    for start in range(0, len(ids), chunk):
+        end = min(start+chunk, len(ids))
+        # the runs that overlap this chunk, cut to the chunk
+        r0 = np.searchsorted(run_start, start, side='right') - 1
+        r1 = np.searchsorted(run_start, end, side='left')
+        rs = np.maximum(run_start[r0:r1], start)
+        rlen = np.minimum(run_start[r0:r1] + run_len[r0:r1], end) - rs
+        rcode = run_codes[r0:r1]
+        # position of each row within its own profile, from the points of each
+        # profile in the earlier runs
+        before = seen[rcode] + pd.Series(rlen).groupby(rcode, sort=False).cumsum().values - rlen
+        c = np.repeat(rcode, rlen)
+        pos = np.repeat(before - rs, rlen) + np.arange(start, end)
+        data[c, pos] = values[start:end]
+        np.add.at(seen, rcode, rlen)
+    return data, lengths
+
+def _average_euclidian_block(rows, rows_len, cols, cols_len):
+    """
+    Average Euclidian difference between each profile in rows and each profile
+    in cols, truncated to the length of the shorter one. Returns an array of
+    size (len(rows), len(cols)).
+    """
+    # squared differences between the two sets of profiles. we never need more
+    # than the longest row since the shorter profile sets the length
+    max_len = min(rows_len.max(), cols.shape[1])
+    sq = rows[:, None, :max_len] - cols[None, :, :max_len]
+    np.square(sq, out=sq)
+    # prefix sums, so the sum up to any truncation length is a single lookup
+    np.cumsum(sq, axis=2, out=sq)
+    trunc_len = np.minimum(rows_len[:,None], cols_len[None,:])
+    ss = np.take_along_axis(sq, (trunc_len-1)[:,:,None], axis=2)[:,:,0]
+    return np.sqrt(ss)/trunc_len
+
+# bytes used by _average_euclidian_rows for each pair in a block of rows: the
+# distances, the upper triangle mask, the condensed copy of the upper triangle
+# and the copy of it sent back by a worker process
+EUCLIDIAN_PAIR_BYTES = 25
+
+def _euclidian_chunk_bytes(max_len):
+    """
+    Bytes used by _average_euclidian_block for each pair of profiles: the squared
+    differences (summed in place), plus the truncation lengths, their indices,
+    the sums of squares and the distances.
+    """
+    return 8*(max_len + 5)
+
+def _average_euclidian_rows(data, lengths, start, end, block_memory=None):
+    """
+    Average Euclidian difference between each profile in rows [start, end)
+    and every profile after it, truncated to the length of the shorter one.
+    Returns the matching slice of the condensed distance vector.
+
+    If block_memory (bytes) is given, the later profiles are compared in chunks
+    so the whole calculation stays within it (see EUCLIDIAN_PAIR_BYTES and
+    _euclidian_chunk_bytes).
+    """
+    n = data.shape[0]
+    n_rows, n_cols = end-start, n-start-1
+    chunk = n_cols
+    if block_memory is not None:
+        chunk_memory = block_memory - n_rows*n_cols*EUCLIDIAN_PAIR_BYTES
+        chunk = max(1, int(chunk_memory // (n_rows*_euclidian_chunk_bytes(data.shape[1]))))
+    d = np.empty((n_rows, n_cols))
+    for c in range(start+1, n, chunk):
+        c_end = min(c+chunk, n)
+        d[:, c-start-1:c_end-start-1] = _average_euclidian_block(data[start:end], lengths[start:end], data[c:c_end], lengths[c:c_end])
+
+    # only keep the upper triangle (j > i)
+    upper = np.arange(n-start-1)[None,:] >= np.arange(end-start)[:,None]
+    return d[upper]
+
+def NearestProfiles(data_a, lengths_a, data_b, lengths_b, block_size=None, distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Find the nearest profile in one set to each profile in another set, e.g.
+    the nearest prototype to each profile.
+    The distances are computed in blocks of rows and only the nearest one is
+    kept, so the full len(data_a) x len(data_b) matrix is never held in memory.
+
+    Args:
+        data_a, data_b: padded arrays of profiles from ProfilesToPaddedArray
+        lengths_a, lengths_b: number of points in each profile
+        block_size (int): number of rows of data_a to compare at once. Default = None,
+        which picks the block size so each block uses roughly 128 MB.
+        distance (str): 'euclidian', 'lag' or 'dtw', see DistanceKernel. Default = 'euclidian'.
+        max_lag, band, lb_cutoff: options for the 'lag' and 'dtw' distances, see DistanceKernel.
+
+    Returns: array of the index in data_b of the nearest profile to each profile
+    in data_a, and array of the distances to them
+    """
+    block = DistanceBlock(distance, max_lag, band, lb_cutoff)
+    n_a = data_a.shape[0]
+    nearest = np.empty(n_a, dtype=np.int64)
+    dist = np.empty(n_a)
+    if block_size is None:
+        block_size = max(1, int(2**24 // max(data_b.size, 1)))
+    for start in range(0, n_a, block_size):
+        end = min(start+block_size, n_a)
+        d = block(data_a[start:end], lengths_a[start:end], data_b, lengths_b)
+        nearest[start:end] = np.argmin(d, axis=1)
+        dist[start:end] = d[np.arange(end-start), nearest[start:end]]
+    return nearest, dist
+
+# state shared with the worker processes for the parallel distance calculation
+_worker_state = {}
+
+def _init_distance_worker(kernel, data_buf, data_shape, data_dtype, lengths_buf, out_buf):
+    """
+    Set up a worker process with numpy views of the shared profile array,
+    lengths and output distance vector.
+    """
+    _worker_state['kernel'] = kernel
+    _worker_state['data'] = np.frombuffer(data_buf, dtype=data_dtype).reshape(data_shape)
+    _worker_state['lengths'] = np.frombuffer(lengths_buf, dtype=np.int64)
+    _worker_state['out'] = None if out_buf is None else np.frombuffer(out_buf)
+
+def _distance_worker(task):
+    """
+    Compute one block of rows of the condensed distance vector and write it
+    into the shared output. If there is no shared output the block is returned.
+    """
+    start, end, k = task
+    block = _worker_state['kernel'](_worker_state['data'], _worker_state['lengths'], start, end)
+    if _worker_state['out'] is None:
+        return k, block
+    _worker_state['out'][k:k+len(block)] = block
+
+def CondensedDistances(kernel, data, lengths, block_size=None, n_jobs=1, out=None):
+    """
+    Fill the condensed distance vector (as used by scipy linkage) by splitting
+    it into blocks of rows. Each block is computed by the kernel function, which
+    takes (data, lengths, start, end) and returns the distances between rows
+    [start, end) and every row after them. For a fixed block size the result is
+    identical for any number of jobs. The float64 kernels give identical results
+    for any block size too, but kernels that use BLAS on float32 data (e.g.
+    _pearson_rows) can change in the last float32 digit (~1e-7) with the block size.
+
+    Args:
+        kernel: function to compute a block of rows
+        data: 2d array of profiles
+        lengths: number of points in each profile
+        block_size (int): number of rows to compute at once. Default = None,
+        which picks the block size so each block uses roughly 128 MB.
+        n_jobs (int): number of processes to use. Default = 1 (serial). Set to
+        -1 to use all the cores. The profile array is put in shared memory
+        rather than copied to each process.
+        out: array to write the distances to, e.g. a float32 or memory-mapped
+        array. Default = None, which makes a new float64 array.
+
+    Returns: condensed distance vector of length n*(n-1)/2
+    """
+    n, max_len = data.shape
+    n_dist = n * (n - 1) // 2
+    if block_size is None:
+        block_size = max(1, int(2**24 // max(n * max_len, 1)))
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = mp.cpu_count()
+
+    # list of (start row, end row, position in the condensed vector)
+    tasks = []
+    for start in range(0, n-1, block_size):
+        end = min(start+block_size, n-1)
+        tasks.append((start, end, start*n - start*(start+1)//2))
+
+    if n_jobs == 1 or len(tasks) < 2:
+        dist = np.empty(n_dist) if out is None else out
+        for start, end, k in tasks:
+            block = kernel(data, lengths, start, end)
+            dist[k:k+len(block)] = block
+        return dist
+
+    # copy the profiles into shared memory so the workers can all read them.
+    # float32 data stay float32 so the kernel sees the same array as in serial.
+    data_dtype = np.dtype(np.float32 if data.dtype == np.float32 else np.float64)
+    data_buf = mp.RawArray('f' if data_dtype == np.float32 else 'd', data.size)
+    np.frombuffer(data_buf, dtype=data_dtype).reshape(data.shape)[:] = data
+    lengths_buf = mp.RawArray('q', n)
+    np.frombuffer(lengths_buf, dtype=np.int64)[:] = lengths
+    # if we have an output array the workers send back each block instead
+    out_buf = mp.RawArray('d', n_dist) if out is None else None
+
+    print("Calculating the distance matrix with {} processes".format(n_jobs))
+    with mp.Pool(n_jobs, initializer=_init_distance_worker,
+                 initargs=(kernel, data_buf, data.shape, data_dtype, lengths_buf, out_buf)) as pool:
+        for result in pool.imap_unordered(_distance_worker, tasks):
+            if out is not None:
+                k, block = result
+                out[k:k+len(block)] = block
+
+    if out is None:
+        return np.frombuffer(out_buf)
+    return out
+
+def AverageEuclidianDistanceMatrix(data, lengths, block_size=None, n_jobs=1):
+    """
+    Compute the condensed distance vector of the average Euclidian difference
+    between every pair of profiles, truncating each pair to the length of the
+    shorter profile. This gives the same distances as calling AverageEuclidianDifference
+    on every pair (to floating point precision), but works on blocks of rows at once.
+
+    Args:
+        data: padded array of profiles from ProfilesToPaddedArray
+        lengths: number of points in each profile
+        block_size (int): number of rows to compare at once, see CondensedDistances
+        n_jobs (int): number of processes to use. Default = 1.
+
+    Returns: condensed distance vector of length n*(n-1)/2
+    """
+    return CondensedDistances(_average_euclidian_rows, data, lengths, block_size, n_jobs)
+
+def _pearson_rows(data, lengths, start, end):
+    """
+    Angle between the standardised profiles in rows [start, end) and every
+    profile after it, i.e. arccos of the Pearson correlation. The rows must
+    already have zero mean and unit norm (see StandardiseProfiles), so the
+    correlations are just a matrix product.
+    """
+    n = data.shape[0]
+    cc = np.dot(data[start:end], data[start+1:].T)
+    # rounding can push the correlation just outside [-1, 1]
+    np.clip(cc, -1, 1, out=cc)
+    d = np.arccos(cc)
+
+    # only keep the upper triangle (j > i)
+    upper = np.arange(n-start-1)[None,:] >= np.arange(end-start)[:,None]
+    return d[upper]
+
+def StandardiseProfiles(data, dtype=np.float32):
+    """
+    Remove the mean of each profile and scale it to unit length, so that the dot
+    product of two profiles is their Pearson correlation. Profiles with a constant
+    slope are left as zeros (correlation of 0 with everything).
+
+    Args:
+        data: 2d array with one profile in each row
+        dtype: dtype of the result. Default = float32, which halves the memory and
+        is plenty for the correlations.
+
+    Returns: array of standardised profiles
+    """
+    data = data - data.mean(axis=1)[:,None]
+    norm = np.sqrt(np.square(data).sum(axis=1))
+    norm[norm == 0] = 1
+    return (data/norm[:,None]).astype(dtype)
+
+def PearsonDistanceMatrix(data, block_size=None, n_jobs=1):
+    """
+    Compute the condensed distance vector of the angle between every pair of
+    profiles (arccos of the Pearson correlation). All the profiles must have the
+    same number of points.
+
+    Args:
+        data: 2d array with one profile in each row
+        block_size (int): number of rows to compare at once, see CondensedDistances
+        n_jobs (int): number of processes to use. Default = 1.
+
+    Returns: condensed distance vector of length n*(n-1)/2
+    """
+    data = StandardiseProfiles(data)
+    lengths = np.full(data.shape[0], data.shape[1], dtype=np.int64)
+    return CondensedDistances(_pearson_rows, data, lengths, block_size, n_jobs)
+
+def _drainage_area_rows(data, lengths, start, end):
+    """
+    Difference between each slope-area series in rows [start, end) and every
+    series after it, using the same measure as find_difference_between_arrays on
+    the areas where both series have data. All the pairs in the block are
+    compared at once with boolean masks.
+    """
+    n = data.shape[0]
+    rows = data[start:end, None, :]
+    cols = data[None, start+1:, :]
+    # areas where there is data in both time series
+    both = ~np.isnan(rows) & ~np.isnan(cols)
+    # the number of identical points sets how much of each pair of series we keep
+    l = np.count_nonzero(both & (rows == cols), axis=2)
+    # position of each point in the series once the missing areas are removed
+    keep = both & (np.cumsum(both, axis=2) <= l[:,:,None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        div = np.where(keep, (rows - cols)/(rows + cols), 0)
+        diff = 1 - np.sqrt(np.square(div).sum(axis=2))/np.sqrt(l)
+
+    # only keep the upper triangle (j > i)
+    upper = np.arange(n-start-1)[None,:] >= np.arange(end-start)[:,None]
+    return diff[upper]
+
+def _min_lag_block(rows, rows_len, cols, cols_len, max_lag, min_overlap=0.5):
+    """
+    Average Euclidian difference between each profile in rows and each profile
+    in cols, minimised over shifts of up to max_lag points in either direction.
+    For each shift the difference is calculated over the part where the two
+    profiles overlap, which must be at least min_overlap times the length of the
+    shorter profile. The cross-correlations for all the shifts come from one FFT,
+    and the sums of squares over each overlap from prefix sums. The FFT is only
+    accurate to floating point precision, so the difference with no shift is
+    calculated directly: it is exactly the truncated difference from
+    AverageEuclidianDifference, and it is used if it ties with the minimum.
+
+    Returns: arrays of size (len(rows), len(cols)) with the minimum difference
+    and the shift of the cols profile at the minimum
+    """
+    n_rows, n_cols = rows.shape[0], cols.shape[0]
+    max_len = max(rows.shape[1], cols.shape[1])
+    max_lag = min(max_lag, max_len-1)
+    lags = np.arange(-max_lag, max_lag+1)
+    # pad to avoid the circular correlation wrapping onto the data
+    n_fft = 2**int(np.ceil(np.log2(max_len+max_lag)))
+    fx = np.conj(np.fft.rfft(rows, n_fft, axis=1))
+    fy = np.fft.rfft(cols, n_fft, axis=1)
+    # prefix sums of squares, so the sum over any overlap is a single lookup
+    px = np.zeros((n_rows, rows.shape[1]+1))
+    np.cumsum(np.square(rows), axis=1, out=px[:,1:])
+    py = np.zeros((n_cols, cols.shape[1]+1))
+    np.cumsum(np.square(cols), axis=1, out=py[:,1:])
+
+    # x[t] is compared with y[t+lag] for t0 <= t < t1
+    a = rows_len[:,None,None]
+    b = cols_len[None,:,None]
+    t0 = np.maximum(0, -lags)[None,None,:]
+    t1 = np.minimum(a, b-lags[None,None,:])
+    n_overlap = t1 - t0
+    valid = n_overlap >= np.maximum(1, np.ceil(min_overlap*np.minimum(a, b)))
+    # the indices for shifts without enough overlap don't matter, just keep them in range
+    t1 = np.maximum(t1, t0)
+    x0, x1 = np.minimum(t0, rows.shape[1]), np.minimum(t1, rows.shape[1])
+    y0, y1 = np.clip(t0+lags, 0, cols.shape[1]), np.clip(t1+lags, 0, cols.shape[1])
+    i = np.arange(n_rows)[:,None,None]
+    j = np.arange(n_cols)[None,:,None]
+    ss = (px[i, x1] - px[i, x0]) + (py[j, y1] - py[j, y0])
+    corr = np.fft.irfft(fx[:,None,:]*fy[None,:,:], n_fft, axis=2)[:,:,lags % n_fft]
+    ss -= 2*corr
+    # rounding can make the sum of squares slightly negative
+    np.maximum(ss, 0, out=ss)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.where(valid, np.sqrt(ss)/n_overlap, np.inf)
+    zero = max_lag
+    d[:,:,zero] = _average_euclidian_block(rows, rows_len, cols, cols_len)
+    best = np.argmin(d, axis=2)
+    best[d[:,:,zero] <= np.take_along_axis(d, best[:,:,None], axis=2)[:,:,0]] = zero
+    return np.take_along_axis(d, best[:,:,None], axis=2)[:,:,0], lags[best]
+
+def _min_lag_cross(rows, rows_len, cols, cols_len, max_lag=200, min_overlap=0.5):
+    """
+    Lag-tolerant difference between each profile in rows and each profile in
+    cols, see _min_lag_block. The cols are done in chunks to limit the memory
+    for the FFTs. Returns an array of size (len(rows), len(cols)).
+    """
+    n_rows, n_cols = rows.shape[0], cols.shape[0]
+    chunk = max(1, int(2**22 // max(n_rows*max(rows.shape[1], cols.shape[1])*4, 1)))
+    d = np.empty((n_rows, n_cols))
+    for c in range(0, n_cols, chunk):
+        c_end = min(c+chunk, n_cols)
+        d[:, c:c_end] = _min_lag_block(rows, rows_len, cols[c:c_end], cols_len[c:c_end], max_lag, min_overlap)[0]
+    return d
+
+def _min_lag_rows(data, lengths, start, end, max_lag=200, min_overlap=0.5):
+    """
+    Lag-tolerant difference between each profile in rows [start, end) and every
+    profile after it, see _min_lag_block. Returns the matching slice of the
+    condensed distance vector.
+    """
+    n = data.shape[0]
+    d = _min_lag_cross(data[start:end], lengths[start:end], data[start+1:], lengths[start+1:], max_lag, min_overlap)
+
+    # only keep the upper triangle (j > i)
+    upper = np.arange(n-start-1)[None,:] >= np.arange(end-start)[:,None]
+    return d[upper]
+
+def MinimiseLag(x, y, s=200, min_overlap=0.5):
     """
     Take in two arrays x and y, and do a shifting to minimise the average
     euclidian distance between them
@@ -64,8 +482,181 @@ def AverageEuclidianDifference(x, y):
         x: first array
         y: second array
         s: maximum shift, default = 200 px
+        min_overlap: the shifted arrays must overlap by at least this fraction
+        of the shorter array. Default = 0.5.
+
+    Returns: the minimum average euclidian distance, and the shift of y at the minimum
     FJC
     """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    d, lag = _min_lag_block(x[None,:], np.array([len(x)]), y[None,:], np.array([len(y)]), s, min_overlap)
+    return d[0,0], lag[0,0]
+
+def _dtw_pairs(x, y, trunc_len, band):
+    """
+    Dynamic time warping between pairs of profiles x[p] and y[p], truncated to
+    trunc_len[p] points, only allowing points to be matched if they are within
+    band points of each other (Sakoe-Chiba band). The cost is the sum of squared
+    differences along the warping path. All the pairs are done at once: we loop
+    over the points of x, and each row of the cost matrix is found in one go
+    from the row before it using prefix sums.
+
+    Returns: the DTW cost of each pair
+    """
+    n_pairs, max_len = x.shape
+    offsets = np.arange(-band, band+1)
+    width = len(offsets)
+    # pad y so we can slice the band around each point
+    y_pad = np.zeros((n_pairs, max_len+2*band))
+    y_pad[:, band:band+max_len] = y
+    cost = np.empty(n_pairs)
+    d_prev = None
+    for i in range(trunc_len.max()):
+        valid = (i+offsets >= 0) & (i+offsets < max_len)
+        c = np.square(x[:, i, None] - y_pad[:, i:i+width])
+        c[:, ~valid] = 0
+        # best path into each cell from the row before. D[i-1, j-1] is at the same
+        # offset in the previous row, and D[i-1, j] is at the next offset.
+        if i == 0:
+            e = np.full((n_pairs, width), np.inf)
+            e[:, band] = c[:, band]
+        else:
+            above = np.full((n_pairs, width), np.inf)
+            above[:, :-1] = d_prev[:, 1:]
+            e = c + np.minimum(d_prev, above)
+        e[:, ~valid] = np.inf
+        # D[i, j] = min(e[j], c[j] + D[i, j-1]), which is a running minimum
+        # once we take off the prefix sum of c
+        cum_c = np.cumsum(c, axis=1)
+        d = cum_c + np.minimum.accumulate(e - cum_c, axis=1)
+        done = trunc_len == i+1
+        cost[done] = d[done, band]
+        d_prev = d
+    return cost
+
+def _lb_keogh_block(rows, rows_len, cols, cols_len, band):
+    """
+    LB_Keogh lower bound of the DTW difference between each profile in rows and
+    each profile in cols, truncated to the length of the shorter one. This only
+    needs the upper and lower envelopes of the cols profiles within the band.
+
+    Returns: array of size (len(rows), len(cols))
+    """
+    upper = ndimage.maximum_filter1d(cols, 2*band+1, axis=1, mode='nearest')
+    lower = ndimage.minimum_filter1d(cols, 2*band+1, axis=1, mode='nearest')
+    max_len = min(rows_len.max(), cols.shape[1])
+    x = rows[:, None, :max_len]
+    excess = np.maximum(x - upper[None, :, :max_len], 0) + np.minimum(x - lower[None, :, :max_len], 0)
+    np.square(excess, out=excess)
+    np.cumsum(excess, axis=2, out=excess)
+    trunc_len = np.minimum(rows_len[:,None], cols_len[None,:])
+    ss = np.take_along_axis(excess, (trunc_len-1)[:,:,None], axis=2)[:,:,0]
+    return np.sqrt(ss)/trunc_len
+
+def _dtw_fill(x_data, y_data, ii, jj, trunc_len, todo, band, dist):
+    """
+    Full DTW difference between the profiles x_data[ii[p]] and y_data[jj[p]] for
+    each pair p in todo, truncated to trunc_len[p] points and scaled in the same
+    way as the average Euclidian difference. The results are written to dist[p].
+    """
+    # do the full DTW in chunks of pairs to limit the memory
+    chunk = max(1, int(2**22 // (4*(2*band+1) + max(x_data.shape[1], y_data.shape[1]))))
+    for c in range(0, len(todo), chunk):
+        p = todo[c:c+chunk]
+        max_len = trunc_len[p].max()
+        cost = _dtw_pairs(x_data[ii[p], :max_len], y_data[jj[p], :max_len], trunc_len[p], band)
+        dist[p] = np.sqrt(cost)/trunc_len[p]
+
+def _dtw_rows(data, lengths, start, end, band=10, lb_cutoff=None):
+    """
+    DTW difference between each profile in rows [start, end) and every profile
+    after it, truncated to the length of the shorter one and scaled in the same
+    way as the average Euclidian difference (a band of 0 is equivalent to that,
+    up to rounding). If lb_cutoff is set, pairs whose LB_Keogh lower bound is
+    already above it get the lower bound instead of the full DTW. Returns the
+    matching slice of the condensed distance vector.
+    """
+    n = data.shape[0]
+    band = min(band, data.shape[1]-1)
+    # the pairs in the upper triangle (j > i), in the order of the condensed vector
+    upper = np.arange(n-start-1)[None,:] >= np.arange(end-start)[:,None]
+    ii, jj = np.nonzero(upper)
+    jj += start+1
+    ii += start
+    trunc_len = np.minimum(lengths[ii], lengths[jj])
+
+    if lb_cutoff is None:
+        dist = np.empty(len(ii))
+        todo = np.arange(len(ii))
+    else:
+        dist = _lb_keogh_block(data[start:end], lengths[start:end], data[start+1:], lengths[start+1:], band)[upper]
+        todo = np.nonzero(dist < lb_cutoff)[0]
+
+    _dtw_fill(data, data, ii, jj, trunc_len, todo, band, dist)
+    return dist
+
+def _dtw_cross(rows, rows_len, cols, cols_len, band=10, lb_cutoff=None):
+    """
+    DTW difference between each profile in rows and each profile in cols, in
+    the same way as _dtw_rows. Returns an array of size (len(rows), len(cols)).
+    """
+    n_rows, n_cols = rows.shape[0], cols.shape[0]
+    band = min(band, max(rows.shape[1], cols.shape[1])-1)
+    ii, jj = np.divmod(np.arange(n_rows*n_cols), n_cols)
+    trunc_len = np.minimum(rows_len[ii], cols_len[jj])
+
+    if lb_cutoff is None:
+        dist = np.empty(len(ii))
+        todo = np.arange(len(ii))
+    else:
+        dist = _lb_keogh_block(rows, rows_len, cols, cols_len, band).ravel()
+        todo = np.nonzero(dist < lb_cutoff)[0]
+
+    _dtw_fill(rows, cols, ii, jj, trunc_len, todo, band, dist)
+    return dist.reshape(n_rows, n_cols)
+
+def DistanceKernel(distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Get the function for calculating the blocks of the distance matrix,
+    see CondensedDistances.
+
+    Args:
+        distance (str): 'euclidian' for the average Euclidian difference truncated to
+        the shorter profile, 'lag' to minimise this over shifts of the profiles
+        (see MinimiseLag), or 'dtw' for dynamic time warping. Default = 'euclidian'.
+        max_lag (int): maximum shift in points for the 'lag' distance. Default = 200.
+        band (int): width of the warping band in points for the 'dtw' distance. Default = 10.
+        lb_cutoff (float): for the 'dtw' distance, pairs whose LB_Keogh lower bound is
+        above this get the lower bound instead of the full DTW. This only changes
+        distances above the cutoff, so set it above the level you will cut the
+        dendrogram at. Default = None (full DTW for every pair).
+    """
+    if distance == 'euclidian':
+        return _average_euclidian_rows
+    if distance == 'lag':
+        return functools.partial(_min_lag_rows, max_lag=max_lag)
+    if distance == 'dtw':
+        return functools.partial(_dtw_rows, band=band, lb_cutoff=lb_cutoff)
+    raise ValueError("Unknown distance '{}', use 'euclidian', 'lag' or 'dtw'".format(distance))
+
+def DistanceBlock(distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Get the function for calculating the distances between two sets of profiles,
+    e.g. between each profile and the prototypes in NearestProfiles. The function
+    takes (rows, rows_len, cols, cols_len) and returns an array of size
+    (len(rows), len(cols)) with the same distances as DistanceKernel.
+
+    Args:
+        distance, max_lag, band, lb_cutoff: see DistanceKernel
+    """
+    if distance == 'euclidian':
+        return _average_euclidian_block
+    if distance == 'lag':
+        return functools.partial(_min_lag_cross, max_lag=max_lag)
+    if distance == 'dtw':
+        return functools.partial(_dtw_cross, band=band, lb_cutoff=lb_cutoff)
+    raise ValueError("Unknown distance '{}', use 'euclidian', 'lag' or 'dtw'".format(distance))
 
 
 
@@ -99,45 +690,38 @@ def ProfilesRegularDistance(DataDirectory, fname_prefix, df, profile_len = 1000,
     # find the minimum length that the array can be (profile length/root2)
     min_length = profile_len/(math.sqrt(2))
 
-    # loop through the dataframe and store the data for each profile as an array of
-    # slopes and distances
-    profiles = []
-    source_ids = df['id'].unique()
-    final_sources = []
-    for i, source in enumerate(source_ids):
-        this_df = df[df['id'] == source]
-        this_df = this_df[np.isnan(this_df['slope']) == False]  # remove nans
-        if not this_df.empty:
-            slopes = this_df['slope'].values[::-1] #need to reverse these as the distances need to be sorted
-            distances = this_df['distance_from_outlet'].values[::-1]
-            if (distances.max() >= profile_len):
-                profiles.append((distances, slopes))
-                #thinned_df = thinned_df.append(this_df)
-                final_sources.append(source)
+    # keep the nodes with a slope, for the profiles that are long enough
+    this_df = df[df['slope'].notna()]
+    max_dist = this_df.groupby('id')['distance_from_outlet'].transform('max')
+    this_df = this_df[max_dist >= profile_len]
+    codes, final_sources = pd.factorize(this_df['id'])
+    n_profiles = len(final_sources)
+
+    # sort each profile by distance. The nodes are listed going downstream, so if
+    # two nodes have the same distance we take the later one first.
+    distances = this_df['distance_from_outlet'].values.astype(float)
+    order = np.lexsort((-np.arange(len(distances)), distances, codes))
+    sorted_dist = distances[order]
+    group_start = np.searchsorted(codes[order], np.arange(n_profiles))
+    group_end = np.r_[group_start[1:], len(order)]
+
+    # for each point in the regularly spaced array, find the index of the closest
+    # point in each profile. Then use this to gather the slopes and the rows
+    # of the dataframe in one go.
+    rows = np.empty((n_profiles, len(reg_dist)), dtype=int)
+    for g in range(n_profiles):
+        rows[g] = group_start[g] + find_nearest_indices(sorted_dist[group_start[g]:group_end[g]], reg_dist)
+    rows = order[rows]
 
     # now create the 2d array to store the data
-    n_profiles = len(profiles)
-    data = np.empty((n_profiles, len(reg_dist)))
+    data = this_df['slope'].values[rows].astype(float)
 
     # create a new dataframe for storing the data about the selected profiles
-    thinned_df = pd.DataFrame()
-
-    # loop through the profiles. For each point in the regularly spaced array,
-    # find the index of the closest point in the distance array. Then use this to
-    # assign the slope to the regularly spaced array
-    for i, p in enumerate(profiles):
-        reg_slope = []
-        for d in reg_dist:
-            idx = find_nearest_idx(p[0], d)
-            reg_slope.append(p[1][idx])
-            this_dist = p[0][idx]
-            # get this distance and append the regular distance to the thinned df
-            thinned_df = thinned_df.append(df.loc[(df['id']==final_sources[i]) & (df['distance_from_outlet'] == p[0][idx])])
-        thinned_df.loc[(thinned_df['id'] == final_sources[i]), 'reg_dist'] = reg_dist
-        data[i] = reg_slope
+    thinned_df = this_df.iloc[rows.ravel()].copy()
+    thinned_df['reg_dist'] = np.tile(reg_dist, n_profiles).astype(float)
 
     # write the thinned_df to output in case we want to reload
-    thinned_df.to_csv(DataDirectory+fname_prefix+'_profiles_upstream_reg_dist.csv',index=False)
+    pio.write_table(thinned_df, DataDirectory+fname_prefix+'_profiles_upstream_reg_dist.csv')
     #
     return thinned_df, data
 
@@ -177,6 +761,7 @@ def ProfilesRegDistVaryingLength(DataDirectory, fname_prefix, df, profile_len=4,
     source_ids = df['id'].unique()
     print (source_ids)
     rows_list = []
+    plot_ids, plot_dist, plot_slope = [], [], []
     for i, source in enumerate(source_ids):
         this_df = df[df['id'] == source]
         # create new array of regularly spaced differences
@@ -197,8 +782,10 @@ def ProfilesRegDistVaryingLength(DataDirectory, fname_prefix, df, profile_len=4,
 
                 rows_list.append(this_row)
 
-            # plot this profile
-            ax.plot(reg_dist, reg_slope, lw=1)
+            # save this profile to plot them all at once
+            plot_ids.append(np.full(len(reg_dist), i))
+            plot_dist.append(reg_dist)
+            plot_slope.append(reg_slope)
 
     # change the array back to a dataframe
     cols = list(df.columns.values)
@@ -210,7 +797,11 @@ def ProfilesRegDistVaryingLength(DataDirectory, fname_prefix, df, profile_len=4,
     thinned_df = RemoveProfilesWithShortUniqueSection(thinned_df, profile_len)
 
     # write the thinned_df to output in case we want to reload
-    thinned_df.to_csv(DataDirectory+fname_prefix+'_profiles_upstream_reg_dist_var_length.csv', index=False)
+    pio.write_table(thinned_df, DataDirectory+fname_prefix+'_profiles_upstream_reg_dist_var_length.csv')
+
+    # plot each profile
+    if plot_ids:
+        pl.plot_profile_lines(ax, np.concatenate(plot_ids), np.concatenate(plot_dist), np.concatenate(plot_slope), lw=1)
 
     # now save the figure
     ax.set_xlabel('Distance from outlet (m)')
@@ -220,6 +811,79 @@ def ProfilesRegDistVaryingLength(DataDirectory, fname_prefix, df, profile_len=4,
 
     return thinned_df
 
+def ResampleProfiles(df, distances, step=2):
+    """
+    Resample every profile in the dataframe to a regular distance step. For each
+    regularly spaced distance we keep the node that is closest to it. The
+    dataframe is sorted once by id and distance, then each profile is matched
+    against all of its regular distances at once.
+
+    Args:
+        df: pandas dataframe with the river profiles
+        distances: array with the distance of each node along its profile (e.g.
+        distance from the source)
+        step (int): step size that you want in metres. Default = 2
+
+    Returns: dataframe with one row per regular distance for each profile, with
+    the regular distance in the 'reg_dist' column. Profiles are in the same order as
+    df['id'].unique().
+    """
+    codes, sources = pd.factorize(df['id'])
+    distances = np.asarray(distances, dtype=float)
+    order = np.lexsort((distances, codes))
+    sorted_dist = distances[order]
+
+    # find the rows of each profile in the sorted array
+    group_start = np.searchsorted(codes[order], np.arange(len(sources)))
+    group_end = np.r_[group_start[1:], len(order)]
+
+    # number of regular distances in each profile, same as
+    # np.arange(step, int(max_dist+step), step)
+    max_dist = sorted_dist[group_end-1]
+    n_reg = np.maximum(np.ceil(((max_dist+step).astype(int) - step)/step), 0).astype(int)
+    reg_start = np.r_[0, np.cumsum(n_reg)[:-1]]
+    reg_dist = step + step*(np.arange(n_reg.sum()) - np.repeat(reg_start, n_reg))
+
+    # find the nearest node to each regular distance
+    rows = np.empty(len(reg_dist), dtype=int)
+    for g in range(len(sources)):
+        these_reg = reg_dist[reg_start[g]:reg_start[g]+n_reg[g]]
+        idx = find_nearest_indices(sorted_dist[group_start[g]:group_end[g]], these_reg)
+        rows[reg_start[g]:reg_start[g]+n_reg[g]] = group_start[g] + idx
+
+    thinned_df = df.iloc[order[rows]].reset_index(drop=True)
+    thinned_df['reg_dist'] = reg_dist.astype(float)
+    return thinned_df
+
+def FindLongestChannelsThroughNodes(df, nodes):
+    """
+    For each of the nodes, find the longest channel (the one with the maximum
+    distance from outlet) that passes through it. We build an index of which
+    channels each node belongs to once, and then take the max for each node,
+    rather than searching the whole dataframe for every node. If two channels
+    are the same length we take the one that comes first in the dataframe.
+
+    Args:
+        df: pandas dataframe with the river profiles
+        nodes: list or array of node IDs to check
+
+    Returns: array of the ids of the longest channels
+    """
+    df = df.reset_index(drop=True)
+    # the length of each channel and the first row where it is reached
+    max_rows = df.groupby('id')['distance_from_outlet'].idxmax()
+    channels = pd.DataFrame({'id': max_rows.index.values,
+                             'length': df['distance_from_outlet'].values[max_rows.values],
+                             'row': max_rows.values})
+
+    # node -> channel index, only for the nodes that we need to check
+    members = df.loc[df['node'].isin(nodes), ['node', 'id']].drop_duplicates()
+    members = members.merge(channels, on='id').sort_values('row').reset_index(drop=True)
+
+    # find the longest channel through each node
+    longest = members.loc[members.groupby('node')['length'].idxmax(), 'id']
+    return longest.unique()
+
 def GetProfilesByStreamOrder(DataDirectory, fname_prefix, df,step=2,slope_window_size=25,stream_order=1):
     """
     Take the dataframe and return only the profiles of a certain stream order,
@@ -244,60 +908,24 @@ def GetProfilesByStreamOrder(DataDirectory, fname_prefix, df,step=2,slope_window
     # if not first order streams then find the longest channel
     if stream_order != 1:
         # get a list of the first highest order node for checking
-        check_nodes = so_df.groupby(by='id').apply(lambda x: x.iloc[-1]['node']).tolist()
+        check_nodes = so_df.groupby(by='id')['node'].last().values
 
         # now find the longest channel in the df that has this node in it
         so_df = df[df['stream_order'] <= stream_order]
-        new_df = so_df.groupby(by='id')
-        longest_ids = []
-        # loop through each higher order node and find all the channel profiles that contain them
-        for node in check_nodes:
-            these_ids = new_df.apply(lambda x: x[x['node'] == node])['id'].tolist()   # get the ids that have this node in it
-            this_df = so_df[so_df['id'].isin(these_ids)]  # filter the SO dataframe to only these IDs
-            # now find the ID of the longest one
-            longest_ids.append(this_df.loc[this_df['distance_from_outlet'].idxmax()]['id'])
-        #print(longest_ids)
+        longest_ids = FindLongestChannelsThroughNodes(so_df, check_nodes)
         longest_df = so_df[so_df['id'].isin(longest_ids)]
 
     #print so_df
 
-    # loop through the dataframe and store the data for each profile as an array of
-    # slopes and distances
-    source_ids = longest_df['id'].unique()
-    #print (source_ids)
-    rows_list = []
-    for i, source in enumerate(source_ids):
-        this_df = longest_df[longest_df['id'] == source]
-        # get the distances from the channel head
-        distances = [this_df.distance_from_outlet.max()-x for x in this_df.distance_from_outlet]
-    #    print distances
-        # create new array of regularly spaced differences
-        reg_dist = np.arange(step, int(np.max(distances)+step), step)
-
-        if not this_df.empty:
-            df_array = this_df.values
-            slopes = this_df['slope'].values
-            reg_slope = []
-            for d in reg_dist:
-                # find the index of the nearest point in the distance array
-                idx = find_nearest_idx(distances, d)
-                reg_slope.append(slopes[idx])
-                # find the row that corresponds to this distance
-                this_row = df_array[idx,:]
-                this_row = np.append(this_row,d)
-
-                rows_list.append(this_row)
-
-            # plot this profile
-            ax1.plot(reg_dist, reg_slope, lw=1)
+    # get the distances from the channel head and resample each profile
+    distances = longest_df.groupby('id')['distance_from_outlet'].transform('max') - longest_df['distance_from_outlet']
+    thinned_df = ResampleProfiles(longest_df, distances.values, step)
 
-    # change the array back to a dataframe
-    cols = list(df.columns.values)
-    cols.append('reg_dist')
-    thinned_df = pd.DataFrame(data=rows_list,columns=cols)
+    # plot each profile
+    pl.plot_profile_lines(ax1, thinned_df['id'].values, thinned_df['reg_dist'].values, thinned_df['slope'].values, lw=1)
 
     # write the thinned_df to output in case we want to reload
-    thinned_df.to_csv(DataDirectory+fname_prefix+'_profiles_SO{}.csv'.format(stream_order), index=False)
+    pio.write_table(thinned_df, DataDirectory+fname_prefix+'_profiles_SO{}.csv'.format(stream_order))
 
     # now save the figure
     ax1.set_xlabel('Distance from source (m)')
@@ -308,7 +936,27 @@ def GetProfilesByStreamOrder(DataDirectory, fname_prefix, df,step=2,slope_window
 
     return thinned_df
 
-def ClusterProfiles(DataDirectory, fname_prefix, df, profile_len=100, step=2, min_corr=0.5, method='complete'):
+def ProfileDistances(df, n_jobs=1, distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Get the condensed distance vector between the profiles for the clustering,
+    using the average Euclidian difference between the slopes of each pair of
+    profiles truncated to the length of the shorter one.
+
+    Args:
+        df: pandas dataframe with the regularly spaced profiles
+        n_jobs (int): number of processes to use. Default = 1.
+        distance (str): 'euclidian', 'lag' or 'dtw', see DistanceKernel. Default = 'euclidian'.
+        max_lag, band, lb_cutoff: options for the 'lag' and 'dtw' distances, see DistanceKernel.
+
+    Returns: condensed distance vector, in the order of df['id'].unique()
+    """
+    # get the data from the dataframe into the right format for clustering
+    data, lengths = ProfilesToPaddedArray(df, 'slope')
+
+    # average euclidian distance between each pair, truncated to the shorter profile
+    return CondensedDistances(DistanceKernel(distance, max_lag, band, lb_cutoff), data, lengths, n_jobs=n_jobs)
+
+def ClusterProfiles(DataDirectory, fname_prefix, df, profile_len=100, step=2, min_corr=0.5, method='complete', n_jobs=1):
     """
     Cluster the profiles based on gradient and distance from source.
     Aggolmerative clustering, see here for more info:
@@ -321,6 +969,7 @@ def ClusterProfiles(DataDirectory, fname_prefix, df, profile_len=100, step=2, mi
         min_corr (float): minimum correlation threshold for clustering
         method (str): clustering method to use, see scipy docs. Can be 'single', 'complete', 'average',
         'weighted', 'centroid', 'median', or 'ward'. Default is 'complete'.
+        n_jobs: number of processes for calculating the distance matrix. Default = 1, -1 uses all the cores.
 
     Author: AR, FJC
     """
@@ -328,22 +977,13 @@ def ClusterProfiles(DataDirectory, fname_prefix, df, profile_len=100, step=2, mi
 
     # get the data from the dataframe into the right format for clustering
     sources = df['id'].unique()
-    #print sources
-    pts_in_profile = len(df[df['id'] == sources[0]])
-    data = np.empty((len(sources), pts_in_profile))
-
-    for i, src in enumerate(sources):
-        this_df = df[df['id'] == src]
-        data[i] = this_df['slope']
-    #print data
-
+    data, lengths = ProfilesToPaddedArray(df, 'slope')
+    if (lengths != lengths[0]).any():
+        raise ValueError("The profiles need to be the same length for this clustering, use ClusterProfilesVaryingLength instead")
 
     # we could have a look at the ranks too ..
-    # correlations
-    cc = Pearson(data)
-
-    # distances
-    dd = np.arccos(cc)
+    # distances: angle between the profiles from the correlations
+    dd = PearsonDistanceMatrix(data, n_jobs=n_jobs)
 
     # do agglomerative clustering by stepwise pair matching
     # based on angle between scalar products of time series
@@ -356,10 +996,10 @@ def ClusterProfiles(DataDirectory, fname_prefix, df, profile_len=100, step=2, mi
     cl = fcluster(ln, thr, criterion = 'distance')
     print("I've finished! I found {} clusters for you :)".format(cl.max()))
 
+    colors = pl.list_of_hex_colours(max(cl.max(), 8), 'Set1')[:cl.max()]
+    threshold_color = '#A9A9A9'
     set_link_color_palette(colors)
 
-    source_ids = df['id'].unique()
-
     plt.title('Hierarchical Clustering Dendrogram')
     plt.ylabel('distance')
     R = dendrogram(ln, color_threshold=thr, above_threshold_color=threshold_color,no_labels=True)
@@ -368,12 +1008,11 @@ def ClusterProfiles(DataDirectory, fname_prefix, df, profile_len=100, step=2, mi
     plt.savefig(DataDirectory+fname_prefix+"_upstream_dendrogram.png", dpi=300)
     plt.clf()
 
-    for i,id in enumerate(source_ids):
-        df.loc[df.id==id, 'cluster_id'] = cl[i]
+    df['cluster_id'] = df['id'].map(dict(zip(sources, cl))).astype(float)
 
     return df
 
-def ClusterProfilesVaryingLength(DataDirectory, OutDirectory, fname_prefix, df, method='ward',stream_order=1,threshold_level=0):
+def ClusterProfilesVaryingLength(DataDirectory, OutDirectory, fname_prefix, df, method='ward',stream_order=1,threshold_level=0,n_jobs=1,ln=None,n_clusters=None,prototypes=None,distance='euclidian',max_lag=200,band=10,lb_cutoff=None,plot_distance=True):
     """
     Cluster the profiles based on gradient and distance from source. This works for profiles of varying length.
     Aggolmerative clustering, see here for more info:
@@ -386,6 +1025,19 @@ def ClusterProfilesVaryingLength(DataDirectory, OutDirectory, fname_prefix, df,
         stream_order: the stream order of the profiles, default = first order.
         threshold_level: the level at which to cut the dendrogram. Threshold level 0 is the default, and this is the level
         with the maximum distance between clusters. Can increase this to 1 to take the second max distance.
+        n_jobs: number of processes for calculating the distance matrix. Default = 1, -1 uses all the cores.
+        ln: linkage matrix for these profiles from BuildHierarchy, e.g. from an earlier run or the cache.
+        If this is None (default) then we calculate it.
+        n_clusters: cut the dendrogram to give this number of clusters instead of using the threshold level.
+        Default = None.
+        prototypes: if ln is the hierarchy of a set of prototypes from BuildApproximateHierarchy, the
+        prototype index of each profile. Each profile gets the cluster of its prototype. Default = None.
+        distance: 'euclidian' for the average Euclidian difference between the profiles, 'lag' to
+        allow the profiles to be shifted along-stream by up to max_lag points (see MinimiseLag), or
+        'dtw' for dynamic time warping within a band of band points. Default = 'euclidian'.
+        lb_cutoff: for 'dtw', skip the full DTW for pairs whose lower bound is above this, see DistanceKernel.
+        plot_distance: plot the distance vs number of clusters. Set this to False when you cut the same
+        hierarchy several times, and plot it once with PlotDistanceVsNClusters instead. Default = True.
 
     Author: AR, FJC
     """
@@ -394,49 +1046,31 @@ def ClusterProfilesVaryingLength(DataDirectory, OutDirectory, fname_prefix, df,
 
     #sort the dataframe based on max distance from outlet for each source id.
 
-    # get the data from the dataframe into the right format for clustering
     sources = df['id'].unique()
-    n = len(sources)
-    data = []
-
-    for i, src in enumerate(sources):
-        this_df = df[df['id'] == src]
-        data.append(this_df['slope'].values)
-
-    # correlation coefficients
-    cc = np.zeros(int(n * (n - 1) / 2))
-    #cc = []
-    k = 0
-    for i in range(n):
-        for j in range(i+1, n):
-            tsi = data[i]
-            tsj = data[j]
-            if len(tsi) > len(tsj):
-                tsi = tsi[:len(tsj)]
-            else:
-                tsj = tsj[:len(tsi)]
-            cc[k] = AverageEuclidianDifference(tsi, tsj)
-            k += 1
-
-    ln = linkage(cc, method=method)
+    if ln is None:
+        ln = BuildHierarchy(df, method, n_jobs, distance=distance, max_lag=max_lag, band=band, lb_cutoff=lb_cutoff)
 
     # make a plot of the distance vs number of clusters. Use this to determine
     # the threshold
-    thr = PlotDistanceVsNClusters(DataDirectory, fname_prefix, ln, threshold_level)
+    if plot_distance:
+        PlotDistanceVsNClusters(DataDirectory, fname_prefix, ln, threshold_level)
 
     # compute cluster indices
-    cl = fcluster(ln, thr, criterion = 'distance')
+    cl, thr = CutHierarchy(ln, threshold_level, n_clusters)
+    if prototypes is not None:
+        cl = cl[prototypes]
     print("I've finished! I found {} clusters for you :)".format(cl.max()))
     #print([int(c) for c in cl])
 
     # assign the cluster id to the dataframe
-    for i,src in enumerate(sources):
-        df.loc[df.id==src, 'cluster_id'] = cl[i]
+    df['cluster_id'] = df['id'].map(dict(zip(sources, cl))).astype(float)
 
     # set colour palette: 8 class Set 1 from http://colorbrewer2.org
     N_colors = 8
     #colors = pl.list_of_hex_colours(N_colors, 'Set1')[:cl.max()]
     colors = ['#e41a1c', '#377eb8', '#000000']
+    if cl.max() > len(colors):
+        colors = pl.list_of_hex_colours(max(cl.max(), N_colors), 'Set1')[:cl.max()]
     threshold_color = '#A9A9A9'
     clusters = df['cluster_id'].unique()
 
@@ -462,11 +1096,11 @@ def ClusterProfilesVaryingLength(DataDirectory, OutDirectory, fname_prefix, df,
     plt.savefig(OutDirectory+fname_prefix+"_dendrogram_SO{}.png".format(stream_order), dpi=300)
     #plt.clf()
 
-    df.to_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order), index=False)
+    pio.write_table(df, OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
 
     return df
 
-def ClusterProfilesDrainageArea(DataDirectory, fname_prefix, df, profile_len=100, step=2, method='ward'):
+def ClusterProfilesDrainageArea(DataDirectory, fname_prefix, df, profile_len=100, step=2, method='ward', n_jobs=1):
     """
     Cluster the profiles based on gradient and drainage area.
     Aggolmerative clustering, see here for more info:
@@ -476,6 +1110,7 @@ def ClusterProfilesDrainageArea(DataDirectory, fname_prefix, df, profile_len=100
         df: pandas dataframe from the river profile csv.
         method (str): clustering method to use, see scipy docs. Can be 'single', 'complete', 'average',
         'weighted', 'centroid', 'median', or 'ward'. Default is 'ward'.
+        n_jobs: number of processes for calculating the distance matrix. Default = 1, -1 uses all the cores.
 
     Author: FJC, AR
     """
@@ -494,63 +1129,24 @@ def ClusterProfilesDrainageArea(DataDirectory, fname_prefix, df, profile_len=100
     print (len(reg_areas))
 
     # create matrix for the data
-    data = np.empty((len(sources), len(reg_areas)))
+    data = np.full((len(sources), len(reg_areas)), np.nan)
 
     # now for each profile, find the nearest point on the trunk areas array and assign the slope value to this.
-    for x, src in enumerate(sources):
-        this_df = df[df['id'] == src]
-        reg_slopes = np.empty(len(reg_areas))
-        reg_slopes[:] = np.nan
-
-        #df_array = this_df.values[::-1]
-        slopes = this_df['slope'].values
-        areas = this_df['drainage_area'].values
-        for idx, i in enumerate(areas):
-            #print i
-            idx_j = find_nearest_idx(reg_areas, i)
-            #print ('THIS AREA: ', trunk_areas[idx_j])
-            reg_slopes[idx_j] = slopes[idx]
-        data[x] = reg_slopes
+    rows = pd.factorize(df['id'])[0]
+    cols = find_nearest_indices(reg_areas, all_areas)
+    # if several nodes of a profile go to the same area, the last one wins
+    key = rows*len(reg_areas) + cols
+    _, last = np.unique(key[::-1], return_index=True)
+    last = len(key) - 1 - last
+    data[rows[last], cols[last]] = df['slope'].values[last]
 
     # correlation coefficients
-    cc = np.zeros(int(n * (n - 1) / 2))
-
-    k = 0
-    for i in range(n):
-        for j in range(i+1, n):
-            tsi = data[i]
-            tsj = data[j]
-            new_tsi = []
-            new_tsj = []
-            # print ("LEN OLD SERIES 1:", np.count_nonzero(~np.isnan(tsi)))
-            # print ("LEN OLD SERIES 2:", np.count_nonzero(~np.isnan(tsj)))
-            # remove any areas where there isn't data in both time series
-            for x in range(len(tsi)):
-                if not (np.isnan(tsi[x])) and not (np.isnan(tsj[x])):
-                    new_tsi.append(tsi[x])
-                    new_tsj.append(tsj[x])
-            # print ("LEN AFTER REMOVING NANS", len(new_tsi))
-            #        print "Not a nan"
-            # remove parts of the time series which are identical
-            new_tsi = np.array(new_tsi)
-            new_tsj = np.array(new_tsj)
-            dts = new_tsi - new_tsj
-            l = 0
-            for x in range(len(dts)):
-                if dts[x] == 0:
-                    l += 1
-            new_tsi, new_tsj = new_tsi[:l], new_tsj[:l]
-            #print ("LEN OF UNIQUE SECTION: ", len(new_tsi))
-            # take the log of them to test the correlation effect
-            log_tsi = np.log(new_tsi)
-            log_tsj = np.log(new_tsj)
-            #cc[k] = np.corrcoef(new_tsi, new_tsj)[0, 1]
-            #cc[k] = np.corrcoef(log_tsi, log_tsj)[0, 1]
-            cc[k] = find_difference_between_arrays(new_tsi, new_tsj)
-            k += 1
-
-    # distances
-    dd = np.arccos(cc)
+    cc = CondensedDistances(_drainage_area_rows, data, np.full(n, len(reg_areas)), n_jobs=n_jobs)
+
+    # distances. Pairs with no identical points have no overlap to compare, so
+    # they get the largest possible angle.
+    dd = np.arccos(np.clip(cc, -1, 1))
+    dd[np.isnan(dd)] = np.pi
     #print dd
     #print len(dd)
     # do agglomerative clustering by stepwise pair matching
@@ -559,7 +1155,7 @@ def ClusterProfilesDrainageArea(DataDirectory, fname_prefix, df, profile_len=100
 
     # make a plot of the distance vs number of clusters. Use this to determine
     # the threshold
-    thr = PlotDistanceVsNClusters(ln)
+    thr = PlotDistanceVsNClusters(DataDirectory, fname_prefix, ln)
 
     # define threshold for cluster determination
     #thr = np.arccos(min_corr)
@@ -571,12 +1167,11 @@ def ClusterProfilesDrainageArea(DataDirectory, fname_prefix, df, profile_len=100
     print (len(cl), n)
 
     # assign the cluster id to the dataframe
-    for i,id in enumerate(sources):
-        df.loc[df.id==id, 'cluster_id'] = cl[i]
+    df['cluster_id'] = df['id'].map(dict(zip(sources, cl))).astype(float)
 
     # set colour palette: 8 class Set 1 from http://colorbrewer2.org
     N_colors = 8
-    colors = list_of_hex_colours(N_colors, 'Dark2')[:cl.max()]
+    colors = pl.list_of_hex_colours(max(cl.max(), N_colors), 'Dark2')[:cl.max()]
     threshold_color = '#377eb8'
 
     # now find the order of the cluster ids and assign the colours accordingly
@@ -602,10 +1197,428 @@ def ClusterProfilesDrainageArea(DataDirectory, fname_prefix, df, profile_len=100
     plt.savefig(DataDirectory+fname_prefix+"_upstream_dendrogram.png", dpi=300)
     plt.clf()
 
-    df.to_csv(DataDirectory+args.fname_prefix+'_profiles_upstream_clustered.csv', index=False)
+    pio.write_table(df, DataDirectory+fname_prefix+'_profiles_upstream_clustered.csv')
     return df
 
-def PlotDistanceVsNClusters(DataDirectory, fname_prefix, ln, threshold_level=0):
+def _condensed_index(i, j, n):
+    """
+    Index of the distance between i and j (i != j) in the condensed distance vector.
+    """
+    a = np.minimum(i, j)
+    b = np.maximum(i, j)
+    return n*a - a*(a+1)//2 + (b - a - 1)
+
+def _lance_williams_update(method, d_xi, d_yi, d_xy, size_x, size_y, size_i):
+    """
+    Distance between the cluster made by merging x and y and each other cluster i.
+    These are the same updates as scipy uses for each method.
+    """
+    if method == 'single':
+        return np.minimum(d_xi, d_yi)
+    if method == 'complete':
+        return np.maximum(d_xi, d_yi)
+    if method == 'average':
+        return (size_x*d_xi + size_y*d_yi)/(size_x + size_y)
+    if method == 'weighted':
+        return 0.5*(d_xi + d_yi)
+    # ward
+    t = 1.0/(size_x + size_y + size_i)
+    return np.sqrt((size_i + size_x)*t*d_xi*d_xi + (size_i + size_y)*t*d_yi*d_yi - size_i*t*d_xy*d_xy)
+
+# linkage methods that can be used with the nearest-neighbour chain
+NN_CHAIN_METHODS = ('single', 'complete', 'average', 'weighted', 'ward')
+
+def _check_nn_chain_method(method):
+    """
+    Raise an error if the method can't be used with NNChainLinkage.
+    """
+    if method not in NN_CHAIN_METHODS:
+        raise ValueError("The method '{}' can't be used for clustering large numbers of profiles, use 'single', 'complete', 'average', 'weighted' or 'ward'".format(method))
+
+def NNChainLinkage(dist, n, method='ward'):
+    """
+    Hierarchical clustering with the nearest-neighbour chain algorithm, working
+    in place on the condensed distance vector. Unlike scipy linkage, this doesn't
+    make any copies of the distances, so it works on a float32 or memory-mapped
+    array and the memory needed is just the distance vector itself. The distance
+    vector is overwritten.
+
+    Args:
+        dist: condensed distance vector
+        n (int): number of profiles
+        method (str): 'single', 'complete', 'average', 'weighted' or 'ward'. The
+        'centroid' and 'median' methods can't be used with the nearest-neighbour chain.
+
+    Returns: linkage matrix in the same format as scipy linkage
+    """
+    _check_nn_chain_method(method)
+
+    size = np.ones(n)
+    active = np.arange(n)
+    merges = np.empty((n-1, 4))
+    chain = []
+    for k in range(n-1):
+        if not chain:
+            chain = [active[0]]
+
+        # grow the chain of nearest neighbours until we find a reciprocal pair
+        while True:
+            x = chain[-1]
+            others = active[active != x]
+            row = dist[_condensed_index(x, others, n)]
+            i = np.argmin(row)
+            if len(chain) > 1 and not row[i] < dist[_condensed_index(x, chain[-2], n)]:
+                y = chain[-2]
+                break
+            y = others[i]
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+
+        chain = chain[:-2]
+        x, y = min(x, y), max(x, y)
+        d_xy = dist[_condensed_index(x, y, n)]
+        merges[k] = x, y, d_xy, size[x] + size[y]
+
+        # the new cluster takes the place of y
+        others = active[(active != x) & (active != y)]
+        idx_x = _condensed_index(x, others, n)
+        idx_y = _condensed_index(y, others, n)
+        dist[idx_y] = _lance_williams_update(method, dist[idx_x], dist[idx_y], d_xy, size[x], size[y], size[others])
+        size[y] += size[x]
+        size[x] = 0
+        active = active[active != x]
+
+    return _label_linkage(merges, n)
+
+def _label_linkage(merges, n):
+    """
+    Sort the merges from the nearest-neighbour chain by distance and give each new
+    cluster its id (n, n+1, ...), so the linkage matrix is in the scipy format.
+    """
+    Z = merges[np.argsort(merges[:,2], kind='mergesort')]
+    parent = np.arange(2*n-1)
+    sizes = np.r_[np.ones(n), np.zeros(n-1)]
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # compress the path
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for k in range(n-1):
+        x_root = find(int(Z[k,0]))
+        y_root = find(int(Z[k,1]))
+        Z[k,0], Z[k,1] = min(x_root, y_root), max(x_root, y_root)
+        parent[x_root] = parent[y_root] = n + k
+        sizes[n+k] = sizes[x_root] + sizes[y_root]
+        Z[k,3] = sizes[n+k]
+    return Z
+
+def BuildHierarchy(df, method='ward', n_jobs=1, max_memory=None, mmap_dir=None, distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Build the cluster hierarchy for the profiles. This is the expensive part of
+    the clustering, so do it once and then use CutHierarchy to get the clusters
+    at as many levels as you like.
+
+    The full distance matrix has n*(n-1)/2 entries, so for lots of profiles it
+    might not fit in memory. If you set max_memory we check this first: if the
+    normal scipy clustering (which needs ~16 bytes per pair) doesn't fit, we store
+    the distances as float32 and cluster them in place (4 bytes per pair). If that
+    doesn't fit either, the distances are written to a memory-mapped file in mmap_dir.
+    The padded profiles and the temporary arrays for each block of the distance
+    calculation count towards the limit, so the blocks are made smaller for more
+    processes. The dataframe itself isn't counted, and the 'lag' and 'dtw'
+    distances use up to a few hundred MB more per process for their own chunks.
+
+    Args:
+        df: pandas dataframe with the regularly spaced profiles
+        method (str): clustering method to use, see scipy linkage docs. Default is 'ward'.
+        n_jobs (int): number of processes for calculating the distance matrix. Default = 1.
+        max_memory (float): memory limit for the distance matrix in bytes. Default = None (no limit).
+        mmap_dir (str): directory for the memory-mapped distance matrix if it doesn't fit in
+        memory. Default = None, which means we raise a MemoryError instead.
+        distance (str): 'euclidian', 'lag' or 'dtw', see DistanceKernel. Default = 'euclidian'.
+        max_lag, band, lb_cutoff: options for the 'lag' and 'dtw' distances, see DistanceKernel.
+
+    Returns: linkage matrix, with the profiles in the order of df['id'].unique()
+    """
+    kernel = DistanceKernel(distance, max_lag, band, lb_cutoff)
+    # check the method before doing the expensive part
+    if method not in ('single', 'complete', 'average', 'weighted', 'centroid', 'median', 'ward'):
+        raise ValueError("Unknown clustering method '{}'".format(method))
+    if max_memory is None:
+        cc = ProfileDistances(df, n_jobs, distance, max_lag, band, lb_cutoff)
+        return linkage(cc, method=method)
+
+    data, lengths = ProfilesToPaddedArray(df, 'slope')
+    n = data.shape[0]
+    n_pairs = n * (n - 1) // 2
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = mp.cpu_count()
+    # the padded profiles count towards the limit too, along with the shared
+    # copy of them used by the worker processes, the lengths and the arrays
+    # of length n used by the linkage
+    data_memory = data.nbytes * (2 if n_jobs > 1 else 1) + 64*n
+    n_cols, data_size = data.shape[1], data.size
+
+    def block_kernel(memory):
+        # split the rest of the memory between the workers, which each compute a
+        # block of rows at the same time, and keep half of each worker's share for
+        # the chunks of columns. Returns None if a single row doesn't fit.
+        worker_memory = min(memory, 2**27*n_jobs) / n_jobs
+        block_size = int(worker_memory/2 // max(n*EUCLIDIAN_PAIR_BYTES, 1))
+        if block_size < 1 or worker_memory/2 < _euclidian_chunk_bytes(n_cols):
+            return None, None
+        if distance == 'euclidian':
+            return functools.partial(_average_euclidian_rows, block_memory=worker_memory), block_size
+        # the 'lag' and 'dtw' kernels limit their own memory per chunk
+        return kernel, max(1, int(worker_memory // max(data_size*8, 1)))
+
+    # the normal scipy clustering needs ~16 bytes per pair
+    limited_kernel, block_size = block_kernel(max_memory - 16*n_pairs - data_memory)
+    if limited_kernel is not None:
+        cc = CondensedDistances(limited_kernel, data, lengths, block_size, n_jobs)
+        data = None
+        return linkage(cc, method=method)
+    _check_nn_chain_method(method)
+
+    limited_kernel, block_size = block_kernel(max_memory - 4*n_pairs - data_memory)
+    if limited_kernel is not None:
+        print("The distance matrix for {} profiles is too big for the normal clustering, storing it as float32 ({:.1f} GB)".format(n, 4*n_pairs/1e9))
+        cc = np.empty(n_pairs, dtype=np.float32)
+        CondensedDistances(limited_kernel, data, lengths, block_size, n_jobs, out=cc)
+        data = None
+        return NNChainLinkage(cc, n, method)
+
+    if mmap_dir is None:
+        raise MemoryError("The distance matrix for {} profiles needs {:.1f} GB but the memory limit is {:.1f} GB. "
+                          "Increase the limit, give a directory for a memory-mapped distance matrix, "
+                          "or reduce the number of profiles.".format(n, 4*n_pairs/1e9, max_memory/1e9))
+
+    mmap_kernel, block_size = block_kernel(max_memory - data_memory)
+    if mmap_kernel is None:
+        raise MemoryError("The memory limit of {:.1f} GB is too small to calculate the distances between {} profiles, "
+                          "even with a memory-mapped distance matrix.".format(max_memory/1e9, n))
+    print("The distance matrix for {} profiles needs {:.1f} GB, writing it to a memory-mapped file in {}".format(n, 4*n_pairs/1e9, mmap_dir))
+    with tempfile.NamedTemporaryFile(dir=mmap_dir, suffix='_distances.mmap') as f:
+        cc = np.memmap(f, dtype=np.float32, mode='w+', shape=(n_pairs,))
+        CondensedDistances(mmap_kernel, data, lengths, block_size, n_jobs, out=cc)
+        data = None
+        ln = NNChainLinkage(cc, n, method)
+        del cc
+    return ln
+
+def FindThreshold(ln, threshold_level=0):
+    """
+    Find the distance threshold for cutting the dendrogram. This is where the
+    biggest jump in distance between successive merges is.
+
+    Args:
+        ln: linkage matrix from clustering
+        threshold_level: which level to return the threshold at. 0 = max distance between clusters.
+
+    Returns: the distance threshold
+    """
+    # find the difference in the distances between each point in the linkage array
+    dist = ln[:,2]
+    deltas = np.diff(dist)
+    # get the argmax of the difference
+    i = np.argmax(deltas)
+    # now find the distance threshold corresponding to this
+    return dist[i-threshold_level]
+
+def CutHierarchy(ln, threshold_level=0, n_clusters=None):
+    """
+    Cut the cluster hierarchy to get the cluster of each profile. This is cheap,
+    so it can be done for lots of levels from the same linkage matrix.
+
+    Args:
+        ln: linkage matrix from BuildHierarchy
+        threshold_level: which level to cut at, see FindThreshold. Default = 0.
+        n_clusters: cut to give this number of clusters instead. Default = None.
+
+    Returns: array of the cluster index of each profile, and the distance threshold
+    """
+    thr = CutThreshold(ln, threshold_level, n_clusters)
+    if n_clusters is None:
+        cl = fcluster(ln, thr, criterion = 'distance')
+    else:
+        cl = fcluster(ln, n_clusters, criterion = 'maxclust')
+    return cl, thr
+
+def CutThreshold(ln, threshold_level=0, n_clusters=None):
+    """
+    The distance at which CutHierarchy cuts the cluster hierarchy, without
+    working out the cluster of each profile.
+
+    Args:
+        ln: linkage matrix from BuildHierarchy
+        threshold_level: which level to cut at, see FindThreshold. Default = 0.
+        n_clusters: cut to give this number of clusters instead. Default = None.
+
+    Returns: the distance threshold
+    """
+    if n_clusters is None:
+        return FindThreshold(ln, threshold_level)
+    if not 1 <= n_clusters <= len(ln)+1:
+        raise ValueError("Can't cut the hierarchy of {} profiles into {} clusters".format(len(ln)+1, n_clusters))
+    if n_clusters == len(ln)+1:
+        # every profile is its own cluster, so we don't keep any merges
+        return 0.
+    # the last merge that we keep
+    return ln[-n_clusters, 2]
+
+def FindPrototypes(data, lengths, n_prototypes, n_iter=5, batch_size=100, seed=0, distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Pick a set of prototype profiles using mini-batch k-medoids. Each profile is
+    assigned to its nearest prototype, then each prototype is moved to the member
+    of its group which is closest to the rest of the group. To keep this cheap,
+    the new prototype is chosen from a random sample of at most batch_size members.
+
+    Args:
+        data: padded array of profiles from ProfilesToPaddedArray
+        lengths: number of points in each profile
+        n_prototypes (int): number of prototypes
+        n_iter (int): number of k-medoids iterations. Default = 5.
+        batch_size (int): max number of members used to update each prototype. Default = 100.
+        seed (int): seed for the random number generator. Default = 0.
+        distance (str): 'euclidian', 'lag' or 'dtw', see DistanceKernel. Default = 'euclidian'.
+        max_lag, band, lb_cutoff: options for the 'lag' and 'dtw' distances, see DistanceKernel.
+
+    Returns: array of the row of each prototype, and array of the prototype index of each profile
+    """
+    rng = np.random.RandomState(seed)
+    options = dict(distance=distance, max_lag=max_lag, band=band, lb_cutoff=lb_cutoff)
+    block = DistanceBlock(**options)
+    n = data.shape[0]
+    medoids = np.sort(rng.choice(n, n_prototypes, replace=False))
+
+    for it in range(n_iter):
+        assignment, _ = NearestProfiles(data, lengths, data[medoids], lengths[medoids], **options)
+        # group the profiles by prototype
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(n_prototypes+1))
+        new_medoids = medoids.copy()
+        for p in range(n_prototypes):
+            members = order[bounds[p]:bounds[p+1]]
+            if len(members) == 0:
+                continue
+            if len(members) > batch_size:
+                members = rng.choice(members, batch_size, replace=False)
+            d = block(data[members], lengths[members], data[members], lengths[members])
+            new_medoids[p] = members[np.argmin(d.sum(axis=1))]
+        n_moved = np.count_nonzero(new_medoids != medoids)
+        print("k-medoids iteration {}: {} prototypes moved".format(it+1, n_moved))
+        medoids = new_medoids
+        if n_moved == 0:
+            break
+
+    assignment, _ = NearestProfiles(data, lengths, data[medoids], lengths[medoids], **options)
+    return medoids, assignment
+
+def BuildApproximateHierarchy(df, method='ward', n_prototypes=2000, n_iter=5, batch_size=100, seed=0, n_jobs=1, distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Approximate version of BuildHierarchy for very large numbers of profiles.
+    First the profiles are grouped around n_prototypes prototypes with
+    mini-batch k-medoids (see FindPrototypes), then the hierarchy is built on the
+    prototypes only. Each profile gets the cluster of its prototype when the
+    hierarchy is cut (see the prototypes argument of ClusterProfilesVaryingLength).
+    The cost grows with n*n_prototypes rather than n**2. Use BuildSampleHierarchy and
+    SampleAgreement to check how close the clusters are to the exact ones.
+    The same distance is used for the k-medoids and for the hierarchy. There is
+    no memory limit as in BuildHierarchy, since the distance matrix only has
+    n_prototypes**2/2 entries.
+
+    Args:
+        df: pandas dataframe with the regularly spaced profiles
+        method (str): clustering method to use, see scipy linkage docs. Default is 'ward'.
+        n_prototypes (int): number of prototypes. Default = 2000.
+        n_iter, batch_size, seed: see FindPrototypes
+        n_jobs (int): number of processes for calculating the distances between prototypes. Default = 1.
+        distance (str): 'euclidian', 'lag' or 'dtw', see DistanceKernel. Default = 'euclidian'.
+        max_lag, band, lb_cutoff: options for the 'lag' and 'dtw' distances, see DistanceKernel.
+
+    Returns: linkage matrix of the prototypes, and array of the prototype index of
+    each profile, in the order of df['id'].unique()
+    """
+    kernel = DistanceKernel(distance, max_lag, band, lb_cutoff)
+    data, lengths = ProfilesToPaddedArray(df, 'slope')
+    n = data.shape[0]
+    if n_prototypes >= n:
+        print("There are only {} profiles, so I'm using the exact clustering".format(n))
+        return linkage(CondensedDistances(kernel, data, lengths, n_jobs=n_jobs), method=method), np.arange(n)
+
+    print("Grouping {} profiles around {} prototypes".format(n, n_prototypes))
+    medoids, assignment = FindPrototypes(data, lengths, n_prototypes, n_iter, batch_size, seed, distance, max_lag, band, lb_cutoff)
+    cc = CondensedDistances(kernel, data[medoids], lengths[medoids], n_jobs=n_jobs)
+    return linkage(cc, method=method), assignment
+
+def AdjustedRandIndex(labels_a, labels_b):
+    """
+    Adjusted Rand index between two sets of cluster labels: 1 if the clusters are
+    the same, ~0 for random labels.
+    """
+    _, a = np.unique(labels_a, return_inverse=True)
+    _, b = np.unique(labels_b, return_inverse=True)
+    table = np.zeros((a.max()+1, b.max()+1))
+    np.add.at(table, (a, b), 1)
+    pairs = lambda x: x*(x-1)/2
+    sum_ab = pairs(table).sum()
+    sum_a = pairs(table.sum(axis=1)).sum()
+    sum_b = pairs(table.sum(axis=0)).sum()
+    expected = sum_a*sum_b/pairs(len(a))
+    max_index = (sum_a+sum_b)/2
+    if max_index == expected:
+        return 1.0
+    return (sum_ab-expected)/(max_index-expected)
+
+def BuildSampleHierarchy(df, method='ward', n_sample=1000, seed=0, distance='euclidian', max_lag=200, band=10, lb_cutoff=None):
+    """
+    Build the exact cluster hierarchy of a random sample of the profiles, to check
+    the approximate clustering with SampleAgreement. This only depends on the
+    profiles, so build it once and use it for every cut of the approximate hierarchy.
+
+    Args:
+        df: pandas dataframe with the regularly spaced profiles
+        method (str): clustering method to use. Default is 'ward'.
+        n_sample (int): number of profiles in the sample. Default = 1000.
+        seed (int): seed for the random number generator. Default = 0.
+        distance (str): 'euclidian', 'lag' or 'dtw', see DistanceKernel. Use the same distance
+        as for the approximate clustering. Default = 'euclidian'.
+        max_lag, band, lb_cutoff: options for the 'lag' and 'dtw' distances, see DistanceKernel.
+
+    Returns: array of the index of each sampled profile in df['id'].unique(), and the
+    linkage matrix of the sample
+    """
+    sources = df['id'].unique()
+    sample = np.sort(np.random.RandomState(seed).choice(len(sources), min(n_sample, len(sources)), replace=False))
+    sample_df = df[df['id'].isin(sources[sample])]
+    return sample, BuildHierarchy(sample_df, method, distance=distance, max_lag=max_lag, band=band, lb_cutoff=lb_cutoff)
+
+def SampleAgreement(labels, sample, sample_ln):
+    """
+    Check the approximate clustering against the exact clustering for a random
+    sample of the profiles. The exact hierarchy of the sample is cut into the same
+    number of clusters as the approximate labels have in the sample.
+
+    Args:
+        labels: cluster of each profile from the approximate clustering, in the order of df['id'].unique()
+        sample: index of each sampled profile, from BuildSampleHierarchy
+        sample_ln: linkage matrix of the sample, from BuildSampleHierarchy
+
+    Returns: adjusted Rand index between the approximate and exact clusters
+    """
+    approx = np.asarray(labels)[sample]
+    exact = fcluster(sample_ln, len(np.unique(approx)), criterion='maxclust')
+    ari = AdjustedRandIndex(approx, exact)
+    print("Agreement with the exact clustering for a sample of {} profiles: adjusted Rand index = {:.3f}".format(len(sample), ari))
+    return ari
+
+def PlotDistanceVsNClusters(DataDirectory, fname_prefix, ln, threshold_level=0, cuts=None):
     """
     Make a plot of the distance between each cluster compared to the
     number of clusters. Maybe use this to determine where to put the distance
@@ -614,34 +1627,36 @@ def PlotDistanceVsNClusters(DataDirectory, fname_prefix, ln, threshold_level=0):
     Args:
         ln: linkage matrix from clustering
         threshold_level: which level to return the threshold at. 0 = max distance between clusters.
+        cuts: list of (label, threshold_level, n_clusters) for each cut of the hierarchy, see
+        CutHierarchy. Each cut is marked on the plot. Default = None.
 
     Author: FJC
     """
     # set up a figure
     fig = plt.figure(1, facecolor='white')
+    # figure 1 might still have the profiles on it
+    fig.clf()
     gs = plt.GridSpec(100,100,bottom=0.15,left=0.1,right=0.9,top=0.9)
     ax = fig.add_subplot(gs[5:100,10:95])
 
-    #print ln
     # each iteration merges one cluster. so we start with n_clusters = n samples,
-    # and then it reduces by one each time.
-    clusters = []
-    n_clusters = len(ln)+1
-    for l in ln:
-        # the distance is the 3rd column.
-        this_dist = l[2]
-        ax.scatter(n_clusters, this_dist, c='k')
-        clusters.append(n_clusters)
-        n_clusters -= 1
-
-    # find the difference in the distances between each point in the linkage array
-    dist = ln[:,2]
-    deltas = [j-i for i, j in zip(dist[:-1], dist[1:])]
-    # get the argmax of the difference
-    i = np.argmax(deltas)
-    n_clusters = clusters[i-threshold_level]
-    # now find the distance threshold corresponding to this
-    thr = dist[i-threshold_level]
+    # and then it reduces by one each time. the distance is the 3rd column.
+    clusters = np.arange(len(ln)+1, 1, -1)
+    ax.scatter(clusters, ln[:,2], c='k')
+
+    if cuts:
+        colors = pl.list_of_hex_colours(max(len(cuts), 3), 'Set1')
+        for (label, level, n_clusters), colour in zip(cuts, colors):
+            cut_thr = CutThreshold(ln, level, n_clusters)
+            # the number of clusters left after the merges below the threshold
+            n_left = len(ln) + 1 - np.count_nonzero(ln[:,2] <= cut_thr)
+            ax.axhline(y=cut_thr, color=colour, ls='--', zorder=1)
+            if n_clusters is None:
+                label = '{}: {} clusters'.format(label, n_left)
+            ax.scatter(n_left, cut_thr, s=80, facecolors='none', edgecolors=colour, zorder=3, label=label)
+        ax.legend(loc='upper right', fontsize=8)
+
+    thr = FindThreshold(ln, threshold_level)
     print ('The optimum distance threshold is '+str(thr))
     # now save the figure
     plt.xlabel('Number of clusters')
@@ -653,6 +1668,65 @@ def PlotDistanceVsNClusters(DataDirectory, fname_prefix, ln, threshold_level=0):
     return thr
 
 
+def RollingWindowSlope(ids, x, y, slope_window_size):
+    """
+    Least squares slope of y against x over a moving window of nodes for each
+    profile. The window is truncated at the ends of each profile, so we use
+    whatever nodes are available. The nodes are sorted by id (keeping their
+    order within each profile) and the windows of a block of nodes are gathered
+    into a 2d array, so there is no regression per node. Each window is centred
+    on its own mean before the sums are taken, so the slopes don't lose precision
+    on long profiles.
+
+    Args:
+        ids: array with the source id of each node
+        x: array of distances
+        y: array of elevations
+        slope_window_size (int): total number of points used to calculate
+        slope (INCLUDES the node of interest)
+
+    Returns: array of absolute slopes in the same order as the input
+    """
+    ids = np.asarray(ids)
+    n = len(ids)
+    order = np.argsort(ids, kind='stable')
+    s_ids = ids[order]
+    xs = np.asarray(x, dtype=float)[order]
+    ys = np.asarray(y, dtype=float)[order]
+
+    # find where each profile starts and the position of each node along it
+    new_group = np.r_[True, s_ids[1:] != s_ids[:-1]]
+    group_start = np.flatnonzero(new_group)
+    group_len = np.diff(np.r_[group_start, n])
+    group = np.cumsum(new_group) - 1
+    starts = group_start[group]
+    pos = np.arange(n) - starts
+
+    # window limits, same as slicing [index-slicer, index+slicer+1)
+    slicer = (slope_window_size - 1)/2
+    lo = np.maximum(pos - slicer, 0).astype(int)
+    hi = np.minimum(pos + slicer + 1, group_len[group]).astype(int)
+    npts = hi - lo
+
+    # gather the windows for blocks of nodes, padding the short windows at the
+    # ends of the profiles with their first node and masking it out
+    offsets = np.arange(npts.max() if n else 0)
+    block_size = max(1, 2**20 // max(len(offsets), 1))
+    sorted_slopes = np.empty(n)
+    for b in range(0, n, block_size):
+        first = (starts + lo)[b:b+block_size]
+        k = npts[b:b+block_size]
+        valid = offsets < k[:, None]
+        idx = np.where(valid, first[:, None] + offsets, first[:, None])
+        wx = xs[idx]
+        wy = ys[idx]
+        dx = np.where(valid, wx - (np.where(valid, wx, 0.).sum(axis=1)/k)[:, None], 0.)
+        dy = np.where(valid, wy - (np.where(valid, wy, 0.).sum(axis=1)/k)[:, None], 0.)
+        sorted_slopes[b:b+block_size] = (dx*dy).sum(axis=1)/(dx*dx).sum(axis=1)
+    slopes = np.empty(n)
+    slopes[order] = np.abs(sorted_slopes)
+    return slopes
+
 def CalculateSlope(DataDirectory, fname_prefix, df, slope_window_size):
     """
     This function takes in a dataframe with elevation and distance
@@ -675,37 +1749,11 @@ def CalculateSlope(DataDirectory, fname_prefix, df, slope_window_size):
     gs = plt.GridSpec(100,100,bottom=0.15,left=0.1,right=0.9,top=0.9)
     ax = fig.add_subplot(gs[5:100,10:95])
 
-    # get all unique source IDs from the dataframe
-    ids = df['id'].unique()
-    for id in ids:
-        dist = df['distance_from_outlet'][df['id'] == id]
-        elev = df['elevation'][df['id'] == id]
-        slopes = np.empty(len(dist))
-
-        pts_array = np.column_stack((dist,elev))
-
-        slicer = (slope_window_size - 1)/2
-
-        for index, x in enumerate(pts_array):
-            start_idx = index-slicer
-            if start_idx < 0:
-                start_idx=0
-            end_idx = index+slicer+1
-            if end_idx > len(pts_array):
-                end_idx = len(pts_array)
-            # find the rows above and below relating to the window size. We use whatever nodes
-            # are available to not waste the data.
-            this_slice = pts_array[int(start_idx):int(end_idx)]
-            # now regress this slice
-            x = this_slice[:,0]
-            y = this_slice[:,1]
-            #print x, y
-            slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
-            slopes[index] = abs(slope)
-            #print slope
-
-        df.loc[df.id==id, 'slope'] = slopes
-        ax.plot(dist, slopes, lw=1)
+    # get the slope for every node at once
+    df['slope'] = RollingWindowSlope(df['id'].values, df['distance_from_outlet'].values, df['elevation'].values, slope_window_size)
+
+    # plot each profile
+    pl.plot_profile_lines(ax, df['id'].values, df['distance_from_outlet'].values, df['slope'].values, lw=1)
 
     # now save the figure
     ax.set_xlabel('Distance from outlet (m)')
@@ -717,6 +1765,63 @@ def CalculateSlope(DataDirectory, fname_prefix, df, slope_window_size):
 
     return df
 
+def StreamSlopes(tribs_file, slope_file, slope_window_size, chunksize=1000000):
+    """
+    Version of CalculateSlope for river networks that are too big to load at once.
+    The tributaries file is read in chunks of whole profiles, and the slopes
+    for each chunk are appended to the slopes file, so we only ever hold one
+    chunk in memory. We don't make the plot of the slopes here.
+
+    Args:
+        tribs_file (str): path of the _all_tribs table
+        slope_file (str): path to write the slopes table to
+        slope_window_size (int): total number of points used to calculate
+        slope (INCLUDES the node of interest)
+        chunksize (int): number of rows to read at once. Default = 1000000.
+
+    Returns: the path of the slopes table
+    """
+    with pio.TableWriter(slope_file) as writer:
+        for chunk in pio.read_table_chunks(tribs_file, chunksize):
+            chunk['slope'] = RollingWindowSlope(chunk['id'].values, chunk['distance_from_outlet'].values, chunk['elevation'].values, slope_window_size)
+            writer.write(chunk)
+    print("Got the slope over a window radius of {} m".format(slope_window_size))
+    return writer.path
+
+def StreamProfilesByStreamOrder(DataDirectory, fname_prefix, slope_file, step=2, stream_order=1, profile_len=5, chunksize=1000000):
+    """
+    Version of GetProfilesByStreamOrder (followed by RemoveProfilesShorterThanThresholdLength)
+    for slopes tables that are too big to load at once. Each chunk of whole profiles
+    is resampled on its own, and only the resampled profiles are kept. This only
+    works for first order streams, as the higher orders need to look at all the
+    profiles at once to find the longest channels.
+
+    Args:
+        slope_file (str): path of the slopes table
+        step (int): the spacing in metres between the resampled points. Default = 2
+        stream_order (int): must be 1
+        profile_len (int): the minimum number of resampled points to keep a profile. Default = 5.
+        chunksize (int): number of rows to read at once. Default = 1000000.
+
+    Returns: dataframe with the resampled profiles
+    """
+    if stream_order != 1:
+        raise ValueError("The profiles can only be streamed for first order streams")
+    print("Assigning the profiles a common distance step of {} m".format(step))
+    profiles = []
+    # write all the resampled profiles to output in case we want to reload, the same
+    # as GetProfilesByStreamOrder, but only keep the ones that are long enough
+    with pio.TableWriter(DataDirectory+fname_prefix+'_profiles_SO{}.csv'.format(stream_order)) as writer:
+        for chunk in pio.read_table_chunks(slope_file, chunksize):
+            so_df = chunk[chunk['stream_order'] == stream_order]
+            if so_df.empty:
+                continue
+            distances = so_df.groupby('id')['distance_from_outlet'].transform('max') - so_df['distance_from_outlet']
+            thinned_df = ResampleProfiles(so_df, distances.values, step)
+            writer.write(thinned_df)
+            profiles.append(RemoveProfilesShorterThanThresholdLength(thinned_df, profile_len))
+    return pd.concat(profiles, ignore_index=True)
+
 def RemoveProfilesShorterThanThresholdLength(df, profile_len=5):
     """
     Remove any profiles that are shorter than a threshold length.
@@ -732,44 +1837,66 @@ def RemoveProfilesWithShortUniqueSection(df, threshold_len=4):
     shorter than a threshold length.
     """
     print ("Removing short unique profiles, the threshold length is: "+str(threshold_len))
-    all_nodes = df['node'].tolist()
     sources = df['id'].unique()
-    unique_sources = []
-    for src in sources:
-        this_df = df[df['id'] == src]
-        these_nodes = this_df['node'].tolist()
-        # check if each node is in the all nodes dataframe twice.
-        # if it is then it is a duplicate.
-        unique_nodes = 0
-        for node in these_nodes:
-            count = all_nodes.count(node)
-            #print count
-            if count < 2:
-                unique_nodes += 1
-        #print unique_nodes
-        if unique_nodes > threshold_len:
-            unique_sources.append(src)
+    # check if each node is in the dataframe twice.
+    # if it is then it is a duplicate.
+    counts = df['node'].map(df['node'].value_counts())
+    unique_nodes = (counts < 2).groupby(df['id']).sum()
+    unique_sources = unique_nodes.index[unique_nodes > threshold_len]
 
     print ('Number of new sources: '+str(len(unique_sources)), 'number of old sources: '+str(len(sources)))
     df_new = df[df['id'].isin(unique_sources)]
     return df_new
 
+def FindNonUniqueProfiles(df):
+    """
+    Find the profiles which are non-unique, i.e. they share a node with a profile
+    that comes before them in the dataframe. Each node is owned by the first
+    profile that contains it, and any other profile with that node is a duplicate.
+    This is done with one pass over the sorted nodes, rather than comparing every
+    pair of profiles.
+
+    Args:
+        df: pandas dataframe with the river profiles
+
+    Returns:
+        duplicate_sources: array of the ids of the non-unique profiles
+        owners: dataframe of the nodes that are shared between profiles, with the
+        id of the profile that owns each one and the number of profiles it is in
+    """
+    codes, sources = pd.factorize(df['id'])
+    nodes = df['node'].values
+
+    # sort by node, then by profile order, so the owner is the first of each run
+    order = np.lexsort((codes, nodes))
+    sorted_nodes = nodes[order]
+    sorted_codes = codes[order]
+    run_start = np.flatnonzero(np.r_[True, sorted_nodes[1:] != sorted_nodes[:-1]])
+    run = np.repeat(np.arange(len(run_start)), np.diff(np.r_[run_start, len(order)]))
+    owner = sorted_codes[run_start]
+
+    # any profile that contains a node owned by another profile is a duplicate
+    not_owner = sorted_codes != owner[run]
+    duplicate_sources = sources[np.unique(sorted_codes[not_owner])]
+
+    # get the shared nodes and their owners
+    shared = np.unique(run[not_owner])
+    # count the number of different profiles in each run
+    new_code = np.r_[True, (sorted_codes[1:] != sorted_codes[:-1]) | (run[1:] != run[:-1])]
+    n_sources = np.bincount(run[new_code], minlength=len(run_start))
+    owners = pd.DataFrame({'node': sorted_nodes[run_start[shared]],
+                           'owner_id': sources[owner[shared]],
+                           'n_sources': n_sources[shared]})
+
+    return np.asarray(duplicate_sources), owners
+
 def RemoveNonUniqueProfiles(df):
     """
     From the regularly spaced distance dataframe, remove any profiles
     which are non-unique (e.g., they have the same nodes as another
     profile).
     """
-    duplicate_sources = []
-    # get a list of the sources
-    sources = df['id'].unique()
-    n = len(sources)
-    for i in range(n):
-        for j in range(i+1, n):
-            df1 = df[df.id == sources[i]].node.tolist()
-            df2 = df[df.id == sources[j]].node.tolist()
-            if not set(df1).isdisjoint(df2):
-                duplicate_sources.append(sources[j])
+    duplicate_sources, _ = FindNonUniqueProfiles(df)
 
     df_new = df[~df['id'].isin(duplicate_sources)]
     return df_new
@@ -780,7 +1907,7 @@ def PrintJunctionsToCSV(DataDirectory, fname_prefix, stream_order=1):
     print a list of the downstream junction of the channels in each cluster
     for extracting the catchments using lsdtopotools
     """
-    df = pd.read_csv(DataDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+    df = pio.read_table(DataDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
     clusters = df.cluster_id.unique()
 
     for cl in clusters:
@@ -2,11 +2,14 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import matplotlib as mpl
-import matplotlib.cm as cm
+import multiprocessing as mp
 import matplotlib.colors as mcolors
 from matplotlib import rcParams
+from matplotlib.collections import LineCollection
+from matplotlib import scale, transforms
 from scipy import stats
 import statsmodels.api as sm
+import profile_io as pio
 
 # Set up fonts for plots
 label_size = 12
@@ -24,7 +27,7 @@ def list_of_hex_colours(N, base_cmap):
 
         Author: FJC
     """
-    cmap = cm.get_cmap(base_cmap, N)
+    cmap = plt.get_cmap(base_cmap, N)
 
     hex_codes = []
     for i in range(cmap.N):
@@ -32,6 +35,139 @@ def list_of_hex_colours(N, base_cmap):
         hex_codes.append(mcolors.rgb2hex(rgb))
     return hex_codes
 
+def plot_profile_lines(ax, ids, x, y, color=None, **kwargs):
+    """
+    Plot a line for every profile as a single LineCollection, which is much quicker
+    to draw and save than calling ax.plot for each profile. The rows of each profile
+    must be next to each other, as they are in the profile tables.
+
+    Args:
+        ax: the axes to plot on
+        ids: array of the profile id of each point
+        x: array of x values
+        y: array of y values
+        color: colour for all the profiles, or a list with one for each profile. Default = None,
+        which uses the colour cycle like ax.plot would
+        kwargs: any other properties of the lines, e.g. lw
+
+    Returns: the LineCollection
+    """
+    ids = np.asarray(ids)
+    # start a new line wherever the id changes
+    splits = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    segments = np.split(np.column_stack((np.asarray(x, dtype=float), np.asarray(y, dtype=float))), splits) if ids.size else []
+    if color is None:
+        cycle = rcParams['axes.prop_cycle'].by_key()['color']
+        color = [cycle[i % len(cycle)] for i in range(len(segments))]
+    lines = LineCollection(segments, colors=color, **kwargs)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+    return lines
+
+def plot_density(ax, x, y, colour, gridsize=(400, 300), zorder=2):
+    """
+    Draw a 2-D density image of points on log-log axes, rather than a scatter plot.
+    The points are counted in a grid of log-spaced cells, so the time to draw the
+    figure and the size of the file don't depend on the number of points. The
+    opacity of each cell increases with the log of the number of points in it.
+    The axis limits are set to the extent of the points.
+
+    Args:
+        ax: the axes to plot on. Set them to log scale as usual.
+        x: x values of the points
+        y: y values of the points
+        colour: colour of the points
+        gridsize: number of cells in x and y. Default = (400, 300)
+        zorder: zorder of the image. Default = 2
+
+    Returns: the image
+    """
+    nx, ny = gridsize
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # we can only show positive values on log axes
+    keep = (x > 0) & (y > 0) & np.isfinite(x) & np.isfinite(y)
+    if not keep.any():
+        return None
+    lx = np.log10(x[keep])
+    ly = np.log10(y[keep])
+
+    # the extent of the grid in log space
+    extent = []
+    for values in (lx, ly):
+        lo, hi = values.min(), values.max()
+        if lo == hi:
+            lo, hi = lo - 0.5, hi + 0.5
+        extent += [lo, hi]
+    x0, x1, y0, y1 = extent
+
+    # count the points in each cell
+    ix = np.minimum(((lx - x0) / (x1 - x0) * nx).astype(int), nx-1)
+    iy = np.minimum(((ly - y0) / (y1 - y0) * ny).astype(int), ny-1)
+    counts = np.bincount(iy*nx + ix, minlength=ny*nx)
+    filled = counts > 0
+    rgba = np.zeros((ny*nx, 4))
+    rgba[filled, :3] = mcolors.to_rgb(colour)
+    rgba[filled, 3] = 0.25 + 0.75 * np.log1p(counts[filled]) / np.log1p(counts.max())
+
+    # the cells are evenly spaced in log space, so the image is placed with its
+    # extent in data coordinates and mapped linearly onto the log space extent,
+    # then back to the data coordinates of the log axes
+    data_extent = (10**x0, 10**x1, 10**y0, 10**y1)
+    to_log = transforms.Affine2D().translate(-data_extent[0], -data_extent[2]) \
+        .scale((x1 - x0) / (data_extent[1] - data_extent[0]), (y1 - y0) / (data_extent[3] - data_extent[2])) \
+        .translate(x0, y0)
+    to_data = transforms.blended_transform_factory(scale.InvertedLogTransform(10), scale.InvertedLogTransform(10))
+    image = ax.imshow(rgba.reshape(ny, nx, 4), extent=data_extent, origin='lower', aspect='auto',
+                      interpolation='nearest', zorder=zorder, transform=to_log + to_data + ax.transData)
+    ax.set_xlim(data_extent[0], data_extent[1])
+    ax.set_ylim(data_extent[2], data_extent[3])
+    return image
+
+def assign_clusters_to_network(df, cluster_df, remove_conflicts=True):
+    """
+    Add the cluster ID of each source to the rows of a dataframe of the full
+    channel network (e.g. the slopes), using the id column. Rows from sources
+    that weren't clustered get a cluster ID of NaN.
+
+    Args:
+        df: dataframe of the channel network with id and node columns
+        cluster_df: dataframe of the clustered profiles with id and cluster_id columns
+        remove_conflicts (bool): if True, remove any nodes which are assigned to more than
+        one cluster, e.g. where tributaries from different clusters share the same channel.
+
+    Returns: the dataframe with the cluster_id column
+    """
+    source_clusters = cluster_df.drop_duplicates('id')[['id', 'cluster_id']]
+    df = df.drop(columns='cluster_id', errors='ignore').merge(source_clusters, on='id', how='left')
+    if remove_conflicts:
+        # keep nodes with exactly one cluster
+        n_clusters = df.groupby('node')['cluster_id'].transform('nunique')
+        df = df[n_clusters.values == 1]
+    return df
+
+def cluster_profile_summary(df):
+    """
+    Get the median and interquartile range of the gradient at each regular distance
+    for each cluster, from the dataframe of clustered profiles. This is done in one
+    grouped pass rather than filtering the dataframe for each distance.
+
+    Args:
+        df: dataframe of the clustered profiles
+
+    Returns: dataframe with the cluster_id, colour, reg_dist, the median, lower and
+    upper quartile of the slope, and the number of nodes at each distance in each cluster
+    """
+    grouped = df.groupby(['cluster_id', 'reg_dist'], observed=True, sort=True)['slope']
+    summary = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    summary.columns = ['lower_quantile', 'median_slope', 'upper_quantile']
+    summary['n_nodes'] = grouped.size()
+    summary = summary.reset_index()
+    # the colour of each cluster
+    colours = df.groupby('cluster_id', observed=True)['colour'].first()
+    summary.insert(1, 'colour', summary['cluster_id'].map(colours).astype(str))
+    return summary
+
 def lower_p(x):
     """
     Calculate IQR of x
@@ -46,6 +182,77 @@ def upper_p(x):
     upper_p = np.percentile(x, 75)
     return upper_p
 
+def binned_statistics(x, y, bins=20, percentiles=(25, 75)):
+    """
+    Bin y by the values of x and get the median, percentiles, median absolute deviation
+    and count of y in each bin. The data are binned and sorted once and all the statistics
+    are found from the sorted array, so this is much quicker than calling
+    stats.binned_statistic for each statistic. The bins and percentiles are the same
+    as stats.binned_statistic and np.percentile. Points where x or y isn't finite (e.g.
+    the log of a slope of zero, or gaps in the data) are left out, but the y values
+    that aren't finite don't change the range of the bins.
+
+    Args:
+        x: array of values to bin by
+        y: array of values to get the statistics of
+        bins: number of equal width bins between the min and max of x, or array of bin edges. Default = 20
+        percentiles: list of percentiles to calculate. Default = (25, 75)
+
+    Returns: arrays of the medians, percentiles (one row for each percentile), median absolute
+    deviations and counts in each bin, and the bin edges. Empty bins have a NaN median.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x)
+    x, y = x[finite], y[finite]
+    if np.ndim(bins) == 0:
+        lo, hi = (x.min(), x.max()) if x.size else (0., 1.)
+        if lo == hi:
+            lo, hi = lo - 0.5, hi + 0.5
+        bin_edges = np.linspace(lo, hi, int(bins)+1)
+    else:
+        bin_edges = np.asarray(bins, dtype=float)
+    nbins = len(bin_edges) - 1
+    finite = np.isfinite(y)
+    x, y = x[finite], y[finite]
+
+    # find the bin of each point. The last bin includes its right edge.
+    bin_idx = np.searchsorted(bin_edges, x, side='right') - 1
+    bin_idx[x == bin_edges[-1]] = nbins - 1
+    inside = (bin_idx >= 0) & (bin_idx < nbins)
+    bin_idx, y = bin_idx[inside], y[inside]
+
+    # sort by bin then value, so each bin is a sorted run of y
+    order = np.lexsort((y, bin_idx))
+    sorted_y = y[order]
+    counts = np.bincount(bin_idx, minlength=nbins)
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    empty = counts == 0
+
+    def run_percentile(values, q):
+        # linear interpolation between the closest ranks, as in np.percentile
+        pos = (np.maximum(counts, 1) - 1) * (q / 100.)
+        below = np.floor(pos).astype(int)
+        above = np.minimum(below + 1, np.maximum(counts, 1) - 1)
+        frac = pos - below
+        if values.size == 0:
+            return np.full(nbins, np.nan)
+        v_below = values[np.minimum(starts + below, values.size - 1)]
+        v_above = values[np.minimum(starts + above, values.size - 1)]
+        result = v_below + frac * (v_above - v_below)
+        result[empty] = np.nan
+        return result
+
+    medians = run_percentile(sorted_y, 50)
+    per = np.asarray([run_percentile(sorted_y, q) for q in percentiles])
+
+    # median absolute deviation from the median of each bin
+    dev = np.abs(y - medians[bin_idx]) if y.size else y
+    sorted_dev = dev[np.lexsort((dev, bin_idx))]
+    mad = run_percentile(sorted_dev, 50)
+
+    return medians, per, mad, counts, bin_edges
+
 def bin_slope_area_data(slope, area, nbins=20):
     """
     Perform log binning on the slope-area data
@@ -58,15 +265,11 @@ def bin_slope_area_data(slope, area, nbins=20):
     log_slope = np.log10(slope)
     log_area = np.log10(area)
 
-    # do log binning
-    bin_meds, bin_edges, binnumber = stats.binned_statistic(log_area, log_slope, bins=nbins, statistic='median')
+    # do log binning and get the median and IQR
+    bin_meds, (lower_per, upper_per), _, _, bin_edges = binned_statistics(log_area, log_slope, bins=nbins, percentiles=(25, 75))
     bin_width = (bin_edges[1] - bin_edges[0])
     bin_centres = bin_edges[1:] - bin_width/2
 
-    # get the IQR
-    lower_per, bin_edges, binnumber = stats.binned_statistic(log_area, log_slope, bins=nbins, statistic=lower_p)
-    upper_per, bin_edges, binnumber = stats.binned_statistic(log_area, log_slope, bins=nbins, statistic=upper_p)
-
     return bin_meds, lower_per, upper_per, bin_centres, bin_edges
 
 def switch_colours(DataDirectory, fname_prefix, stream_order=1):
@@ -74,29 +277,74 @@ def switch_colours(DataDirectory, fname_prefix, stream_order=1):
     Function to switch the colours for a two cluster situation in case
     the plotting was messed up
     """
-    df = pd.read_csv(DataDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
-    clusters = df.cluster_id.unique()
+    df = pio.read_table(DataDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
     colours = df.colour.unique()
 
     #check if there are two
     if len(colours) == 2:
-        df.loc[df.cluster_id == clusters[0], 'colour'] = colours[1]
-        df.loc[df.cluster_id == clusters[1], 'colour'] = colours[0]
+        df['colour'] = df['colour'].map({colours[0]: colours[1], colours[1]: colours[0]})
+
+    pio.write_table(df, DataDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+
+def _init_plot_worker():
+    """
+    Each plotting process draws straight to files, so make sure it doesn't try
+    to open a window.
+    """
+    plt.switch_backend('Agg')
+
+def _run_plot_job(job):
+    """
+    Make one figure. The job is (function, args, kwargs).
+    """
+    func, args, kwargs = job
+    func(*args, **kwargs)
+    plt.close('all')
+    return func.__name__
 
-    df.to_csv(DataDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+def RunPlotJobs(jobs, n_jobs=1):
+    """
+    Make a set of figures that don't depend on each other, either one after
+    the other or in a pool of processes.
+
+    Args:
+        jobs: list of (function, args, kwargs) for each figure. The functions
+        need to be defined at the top level of a module so they can be sent to the pool.
+        n_jobs (int): max number of processes to use. Default = 1 (no pool). Set to
+        -1 to use all the cores.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = mp.cpu_count()
+    n_jobs = min(n_jobs, len(jobs))
+    # close the figures that are still open (e.g. the dendrogram), so they aren't
+    # drawn on by the jobs or copied into each forked process
+    plt.close('all')
+    if n_jobs <= 1:
+        for job in jobs:
+            _run_plot_job(job)
+        return
+
+    print("Making {} figures with {} processes".format(len(jobs), n_jobs))
+    with mp.Pool(n_jobs, initializer=_init_plot_worker) as pool:
+        for name in pool.imap_unordered(_run_plot_job, jobs):
+            print("Finished {}".format(name))
 
 #---------------------------------------------------------------------#
 # PLOTTING FUNCTIONS
 #---------------------------------------------------------------------#
-def PlotProfilesByCluster(DataDirectory, OutDirectory, fname_prefix, stream_order=1):
+def PlotProfilesByCluster(DataDirectory, OutDirectory, fname_prefix, stream_order=1, cluster_df=None):
     """
     Function to make plots of the river profiles in each cluster
 
+    Args:
+        cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
+
     Author: FJC
     """
     print("Making plots of the river profiles in each cluster")
 
-    cluster_df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+    if cluster_df is None:
+        cluster_df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order), columns=['id', 'reg_dist', 'slope', 'cluster_id', 'colour'])
     clusters = cluster_df['cluster_id'].unique()
 
     # set up a figure
@@ -110,12 +358,9 @@ def PlotProfilesByCluster(DataDirectory, OutDirectory, fname_prefix, stream_orde
         this_colour = str(this_df.colour.unique()[0])
         sources = this_df['id'].unique()
         if (len(sources) > 1):
-            for idx, src in enumerate(sources):
-                src_df = this_df[this_df['id'] == src]
-                src_df = src_df[src_df['slope'] != np.nan]
-                ax[i].plot(src_df['reg_dist'].values, src_df['slope'].values, lw=1, color=this_colour)
-                # save the colour to the cluster dataframe for later plots
-                #cluster_df.loc[cluster_df.cluster_id==cl, 'colour'] = colors[counter]
+            plot_profile_lines(ax[i], this_df['id'].values, this_df['reg_dist'].values, this_df['slope'].values, lw=1, color=this_colour)
+            # save the colour to the cluster dataframe for later plots
+            #cluster_df.loc[cluster_df.cluster_id==cl, 'colour'] = colors[counter]
             #counter +=1
         # else:
         #     ax.plot(this_df['distance_from_outlet'].values, this_df['elevation'].values, lw=1, color=threshold_color)
@@ -134,19 +379,23 @@ def PlotProfilesByCluster(DataDirectory, OutDirectory, fname_prefix, stream_orde
 
     return cluster_df
 
-def PlotMedianProfiles(DataDirectory, OutDirectory, fname_prefix, stream_order=1):
+def PlotMedianProfiles(DataDirectory, OutDirectory, fname_prefix, stream_order=1, cluster_df=None):
     """
     Make a summary plot showing the median profile for each cluster, both in
     gradient-distance and elevation-distance space.
 
+    Args:
+        cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
+
     Author: FJC
     """
     print("I'm making plots of the median profiles for each cluster")
-    df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+    df = cluster_df
+    if df is None:
+        df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order), columns=['id', 'reg_dist', 'slope', 'cluster_id', 'colour'])
 
     # find out some info
-    clusters = df.cluster_id.unique()
-    clusters.sort()
+    clusters = np.sort(df.cluster_id.unique())
     sources = df.id.unique()
     max_source = df.loc[df['reg_dist'].idxmax()]['id']
     dist_array = df[df.id == max_source].reg_dist.values
@@ -158,15 +407,19 @@ def PlotMedianProfiles(DataDirectory, OutDirectory, fname_prefix, stream_order=1
     # hide tick and tick label of the big axes
     plt.tick_params(labelcolor='none', top=False, bottom=False, left=False, right=False)
 
-    # for each cluster, get the mean gradient for each regular distance
+    # get the median and IQR of the gradient for each regular distance in each cluster,
+    # and save it in case we want to reload it
+    summary = cluster_profile_summary(df)
+    pio.write_table(summary, OutDirectory+fname_prefix+'_profiles_median_SO{}.csv'.format(stream_order))
+
     for i, cl in enumerate(clusters):
 
-        cluster_df = df[df.cluster_id == cl]
-        median_gradients = np.asarray([cluster_df[cluster_df.reg_dist == x].slope.median() for x in dist_array])
-        lower_quantile = np.asarray([cluster_df[cluster_df.reg_dist == x].slope.quantile(0.25) for x in dist_array])
-        upper_quantile = np.asarray([cluster_df[cluster_df.reg_dist == x].slope.quantile(0.75) for x in dist_array])
+        cluster_summary = summary[summary.cluster_id == cl].set_index('reg_dist').reindex(dist_array)
+        median_gradients = cluster_summary['median_slope'].values
+        lower_quantile = cluster_summary['lower_quantile'].values
+        upper_quantile = cluster_summary['upper_quantile'].values
         # get the colour from the dataframe
-        this_colour = str(cluster_df.colour.unique()[0])
+        this_colour = str(df.colour[df.cluster_id == cl].iloc[0])
         ax.grid(color='0.8', linestyle='--', which='both')
         ax.plot(dist_array,median_gradients,color=this_colour, lw=1, label='Median + IQR')
         ax.fill_between(dist_array, lower_quantile, upper_quantile, facecolor=this_colour, alpha=0.2)
@@ -186,7 +439,7 @@ def PlotMedianProfiles(DataDirectory, OutDirectory, fname_prefix, stream_order=1
     #plt.cla()
     #plt.close()
 
-def PlotSlopeAreaAllProfiles(DataDirectory, OutDirectory, fname_prefix, stream_order=1, orientation='vertical', ref_theta=0.45, nbins=20, area_t = 1000):
+def PlotSlopeAreaAllProfiles(DataDirectory, OutDirectory, fname_prefix, stream_order=1, orientation='vertical', ref_theta=0.45, nbins=20, area_t = 1000, cluster_df=None, density=False):
     """
     Make a summary plot showing the S-A plot for each cluster. Includes the data from
     all the way down the channel profile
@@ -195,17 +448,18 @@ def PlotSlopeAreaAllProfiles(DataDirectory, OutDirectory, fname_prefix, stream_o
         nbins: number of bins for doing the log binning. default = 20
         area_t = threshold area below which we will remove data to only plot the
         power law through the fluvial domain. default = 1000 m^2
+        cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
+        density: if True, plot the density of the points as an image rather than every point. Use this for large networks. Default = False
 
     Author: FJC
     """
     print("I'm making a slope-area plot for each cluster")
-    cluster_df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
-    df = pd.read_csv(DataDirectory+fname_prefix+'_slopes.csv')
+    if cluster_df is None:
+        cluster_df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order), columns=['id', 'cluster_id', 'colour'])
+    df = pio.read_table(DataDirectory+fname_prefix+'_slopes.csv', columns=['id', 'node', 'drainage_area', 'slope'])
 
     # find out some info
-    clusters = cluster_df.cluster_id.unique()
-    clusters.sort()
-    sources = cluster_df.id.unique()
+    clusters = np.sort(cluster_df.cluster_id.unique())
 
     # set up a figure
     if orientation == "horizontal":
@@ -217,13 +471,9 @@ def PlotSlopeAreaAllProfiles(DataDirectory, OutDirectory, fname_prefix, stream_o
     # hide tick and tick label of the big axes
     plt.tick_params(labelcolor='none', top=False, bottom=False, left=False, right=False)
 
-    # we need to add the cluster ID into the full dataframe
-    for i,id in enumerate(sources):
-        this_id = cluster_df[cluster_df.id==id].iloc[0]['cluster_id']
-        df.loc[df.id==id, 'cluster_id'] = this_id
-
-    # now group by the node id and remove any nodes which identify as multiple clusters
-    df = df.loc[df.groupby('node').filter(lambda x: x['cluster_id'].nunique() == 1).index]
+    # we need to add the cluster ID into the full dataframe, and remove any nodes
+    # which identify as multiple clusters
+    df = assign_clusters_to_network(df, cluster_df)
 
     # for each cluster, get the mean gradient for each regular distance
     for i, cl in enumerate(clusters):
@@ -288,7 +538,10 @@ def PlotSlopeAreaAllProfiles(DataDirectory, OutDirectory, fname_prefix, stream_o
         # get the colour from the dataframe
         this_colour = str(this_df.colour.unique()[0])
         ax[i].grid(color='0.8', linestyle='--', which='both')
-        ax[i].scatter(filter_df['drainage_area'], filter_df['slope'], color=this_colour, s=1)
+        if density:
+            plot_density(ax[i], filter_df['drainage_area'], filter_df['slope'], this_colour)
+        else:
+            ax[i].scatter(filter_df['drainage_area'], filter_df['slope'], color=this_colour, s=1)
         ax[i].errorbar(med_areas, med_slopes, xerr=None, yerr=[lower_err, upper_err], fmt='o', ms=5, marker='D', mfc='w', mec='k', zorder=3, c='k')
         # ax[i].scatter(med_areas, med_slopes, color='w',zorder=3, s=20, marker='D', edgecolors='k')
         ax[i].plot(x2, y2, ls="--", c='k')
@@ -315,14 +568,17 @@ def PlotSlopeAreaAllProfiles(DataDirectory, OutDirectory, fname_prefix, stream_o
     #plt.cla()
     #plt.close()
 
-def PlotSlopeArea(DataDirectory, fname_prefix):
+def PlotSlopeArea(DataDirectory, fname_prefix, density=False):
     """
     Make a summary plot showing a SA plot for all the channels in the basin
 
+    Args:
+        density: if True, plot the density of the points as an image rather than every point. Use this for large networks. Default = False
+
     Author: FJC
     """
     print("I'm making a summary slope--area plot for all the channels in the basin")
-    df = pd.read_csv(DataDirectory+fname_prefix+'_slopes.csv')
+    df = pio.read_table(DataDirectory+fname_prefix+'_slopes.csv', columns=['id', 'drainage_area', 'slope'])
 
     # find out some info
     sources = df.id.unique()
@@ -374,7 +630,10 @@ def PlotSlopeArea(DataDirectory, fname_prefix):
 
     # LEFT - slope area plot
     ax.grid(color='0.8', linestyle='--', which='both', zorder=1)
-    ax.scatter(filter_df['drainage_area'], filter_df['slope'], color='0.5', s=1, zorder=2)
+    if density:
+        plot_density(ax, filter_df['drainage_area'], filter_df['slope'], '0.5', zorder=2)
+    else:
+        ax.scatter(filter_df['drainage_area'], filter_df['slope'], color='0.5', s=1, zorder=2)
     ax.errorbar(med_areas, med_slopes, xerr=None, yerr=[lower_err, upper_err], fmt='o', ms=5, marker='D', mfc='r', mec='k', zorder=3, c='k')
     ax.plot(x2, y2, "--", c='k')
     #ax.text(0.15, 0.1,'Cluster {}'.format(int(cl)),horizontalalignment='center',verticalalignment='center',transform = ax[i].transAxes,fontsize=12)
@@ -405,7 +664,7 @@ def PlotUniqueStreamsWithLength(DataDirectory, OutDirectory, fname_prefix, step=
     Author: FJC
     """
     # read in the original csv
-    df = pd.read_csv(DataDirectory+fname_prefix+'_all_tribs.csv')
+    df = pio.read_table(DataDirectory+fname_prefix+'_all_tribs.csv')
 
     max_length = df['distance_from_outlet'].max()
     len_step=100
@@ -438,18 +697,14 @@ def PlotLongitudinalProfiles(DataDirectory, fname_prefix):
     """
     Just make a simple plot of the river long profiles
     """
-    df = pd.read_csv(DataDirectory+fname_prefix+'_profiles_upstream_clustered.csv')
+    df = pio.read_table(DataDirectory+fname_prefix+'_profiles_upstream_clustered.csv')
 
     # set up a figure
     fig = plt.figure(1, facecolor='white')
     gs = plt.GridSpec(100,100,bottom=0.15,left=0.1,right=0.9,top=0.9)
     ax = fig.add_subplot(gs[5:100,10:95])
 
-    sources = df['id'].unique()
-
-    for src in sources:
-        this_df = df[df['id'] == src]
-        ax.plot(this_df['distance_from_outlet'], this_df['elevation'])
+    plot_profile_lines(ax, df['id'].values, df['distance_from_outlet'].values, df['elevation'].values)
 
     ax.set_xlabel('Distance from outlet (m)')
     ax.set_ylabel('Elevation (m)')
@@ -457,19 +712,33 @@ def PlotLongitudinalProfiles(DataDirectory, fname_prefix):
     plt.savefig(DataDirectory+fname_prefix+'_long_profiles.png', dpi=300, transparent=True)
     #plt.clf()
 
-def PlotTrunkChannel(DataDirectory, fname_prefix):
+def PlotTrunkChannel(DataDirectory, fname_prefix, chunksize=None):
     """
     Make a simple plot of the longest channel. This is mostly to use for the model runs.
+
+    Args:
+        chunksize (int): if set, read the _all_tribs table in chunks of this many rows
+        and only keep the longest channel so far, for tables that are too big to load
+        at once (see profile_io.read_table_chunks). Default = None (read it all at once).
     """
     print("I'm plotting the trunk channel...")
-    df = pd.read_csv(DataDirectory+fname_prefix+'_all_tribs.csv')
+    columns = ['id', 'distance_from_outlet', 'elevation']
+    tribs_file = DataDirectory+fname_prefix+'_all_tribs.csv'
+    if chunksize is None:
+        chunks = [pio.read_table(tribs_file, columns=columns)]
+    else:
+        chunks = pio.read_table_chunks(tribs_file, chunksize, columns=columns)
+    # a profile is never split between chunks, so keep the one with the node
+    # furthest from the outlet
+    this_df = None
+    for df in chunks:
+        trunk_src = df.loc[df['distance_from_outlet'].idxmax()]['id']
+        if this_df is None or df['distance_from_outlet'].max() > this_df['distance_from_outlet'].max():
+            this_df = df[df['id'] == trunk_src]
 
     # set up a figure
     fig,ax = plt.subplots(nrows=1,ncols=1, figsize=(6,4), sharex=True, sharey=True)
 
-    trunk_src = df.loc[df['distance_from_outlet'].idxmax()]['id']
-
-    this_df = df[df['id'] == trunk_src]
     dist_from_outlet = this_df['distance_from_outlet'].values
     max_dist = np.max(dist_from_outlet)
     dist_from_source = abs(dist_from_outlet - max_dist)
@@ -491,7 +760,7 @@ def PlotElevDistanceTrunkChannel(DataDirectory, fname_prefix, stream_order=1):
     Make a plot of the elevation and slope against the distance from the channel head
     For the paper
     """
-    df = pd.read_csv(DataDirectory+fname_prefix+'_slopes.csv')
+    df = pio.read_table(DataDirectory+fname_prefix+'_slopes.csv')
 
     # set up a figure
     fig = plt.figure(1, facecolor='white')
@@ -509,7 +778,7 @@ def PlotElevDistanceTrunkChannel(DataDirectory, fname_prefix, stream_order=1):
     #print(slope, intercept)
     new_elev = slope* this_dist + intercept
 
-    reg_df = pd.read_csv(DataDirectory+fname_prefix+'_profiles_SO{}.csv'.format(stream_order))
+    reg_df = pio.read_table(DataDirectory+fname_prefix+'_profiles_SO{}.csv'.format(stream_order))
     print(reg_df['distance_from_outlet'][::-1][1:20])
     print(reg_df['reg_dist'][1:20])
 
@@ -533,13 +802,18 @@ def PlotElevDistanceTrunkChannel(DataDirectory, fname_prefix, stream_order=1):
     plt.savefig(DataDirectory+fname_prefix+'_trunk_elev_dist.png', dpi=300, transparent=True)
     #plt.clf()
 
-def MakeBoxPlotByCluster(DataDirectory, OutDirectory, fname_prefix, stream_order=1):
+def MakeBoxPlotByCluster(DataDirectory, OutDirectory, fname_prefix, stream_order=1, cluster_df=None):
     """
     Make a boxplot showing the channel gradient stats for each cluster
+
+    Args:
+        cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
     """
     print("Making a boxplot of the channel gradient in each cluster...")
     # read the csv and get some info
-    df = pd.read_csv(OutDirectory+fname_prefix+"_profiles_clustered_SO{}.csv".format(stream_order))
+    df = cluster_df
+    if df is None:
+        df = pio.read_table(OutDirectory+fname_prefix+"_profiles_clustered_SO{}.csv".format(stream_order), columns=['slope', 'cluster_id', 'colour'])
 
     print("========SOME CLUSTER STATISTICS=========")
     clusters = df['cluster_id'].unique()
@@ -600,15 +874,20 @@ def MakeBoxPlotByCluster(DataDirectory, OutDirectory, fname_prefix, stream_order
     plt.savefig(OutDirectory+fname_prefix+'_boxplot_SO{}.png'.format(stream_order), dpi=300, transparent=True)
     #plt.clf()
 
-def MakeCatchmentMetricsBoxPlot(DataDirectory, OutDirectory, fname_prefix, stream_order=1):
+def MakeCatchmentMetricsBoxPlot(DataDirectory, OutDirectory, fname_prefix, stream_order=1, cluster_df=None):
     """
     Make a boxplot showing the catchment metric stats for each cluster
+
+    Args:
+        cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
     """
     print("I'm making a boxplot of the catchment metrics for each cluster")
     mpl.rcParams['ytick.labelsize'] = 8
 
     # read the csv and get some info
-    df = pd.read_csv(OutDirectory+fname_prefix+"_profiles_clustered_SO{}.csv".format(stream_order))
+    df = cluster_df
+    if df is None:
+        df = pio.read_table(OutDirectory+fname_prefix+"_profiles_clustered_SO{}.csv".format(stream_order), columns=['cluster_id', 'colour'])
     colors = df['colour'].unique()
 
     # master dataframe for the catchment info
@@ -0,0 +1,287 @@
+#---------------------------------------------------------------------#
+# Reading and writing the river profile tables
+# Developed by Fiona Clubb
+#              Bodo Bookhagen
+#              Aljoscha Rheinwalt
+# University of Potsdam
+#---------------------------------------------------------------------#
+
+import os
+import numpy as np
+import pandas as pd
+
+# parquet and feather need pyarrow. If it isn't installed we just use csv.
+try:
+    import pyarrow
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+# file extension for each table format, in the order we look for them when reading
+EXTENSIONS = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+
+# format used by write_table if none is given. Change with set_table_format.
+table_format = 'csv'
+
+# compact dtypes for the columns of the profile tables (_all_tribs, slopes, profiles
+# and clustered profiles), used whenever a table is read or written. Integer columns
+# are only narrowed if all the values fit. The elevation and distance_from_outlet
+# of the raw input keep full precision, since the slopes and the resampling are
+# calculated from them, and so do the coordinates and drainage area.
+SCHEMA = {'id': 'int32', 'node': 'int32', 'stream_order': 'uint8', 'reg_dist': 'float32',
+          'slope': 'float32', 'cluster_id': 'category', 'colour': 'category'}
+
+def set_table_format(fmt):
+    """
+    Set the default format for writing the profile tables.
+
+    Args:
+        fmt (str): 'csv', 'parquet' or 'feather'
+    """
+    global table_format
+    if fmt not in EXTENSIONS:
+        raise ValueError("Unknown table format '{}', use one of {}".format(fmt, list(EXTENSIONS)))
+    table_format = resolve_format(fmt)
+
+def resolve_format(fmt=None):
+    """
+    Get the format that will actually be written: falls back to csv
+    if pyarrow isn't installed.
+    """
+    if fmt is None:
+        fmt = table_format
+    if fmt != 'csv' and not HAVE_PYARROW:
+        print("WARNING: pyarrow is not installed so I can't write {} files, using csv instead.".format(fmt))
+        return 'csv'
+    return fmt
+
+def table_path(path, fmt=None):
+    """
+    Swap the extension of path for the one used by the table format.
+    """
+    stem = os.path.splitext(path)[0]
+    return stem+EXTENSIONS[resolve_format(fmt)]
+
+def find_table(path):
+    """
+    Find the file for a table, in whichever format it was written. The path can
+    be given with any of the extensions (e.g. the old .csv name). Binary formats
+    are used first if pyarrow is installed.
+
+    Returns: the path of the file, or None if the table doesn't exist
+    """
+    stem = os.path.splitext(path)[0]
+    for fmt, ext in EXTENSIONS.items():
+        if fmt != 'csv' and not HAVE_PYARROW:
+            continue
+        if os.path.isfile(stem+ext):
+            return stem+ext
+    return None
+
+def apply_schema(df, narrow_ints=True):
+    """
+    Convert the columns of a profile table to the compact dtypes in SCHEMA.
+    The dataframe is changed in place and returned.
+
+    Args:
+        df: pandas dataframe
+        narrow_ints (bool): narrow the integer columns if all the values fit. Set this
+        to False when the table is read or written in chunks, since one chunk can't
+        tell if the values in the rest of the table fit. Default = True.
+    """
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype != 'category' and np.issubdtype(np.dtype(dtype), np.integer):
+            if not narrow_ints:
+                continue
+            info = np.iinfo(dtype)
+            values = df[col]
+            if not np.issubdtype(values.dtype, np.integer) or values.empty or values.min() < info.min or values.max() > info.max:
+                continue
+        df[col] = df[col].astype(dtype)
+    return df
+
+def prepare_table(df, narrow_ints=True):
+    """
+    Convert the dataframe to the dtypes that will be stored,
+    so that the data in memory match what is read back from the file.
+    """
+    return apply_schema(df.reset_index(drop=True), narrow_ints)
+
+def read_table(path, columns=None):
+    """
+    Read a profile table. Looks for parquet or feather versions of the file first,
+    then the csv.
+
+    Args:
+        path (str): path of the table, e.g. DataDirectory+fname_prefix+'_slopes.csv'
+        columns (list): only read these columns. Default = None (read all of them)
+
+    Returns: pandas dataframe
+    """
+    found = find_table(path)
+    if found is None:
+        raise IOError("I can't find the table {} in any format".format(path))
+    if found.endswith('.parquet'):
+        return apply_schema(pd.read_parquet(found, columns=columns))
+    if found.endswith('.feather'):
+        return apply_schema(pd.read_feather(found, columns=columns))
+    return apply_schema(pd.read_csv(found, usecols=columns, dtype=_csv_dtypes()))
+
+def _csv_dtypes():
+    """
+    The dtypes from SCHEMA that are safe to give read_csv directly, so the
+    columns are never held at full size. The integer columns and cluster_id
+    are converted afterwards by apply_schema.
+    """
+    return {col: dtype for col, dtype in SCHEMA.items()
+            if col != 'cluster_id' and (dtype == 'category' or np.issubdtype(np.dtype(dtype), np.floating))}
+
+def write_table(df, path, fmt=None):
+    """
+    Write a profile table in the chosen format. Any existing copies of the table
+    are removed first, so an old file in another format can't be read by mistake
+    (and a hard link into the cache isn't overwritten).
+
+    Args:
+        df: pandas dataframe
+        path (str): path of the table. The extension is replaced by the one for the format.
+        fmt (str): 'csv', 'parquet' or 'feather'. Default = None, which uses the format
+        set by set_table_format
+
+    Returns: the path of the file that was written
+    """
+    fmt = resolve_format(fmt)
+    out_path = table_path(path, fmt)
+    df = prepare_table(df)
+    remove_table(path)
+    if fmt == 'parquet':
+        df.to_parquet(out_path, index=False)
+    elif fmt == 'feather':
+        df.to_feather(out_path)
+    else:
+        df.to_csv(out_path, index=False)
+    return out_path
+
+def remove_table(path):
+    """
+    Remove the table in every format.
+    """
+    stem = os.path.splitext(path)[0]
+    for ext in EXTENSIONS.values():
+        if os.path.isfile(stem+ext):
+            os.remove(stem+ext)
+
+def read_table_chunks(path, chunksize=1000000, columns=None):
+    """
+    Read a profile table in chunks of roughly chunksize rows, for tables that are
+    too big to load at once. A profile is never split between two chunks, so each
+    chunk can be processed on its own. The rows of each profile (id) must be next
+    to each other in the file, as they are in the LSDTopoTools output. The integer
+    columns aren't narrowed, so every chunk has the same dtypes.
+
+    Args:
+        path (str): path of the table, in any format (see read_table)
+        chunksize (int): number of rows to read at once. Default = 1000000.
+        columns (list): only read these columns. Default = None (read all of them)
+
+    Returns: generator of pandas dataframes
+    """
+    found = find_table(path)
+    if found is None:
+        raise IOError("I can't find the table {} in any format".format(path))
+    if found.endswith('.parquet'):
+        from pyarrow import parquet
+        batches = (b.to_pandas() for b in parquet.ParquetFile(found).iter_batches(chunksize, columns=columns))
+    elif found.endswith('.feather'):
+        from pyarrow import ipc
+        reader = ipc.open_file(pyarrow.memory_map(found))
+        # the record batches are whatever size they were written with, so split
+        # them up into chunks. Slicing the memory-mapped batches doesn't copy them.
+        batches = (reader.get_batch(i).slice(offset, chunksize).to_pandas()[columns or slice(None)]
+                   for i in range(reader.num_record_batches)
+                   for offset in range(0, reader.get_batch(i).num_rows, chunksize))
+    else:
+        batches = pd.read_csv(found, usecols=columns, chunksize=chunksize, dtype=_csv_dtypes())
+
+    seen = set()
+    carry = None
+    for batch in batches:
+        if carry is not None:
+            batch = pd.concat([carry, batch], ignore_index=True)
+        ids = batch['id'].values
+        # the last profile might carry on in the next batch, so keep it back
+        different = ids != ids[-1]
+        split = len(ids) - np.argmax(different[::-1]) if different.any() else 0
+        carry = batch.iloc[split:]
+        if split > 0:
+            chunk = apply_schema(batch.iloc[:split].reset_index(drop=True), narrow_ints=False)
+            _check_profiles_together(chunk['id'].values, seen)
+            yield chunk
+    if carry is not None and len(carry) > 0:
+        chunk = apply_schema(carry.reset_index(drop=True), narrow_ints=False)
+        _check_profiles_together(chunk['id'].values, seen)
+        yield chunk
+
+def _check_profiles_together(ids, seen):
+    """
+    Check that the rows of each profile in a chunk are next to each other and
+    that none of the profiles were in an earlier chunk.
+    """
+    run_ids = ids[np.r_[True, ids[1:] != ids[:-1]]].tolist()
+    if len(set(run_ids)) != len(run_ids) or not seen.isdisjoint(run_ids):
+        raise ValueError("The rows of each profile need to be next to each other to read the table in chunks")
+    seen.update(run_ids)
+
+class TableWriter(object):
+    """
+    Write a profile table one chunk at a time, for tables that are too big to
+    hold in memory. Use it as a context manager:
+
+        with TableWriter(path) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+    The dtypes of the first chunk are used for the whole table, so the integer
+    columns are never narrowed: a later chunk might not fit.
+    """
+    def __init__(self, path, fmt=None):
+        self.fmt = resolve_format(fmt)
+        self.path = table_path(path, self.fmt)
+        self.schema = None
+        self.writer = None
+        self.sink = None
+        remove_table(path)
+
+    def write(self, df):
+        df = prepare_table(df, narrow_ints=False)
+        if self.fmt == 'csv':
+            df.to_csv(self.path, mode='a', header=self.schema is None, index=False)
+            self.schema = df.columns
+            return
+        table = pyarrow.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            if self.fmt == 'parquet':
+                from pyarrow import parquet
+                self.writer = parquet.ParquetWriter(self.path, self.schema)
+            else:
+                # feather files are in the arrow IPC file format
+                from pyarrow import ipc
+                self.sink = pyarrow.OSFile(self.path, 'wb')
+                self.writer = ipc.new_file(self.sink, self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
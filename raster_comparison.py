@@ -12,6 +12,7 @@ import LSDPlottingTools as LSDP
 from LSDPlottingTools import LSDMap_GDALIO as IO
 from LSDPlottingTools import LSDMap_PointTools as PT
 import os
+import profile_io as pio
 
 def BoxPlotByCluster(DataDirectory, OutDirectory, fname_prefix,  raster_name, stream_order=1):
     """
@@ -63,7 +64,7 @@ def BoxPlotGradient(DataDirectory, OutDirectory, fname_prefix, stream_order=1):
     """
 
     # read the csv and get some info
-    df = pd.read_csv(OutDirectory+fname_prefix+"_profiles_clustered_SO{}.csv".format(stream_order))
+    df = pio.read_table(OutDirectory+fname_prefix+"_profiles_clustered_SO{}.csv".format(stream_order))
     colors = df['colour'].unique()
 
     # set props for fliers
@@ -193,7 +194,7 @@ def PlotBasinsWithHillshade(DataDirectory, OutDirectory, fname_prefix, stream_or
     Read in the basins and plot them over a hillshade coloured by their cluster ID
     """
 
-    df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+    df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
     clusters = df.cluster_id.unique()
 
     # make a figure
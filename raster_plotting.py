@@ -11,7 +11,6 @@ from LSDPlottingTools import LSDMap_GDALIO as IO
 from LSDPlottingTools import LSDMap_BasicManipulation as BM
 from LSDMapFigure import PlottingRaster
 from LSDMapFigure.PlottingRaster import MapFigure
-import pandas as pd
 from shapely.geometry import shape, Polygon
 from descartes.patch import PolygonPatch
 import matplotlib.pyplot as plt
@@ -20,6 +19,7 @@ from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
 import matplotlib.cm as cm
 from matplotlib import rcParams
 import LSDPlottingTools as LSDP
+import profile_io as pio
 
 # Set up fonts for plots
 label_size = 12
@@ -28,6 +28,14 @@ label_size = 12
 rcParams['font.size'] = label_size
 
 
+def ReadChannelNetwork(DataDirectory, fname_prefix):
+    """
+    Read the coordinates of every node of the channel network from the _all_tribs
+    table. The maps only draw the network in a single colour, so we don't need
+    the other columns, which keeps the memory down for big networks.
+    """
+    return pio.read_table(DataDirectory+fname_prefix+'_all_tribs.csv', columns=['latitude', 'longitude'])
+
 def PlotElevationWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_order=1, cbar_loc='right', custom_cbar_min_max = []):
     """
     Make a plot of the raster with the channels coloured by the cluster
@@ -41,8 +49,8 @@ def PlotElevationWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_
     Author: FJC
     """
     print("I'm plotting the elevation with channels coloured by cluster")
-    df = pd.read_csv(DataDirectory+fname_prefix+'_all_tribs.csv')
-    cluster_df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+    df = ReadChannelNetwork(DataDirectory, fname_prefix)
+    cluster_df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
 
 
     # set figure sizes based on format
@@ -76,13 +84,14 @@ def PlotElevationWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_
 
     MF.save_fig(fig_width_inches = fig_width_inches, FigFileName = OutDirectory+fname_prefix+'_elev_clusters_SO{}.png'.format(stream_order), FigFormat='png', Fig_dpi = 300, fixed_cbar_characters=6, adjust_cbar_characters=False, axis_style='Thin', transparent=True) # Save the figure
 
-def PlotHillshadewithClusters(DataDirectory, OutDirectory, fname_prefix,stream_order=1):
+def PlotHillshadewithClusters(DataDirectory, OutDirectory, fname_prefix,stream_order=1, cluster_df=None):
         """
         Make a hillshade of the raster with the channels coloured by the cluster
         value. Uses the LSDPlottingTools libraries. https://github.com/LSDtopotools/LSDMappingTools
 
         Args:
             stream_order: the stream order of the profiles that you are analysing
+            cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
 
         Author: FJC
         """
@@ -91,8 +100,9 @@ def PlotHillshadewithClusters(DataDirectory, OutDirectory, fname_prefix,stream_o
 
         print("I'm plotting a shaded relief map with the channels coloured by cluster")
 
-        df = pd.read_csv(DataDirectory+fname_prefix+'_all_tribs.csv')
-        cluster_df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+        df = ReadChannelNetwork(DataDirectory, fname_prefix)
+        if cluster_df is None:
+            cluster_df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
 
 
         # set figure sizes based on format
@@ -123,7 +133,7 @@ def PlotHillshadewithClusters(DataDirectory, OutDirectory, fname_prefix,stream_o
 
         fig = MF.save_fig(fig_width_inches = fig_width_inches, FigFileName = OutDirectory+fname_prefix+'_hs_clusters_SO{}.png'.format(stream_order), FigFormat='png', Fig_dpi = 300, fixed_cbar_characters=6, adjust_cbar_characters=False, transparent=True, return_fig=True) # Save the figure
 
-def PlotLithologyWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_order=1, shapefile_name = 'geol.shp', geol_field = 'geol'):
+def PlotLithologyWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_order=1, shapefile_name = 'geol.shp', geol_field = 'geol', cluster_df=None):
         """
         Make a hillshade of the raster with the channels coloured by the cluster
         value. Rasterise a geology shapefile and drape on the top.
@@ -133,14 +143,16 @@ def PlotLithologyWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_
             stream_order: the stream order of the profiles that you are analysing
             shapefile_name: name of the lithology shapefile
             geol_field: the field of the shapefile that has the lithology information
+            cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
 
         Author: FJC
         """
         import LSDPlottingTools as LSDP
         from LSDMapFigure.PlottingRaster import MapFigure
 
-        df = pd.read_csv(DataDirectory+fname_prefix+'_all_tribs.csv')
-        cluster_df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+        df = ReadChannelNetwork(DataDirectory, fname_prefix)
+        if cluster_df is None:
+            cluster_df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
 
 
         # set figure sizes based on format
@@ -179,7 +191,7 @@ def PlotLithologyWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_
         MF.save_fig(fig_width_inches = fig_width_inches, FigFileName = OutDirectory+fname_prefix+'_lith_clusters_SO{}.png'.format(stream_order), FigFormat='png', Fig_dpi = 300, fixed_cbar_characters=6, adjust_cbar_characters=False, transparent=True, return_fig=True) # Save the figure
 
 
-def PlotRasterLithologyWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_order=1, geol_raster = 'geol'):
+def PlotRasterLithologyWithClusters(DataDirectory, OutDirectory, fname_prefix, stream_order=1, geol_raster = 'geol', cluster_df=None):
         """
         Make a hillshade of the raster with the channels coloured by the cluster
         value. Rasterise a geology shapefile and drape on the top.
@@ -189,14 +201,16 @@ def PlotRasterLithologyWithClusters(DataDirectory, OutDirectory, fname_prefix, s
             stream_order: the stream order of the profiles that you are analysing
             shapefile_name: name of the lithology shapefile
             geol_field: the field of the shapefile that has the lithology information
+            cluster_df: dataframe of the clustered profiles, if it is already loaded. Default = None, which reads it from the OutDirectory.
 
         Author: FJC
         """
         import LSDPlottingTools as LSDP
         from LSDMapFigure.PlottingRaster import MapFigure
 
-        df = pd.read_csv(DataDirectory+fname_prefix+'_all_tribs.csv')
-        cluster_df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+        df = ReadChannelNetwork(DataDirectory, fname_prefix)
+        if cluster_df is None:
+            cluster_df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
 
 
         # set figure sizes based on format
@@ -316,7 +330,7 @@ def PlotBasinsWithHillshade(DataDirectory, OutDirectory, fname_prefix, stream_or
     Read in the basins and plot them over a hillshade coloured by their cluster ID
     """
 
-    df = pd.read_csv(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
+    df = pio.read_table(OutDirectory+fname_prefix+'_profiles_clustered_SO{}.csv'.format(stream_order))
     clusters = df.cluster_id.unique()
 
     # make a figure
@@ -357,7 +371,7 @@ def PlotKsnFromSlopeArea(DataDirectory, fname_prefix, theta=0.45, cbar_loc='righ
 
     print("Calculating ksn...")
     # read the csv and get some info
-    df = pd.read_csv(DataDirectory+fname_prefix+"_slopes.csv")
+    df = pio.read_table(DataDirectory+fname_prefix+"_slopes.csv")
 
     # now force a fit of ks based on this concavity
     area = df['drainage_area'].values
@@ -368,7 +382,7 @@ def PlotKsnFromSlopeArea(DataDirectory, fname_prefix, theta=0.45, cbar_loc='righ
     print(np.max(ksn), np.min(ksn))
     print(ksn)
 
-    df.to_csv(DataDirectory+fname_prefix+'_ksn.csv', index=False)
+    pio.write_table(df, DataDirectory+fname_prefix+'_ksn.csv')
 
     # set figure sizes based on format
     fig_width_inches = 6
@@ -0,0 +1,157 @@
+#---------------------------------------------------------------------#
+# On-disk cache for the intermediate stages of the clustering
+# Developed by Fiona Clubb
+#              Bodo Bookhagen
+#              Aljoscha Rheinwalt
+# University of Potsdam
+#---------------------------------------------------------------------#
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import profile_io as pio
+
+def hash_files(*paths):
+    """
+    Make a hash of the contents of one or more files. This is used to work out
+    if the input data has changed since the cache was written.
+
+    Args:
+        paths: the files to hash
+
+    Returns: hex string of the hash
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def stage_key(parent_key, stage, **params):
+    """
+    Make the key for a stage from the key of the stage before it and the
+    parameters that affect this stage. If the input data or any parameter changes,
+    the key of this stage and every stage after it changes too.
+
+    Args:
+        parent_key (str): key of the previous stage, or the hash of the input files
+        stage (str): name of the stage
+        params: parameters used for this stage
+
+    Returns: hex string of the key
+    """
+    h = hashlib.sha1()
+    h.update(parent_key.encode())
+    h.update(stage.encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def stage_path(CacheDirectory, fname_prefix, stage, key, kind='dataframe'):
+    """
+    Get the path of the cache file for a stage.
+    """
+    path = CacheDirectory+fname_prefix+'_'+stage+'_'+key[:16]
+    if kind == 'dataframe':
+        return pio.table_path(path+'.csv')
+    if kind == 'arrays':
+        return path+'.npz'
+    return path+'.npy'
+
+def cached_stage(CacheDirectory, fname_prefix, stage, key, compute, kind='dataframe'):
+    """
+    Load the result of a stage from the cache if it exists, otherwise
+    compute it and save it to the cache.
+
+    Args:
+        CacheDirectory (str): directory for the cache files. If this is None
+        the stage is always computed and nothing is saved.
+        stage (str): name of the stage, e.g. 'slopes'
+        key (str): key of the stage from stage_key
+        compute: function with no arguments that computes the stage
+        kind (str): 'dataframe' for pandas dataframes, 'array' for numpy arrays or
+        'arrays' for a tuple of numpy arrays
+
+    Returns: the result of the stage, and True if it was read from the cache
+    """
+    if CacheDirectory is None:
+        return compute(), False
+
+    path = stage_path(CacheDirectory, fname_prefix, stage, key, kind)
+    if os.path.isfile(path):
+        print("Reading the {} from the cache: {}".format(stage, path))
+        if kind == 'dataframe':
+            return pio.read_table(path), True
+        if kind == 'arrays':
+            with np.load(path) as arrays:
+                return tuple(arrays['arr_{}'.format(i)] for i in range(len(arrays.files))), True
+        return np.load(path), True
+
+    result = compute()
+    if not os.path.isdir(CacheDirectory):
+        os.makedirs(CacheDirectory)
+    # write to a temporary file first so an interrupted run doesn't leave a broken cache
+    stem, ext = os.path.splitext(path)
+    tmp_path = stem+'.tmp'+ext
+    if kind == 'dataframe':
+        # keep the same dtypes as we will get back when reading the cache
+        result = pio.prepare_table(result)
+        pio.write_table(result, tmp_path)
+    elif kind == 'arrays':
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, *result)
+    else:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, result)
+    os.replace(tmp_path, path)
+    return result, False
+
+def cached_file_stage(CacheDirectory, fname_prefix, stage, key, write, kind='dataframe'):
+    """
+    Like cached_stage, but for stages that write their result straight to a file
+    rather than returning it, e.g. when it is too big to hold in memory.
+
+    Args:
+        CacheDirectory (str): directory for the cache files
+        stage (str): name of the stage, e.g. 'slopes'
+        key (str): key of the stage from stage_key
+        write: function that takes a path and writes the result of the stage to it
+        kind (str): kind of file, see cached_stage
+
+    Returns: the path of the cache file, and True if it was already in the cache
+    """
+    path = stage_path(CacheDirectory, fname_prefix, stage, key, kind)
+    if os.path.isfile(path):
+        print("Reading the {} from the cache: {}".format(stage, path))
+        return path, True
+
+    if not os.path.isdir(CacheDirectory):
+        os.makedirs(CacheDirectory)
+    stem, ext = os.path.splitext(path)
+    tmp_path = stem+'.tmp'+ext
+    write(tmp_path)
+    os.replace(tmp_path, path)
+    return path, False
+
+def export_stage(CacheDirectory, fname_prefix, stage, key, dest, kind='dataframe'):
+    """
+    Put a copy of a cached stage at dest, e.g. so the slopes file that the plotting
+    functions read matches the cache. We use a hard link if we can to avoid
+    copying the data.
+    """
+    path = stage_path(CacheDirectory, fname_prefix, stage, key, kind)
+    if kind == 'dataframe':
+        dest = pio.table_path(dest)
+        if os.path.isfile(dest) and os.path.samefile(path, dest):
+            return
+        pio.remove_table(dest)
+    elif os.path.isfile(dest):
+        if os.path.samefile(path, dest):
+            return
+        os.remove(dest)
+    try:
+        os.link(path, dest)
+    except OSError:
+        shutil.copyfile(path, dest)
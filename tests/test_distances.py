@@ -0,0 +1,192 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import squareform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clustering as cl
+
+
+def random_profiles(n=30, min_len=5, max_len=40, seed=0):
+    rng = np.random.RandomState(seed)
+    frames = []
+    for i in range(n):
+        length = rng.randint(min_len, max_len)
+        frames.append(pd.DataFrame({'id': 100+i, 'slope': rng.uniform(0, 0.5, length)}))
+    df = pd.concat(frames, ignore_index=True)
+    return df, [g['slope'].values for _, g in df.groupby('id', sort=False)]
+
+
+def brute_force_matrix(profiles, func):
+    n = len(profiles)
+    d = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i+1, n):
+            d[i, j] = d[j, i] = func(profiles[i], profiles[j])
+    return d
+
+
+def truncated_euclidian(x, y):
+    l = min(len(x), len(y))
+    return cl.AverageEuclidianDifference(x[:l], y[:l])
+
+
+def brute_force_lag(x, y, max_lag, min_overlap=0.5):
+    # the difference for every shift of y with enough overlap
+    min_points = max(1, np.ceil(min_overlap*min(len(x), len(y))))
+    d = {}
+    for lag in range(-max_lag, max_lag+1):
+        t = np.arange(max(0, -lag), min(len(x), len(y)-lag))
+        if len(t) >= min_points:
+            d[lag] = np.sqrt(np.sum((x[t] - y[t+lag])**2))/len(t)
+    return d
+
+
+def brute_force_dtw(x, y, band):
+    # the textbook dynamic programming table, truncated to the shorter profile
+    l = min(len(x), len(y))
+    D = np.full((l+1, l+1), np.inf)
+    D[0, 0] = 0
+    for i in range(1, l+1):
+        for j in range(max(1, i-band), min(l, i+band)+1):
+            D[i, j] = (x[i-1] - y[j-1])**2 + min(D[i-1, j-1], D[i-1, j], D[i, j-1])
+    return np.sqrt(D[l, l])/l
+
+
+def test_padded_array_matches_profiles():
+    df, profiles = random_profiles()
+    data, lengths = cl.ProfilesToPaddedArray(df, 'slope')
+    for row, l, p in zip(data, lengths, profiles):
+        assert l == len(p)
+        assert np.array_equal(row[:l], p)
+        assert not row[l:].any()
+
+
+def test_euclidian_matches_pairwise_loop():
+    df, profiles = random_profiles()
+    data, lengths = cl.ProfilesToPaddedArray(df, 'slope')
+    expected = brute_force_matrix(profiles, truncated_euclidian)
+    for block_size in (None, 1, 7):
+        d = cl.AverageEuclidianDistanceMatrix(data, lengths, block_size)
+        # the sums for each truncation length come from a cumulative sum rather than
+        # np.sum, so they only agree to rounding
+        assert np.allclose(squareform(d), expected, rtol=1e-12, atol=0)
+
+
+def test_parallel_matches_serial():
+    df, _ = random_profiles(n=40)
+    for distance in ('euclidian', 'lag', 'dtw'):
+        serial = cl.ProfileDistances(df, 1, distance, max_lag=5, band=3)
+        parallel = cl.ProfileDistances(df, 2, distance, max_lag=5, band=3)
+        assert np.array_equal(serial, parallel)
+
+
+def test_minimise_lag_matches_shift_loop():
+    _, profiles = random_profiles(n=12, min_len=3, seed=1)
+    # shifted copies, so the best match isn't at zero lag
+    profiles += [np.r_[np.zeros(4), p] for p in profiles[:4]]
+    for max_lag in (0, 3, 10):
+        for x in profiles:
+            for y in profiles:
+                d, lag = cl.MinimiseLag(x, y, max_lag)
+                expected = brute_force_lag(x, y, max_lag)
+                best = min(expected.values())
+                # the FFT is only accurate to rounding, which the square root makes bigger for exact matches
+                assert abs(d - best) <= 1e-9*best + 1e-7
+                assert abs(expected[lag] - best) <= 1e-9*best + 1e-7
+                if expected[0] == best:
+                    assert lag == 0
+
+
+def test_lag_kernel_matches_shift_loop():
+    df, profiles = random_profiles(n=15, seed=2)
+    d = cl.ProfileDistances(df, distance='lag', max_lag=6)
+    expected = brute_force_matrix(profiles, lambda x, y: min(brute_force_lag(x, y, 6).values()))
+    assert np.allclose(squareform(d), expected, rtol=1e-9, atol=1e-7)
+
+
+def test_dtw_matches_dynamic_programming():
+    df, profiles = random_profiles(n=15, seed=3)
+    for band in (0, 2, 5):
+        d = cl.ProfileDistances(df, distance='dtw', band=band)
+        expected = brute_force_matrix(profiles, lambda x, y: brute_force_dtw(x, y, band))
+        assert np.allclose(squareform(d), expected, rtol=1e-12, atol=0)
+    # with no warping this is the truncated Euclidian difference
+    euclidian = cl.ProfileDistances(df)
+    assert np.allclose(cl.ProfileDistances(df, distance='dtw', band=0), euclidian, rtol=1e-12, atol=0)
+
+
+def test_dtw_lower_bound_pruning():
+    df, _ = random_profiles(n=20, seed=4)
+    full = cl.ProfileDistances(df, distance='dtw', band=3)
+    cutoff = np.median(full)
+    pruned = cl.ProfileDistances(df, distance='dtw', band=3, lb_cutoff=cutoff)
+    # the pruned pairs get the lower bound, which can't be above the DTW
+    kept = pruned < cutoff
+    assert np.array_equal(pruned[kept], full[kept])
+    assert np.all(pruned[~kept] <= full[~kept] + 1e-12)
+    assert np.all(full[~kept] >= cutoff)
+
+
+def test_distance_block_matches_kernel():
+    df, _ = random_profiles(n=20, seed=5)
+    data, lengths = cl.ProfilesToPaddedArray(df, 'slope')
+    for distance in ('euclidian', 'lag', 'dtw'):
+        expected = squareform(cl.ProfileDistances(df, distance=distance, max_lag=5, band=3))
+        block = cl.DistanceBlock(distance, max_lag=5, band=3)(data[:6], lengths[:6], data, lengths)
+        off_diagonal = ~np.eye(6, data.shape[0], dtype=bool)
+        assert np.allclose(block[off_diagonal], expected[:6][off_diagonal], rtol=1e-9, atol=1e-12)
+
+
+def test_pearson_matches_corrcoef():
+    data = np.random.RandomState(6).rand(25, 40)
+    data[3] = 1  # a flat profile
+    expected = np.arccos(np.clip(np.corrcoef(data), -1, 1))
+    expected[3] = expected[:, 3] = np.pi/2
+    np.fill_diagonal(expected, 0)
+    # the correlations are float32
+    for n_jobs in (1, 2):
+        d = cl.PearsonDistanceMatrix(data, block_size=4, n_jobs=n_jobs)
+        assert np.allclose(squareform(d), expected, rtol=0, atol=1e-5)
+
+
+def drainage_area_series(n=20, n_areas=30, seed=7):
+    # slopes at each regular area, with gaps, rounded so some points are identical
+    rng = np.random.RandomState(seed)
+    data = np.round(rng.uniform(0.1, 0.5, (n, n_areas)), 1)
+    data[rng.rand(n, n_areas) < 0.3] = np.nan
+    return data
+
+
+def test_drainage_area_matches_pairwise_loop():
+    data = drainage_area_series()
+    n = len(data)
+    expected = []
+    for i in range(n):
+        for j in range(i+1, n):
+            both = ~np.isnan(data[i]) & ~np.isnan(data[j])
+            tsi, tsj = data[i][both], data[j][both]
+            l = np.count_nonzero(tsi - tsj == 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                expected.append(cl.find_difference_between_arrays(tsi[:l], tsj[:l]))
+    lengths = np.full(n, data.shape[1])
+    d = cl.CondensedDistances(cl._drainage_area_rows, data, lengths, block_size=3)
+    assert np.allclose(d, expected, rtol=1e-12, atol=0, equal_nan=True)
+    assert np.isnan(d).any()
+
+
+def test_cluster_by_drainage_area(tmp_path):
+    data = drainage_area_series(n=15)
+    areas = np.arange(1, data.shape[1]+1)*100.
+    frames = []
+    for i, row in enumerate(data):
+        keep = ~np.isnan(row)
+        frames.append(pd.DataFrame({'id': i, 'drainage_area': areas[keep], 'slope': row[keep],
+                                    'distance_from_outlet': np.arange(keep.sum())[::-1]*2.}))
+    df = pd.concat(frames, ignore_index=True)
+    out = cl.ClusterProfilesDrainageArea(str(tmp_path)+'/', 'test', df)
+    assert out['cluster_id'].notna().all()
+    assert (out.groupby('id')['cluster_id'].nunique() == 1).all()
+    assert os.path.isfile(str(tmp_path)+'/test_profiles_upstream_clustered.csv')
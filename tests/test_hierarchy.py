@@ -0,0 +1,161 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.cluster.hierarchy import fcluster, linkage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clustering as cl
+
+
+def random_profiles(n=40, min_len=5, max_len=30, seed=0):
+    rng = np.random.RandomState(seed)
+    frames = []
+    for i in range(n):
+        length = rng.randint(min_len, max_len)
+        frames.append(pd.DataFrame({'id': i, 'slope': rng.uniform(0, 0.5, length)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def same_partition(a, b):
+    # the cluster numbers can differ, but each cluster must have the same members
+    pairs = np.unique(np.column_stack((a, b)), axis=0)
+    return len(pairs) == len(np.unique(a)) == len(np.unique(b))
+
+
+def test_cuts_match_fcluster():
+    ln = linkage(np.random.RandomState(0).rand(30, 4), 'ward')
+    for level in (0, 1, 2, 3):
+        clusters, thr = cl.CutHierarchy(ln, level)
+        assert thr == cl.FindThreshold(ln, level)
+        assert np.array_equal(clusters, fcluster(ln, thr, criterion='distance'))
+    for k in (1, 2, 5, 30):
+        clusters, thr = cl.CutHierarchy(ln, n_clusters=k)
+        assert np.array_equal(clusters, fcluster(ln, k, criterion='maxclust'))
+        assert len(np.unique(clusters)) == k
+        assert len(np.unique(fcluster(ln, thr, criterion='distance'))) == k
+
+
+def test_cut_rejects_bad_number_of_clusters():
+    ln = linkage(np.random.RandomState(0).rand(10, 2), 'ward')
+    for k in (0, -1, 11):
+        with pytest.raises(ValueError):
+            cl.CutHierarchy(ln, n_clusters=k)
+
+
+def condensed_distances(points):
+    return np.sqrt(np.square(points[:, None] - points[None, :]).sum(axis=2))[np.triu_indices(len(points), 1)]
+
+
+@pytest.mark.parametrize('method', cl.NN_CHAIN_METHODS)
+def test_nn_chain_matches_scipy(method):
+    rng = np.random.RandomState(1)
+    dist = condensed_distances(rng.rand(40, 3))
+    expected = linkage(dist, method)
+    ln = cl.NNChainLinkage(dist.copy(), 40, method)
+    assert np.allclose(ln[:, 2], expected[:, 2])
+    assert np.array_equal(ln[:, 3], expected[:, 3])
+    for k in (2, 4, 7):
+        assert same_partition(fcluster(ln, k, 'maxclust'), fcluster(expected, k, 'maxclust'))
+
+
+@pytest.mark.parametrize('method', cl.NN_CHAIN_METHODS)
+def test_nn_chain_matches_scipy_with_ties(method):
+    # lots of tied distances, so the order of the merges at the same height can
+    # differ, but the heights and the clusters between them can't
+    dist = condensed_distances(np.random.RandomState(2).randint(0, 3, (40, 2)).astype(float))
+    expected = linkage(dist, method)
+    ln = cl.NNChainLinkage(dist.copy(), 40, method)
+    assert np.allclose(ln[:, 2], expected[:, 2])
+    heights = np.unique(expected[:, 2])
+    for thr in (heights[1:] + heights[:-1])/2:
+        assert same_partition(fcluster(ln, thr, 'distance'), fcluster(expected, thr, 'distance'))
+
+
+def memory_for(df, bytes_per_pair):
+    # the memory limit that leaves this many bytes for each pair of profiles, after
+    # the padded profiles, the arrays of length n and a block of one row
+    data, _ = cl.ProfilesToPaddedArray(df, 'slope')
+    n = data.shape[0]
+    return data.nbytes + 64*n + 2*n*cl.EUCLIDIAN_PAIR_BYTES + 1000 + bytes_per_pair*n*(n-1)//2
+
+
+def test_memory_limited_hierarchy(tmp_path, capsys):
+    df = random_profiles()
+    exact = cl.BuildHierarchy(df, 'ward')
+    # enough memory for everything
+    assert np.array_equal(cl.BuildHierarchy(df, 'ward', max_memory=1e9), exact)
+    capsys.readouterr()
+    # too little for scipy, so the distances are float32 and clustered in place
+    ln = cl.BuildHierarchy(df, 'ward', max_memory=memory_for(df, 8))
+    assert 'float32' in capsys.readouterr().out
+    assert np.allclose(ln, exact, rtol=1e-5)
+    # too little for the float32 distances, so they go to a memory-mapped file
+    ln = cl.BuildHierarchy(df, 'ward', max_memory=memory_for(df, 2), mmap_dir=str(tmp_path)+'/')
+    assert 'memory-mapped' in capsys.readouterr().out
+    assert np.allclose(ln, exact, rtol=1e-5)
+    assert os.listdir(str(tmp_path)) == []
+    with pytest.raises(MemoryError):
+        cl.BuildHierarchy(df, 'ward', max_memory=memory_for(df, 2))
+
+
+def test_hierarchy_rejects_method_early():
+    df = random_profiles()
+    with pytest.raises(ValueError):
+        cl.BuildHierarchy(df, 'not_a_method')
+    # centroid and median can't be done in place, so they need the full scipy memory
+    with pytest.raises(ValueError):
+        cl.BuildHierarchy(df, 'centroid', max_memory=memory_for(df, 8))
+
+
+def test_adjusted_rand_index():
+    labels = np.array([1, 1, 2, 2, 3, 3])
+    assert cl.AdjustedRandIndex(labels, labels) == 1.0
+    # the same clusters with different numbers
+    assert cl.AdjustedRandIndex(labels, [5, 5, 0, 0, 9, 9]) == 1.0
+    # every pair that is together in one is apart in the other
+    assert cl.AdjustedRandIndex([1, 1, 2, 2], [1, 2, 1, 2]) == pytest.approx(-0.5)
+
+
+def test_prototypes_are_nearest():
+    df = random_profiles(n=60)
+    data, lengths = cl.ProfilesToPaddedArray(df, 'slope')
+    medoids, assignment = cl.FindPrototypes(data, lengths, 8)
+    assert len(np.unique(medoids)) == 8
+    # each prototype belongs to its own group
+    assert np.array_equal(assignment[medoids], np.arange(8))
+    # and every profile goes to the closest prototype
+    for i in range(len(data)):
+        d = [cl.AverageEuclidianDifference(data[i, :min(lengths[i], lengths[m])], data[m, :min(lengths[i], lengths[m])])
+             for m in medoids]
+        assert d[assignment[i]] == pytest.approx(min(d))
+
+
+def test_approximate_hierarchy():
+    df = random_profiles(n=60)
+    ln, prototypes = cl.BuildApproximateHierarchy(df, 'ward', 10)
+    assert ln.shape == (9, 4)
+    assert len(prototypes) == 60 and prototypes.max() == 9
+    # with a prototype for every profile this is the exact clustering
+    ln, prototypes = cl.BuildApproximateHierarchy(df, 'ward', 60)
+    assert np.allclose(ln, cl.BuildHierarchy(df, 'ward'))
+    assert np.array_equal(prototypes, np.arange(60))
+    sample, sample_ln = cl.BuildSampleHierarchy(df, 'ward', 60)
+    labels = cl.CutHierarchy(ln, n_clusters=4)[0]
+    assert cl.SampleAgreement(labels, sample, sample_ln) == 1.0
+
+
+@pytest.mark.parametrize('distance', ['lag', 'dtw'])
+def test_approximate_hierarchy_uses_distance(distance):
+    df = random_profiles(n=30)
+    options = dict(distance=distance, max_lag=4, band=3)
+    # with a prototype for every profile this is the exact clustering with the same distance
+    ln, _ = cl.BuildApproximateHierarchy(df, 'ward', 30, **options)
+    assert np.allclose(ln, cl.BuildHierarchy(df, 'ward', **options))
+    # each profile goes to the prototype that is nearest by this distance
+    data, lengths = cl.ProfilesToPaddedArray(df, 'slope')
+    medoids, assignment = cl.FindPrototypes(data, lengths, 6, **options)
+    d = cl.DistanceBlock(**options)(data, lengths, data[medoids], lengths[medoids])
+    assert np.allclose(d[np.arange(len(data)), assignment], d.min(axis=1))
@@ -0,0 +1,141 @@
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.colors as mcolors
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import plotting as pl
+
+
+def test_assign_clusters_matches_source_loop():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({'id': rng.randint(0, 20, 500), 'node': rng.randint(0, 150, 500),
+                       'slope': rng.uniform(0, 0.5, 500)})
+    # only some of the sources were clustered
+    cluster_df = pd.DataFrame({'id': np.repeat(np.arange(15), 3), 'cluster_id': np.repeat(rng.randint(1, 4, 15), 3).astype(float)})
+
+    expected = df.copy()
+    for source in cluster_df.id.unique():
+        expected.loc[expected.id == source, 'cluster_id'] = cluster_df[cluster_df.id == source].iloc[0]['cluster_id']
+    unfiltered = pl.assign_clusters_to_network(df, cluster_df, remove_conflicts=False)
+    pd.testing.assert_frame_equal(unfiltered, expected)
+
+    expected = expected.loc[expected.groupby('node').filter(lambda x: x['cluster_id'].nunique() == 1).index]
+    pd.testing.assert_frame_equal(pl.assign_clusters_to_network(df, cluster_df).reset_index(drop=True),
+                                  expected.reset_index(drop=True))
+
+
+def test_binned_statistics_match_binned_statistic():
+    rng = np.random.RandomState(1)
+    x = rng.uniform(0, 10, 2000)
+    y = rng.normal(size=2000)
+    # a gap in the data and an empty bin
+    y[::50] = np.nan
+    x[(x > 4) & (x < 4.6)] = 5
+    finite = np.isfinite(y)
+    for bins in (7, 20, np.linspace(-1, 11, 9)):
+        medians, (lower, upper), mad, counts, bin_edges = pl.binned_statistics(x, y, bins, (25, 75))
+        edges = stats.binned_statistic(x, y, 'count', bins=bins)[1]
+        assert np.allclose(bin_edges, edges)
+        for values, statistic in ((medians, 'median'), (lower, pl.lower_p), (upper, pl.upper_p), (counts, 'count')):
+            expected = stats.binned_statistic(x[finite], y[finite], statistic, bins=edges)[0]
+            if statistic == 'count':
+                assert np.array_equal(values, expected)
+            else:
+                expected[counts == 0] = np.nan
+                assert np.allclose(values, expected, equal_nan=True)
+        expected_mad = stats.binned_statistic(x[finite], y[finite], lambda v: np.median(np.abs(v - np.median(v))), bins=edges)[0]
+        expected_mad[counts == 0] = np.nan
+        assert np.allclose(mad, expected_mad, equal_nan=True)
+
+
+def test_cluster_summary_matches_percentile_loop():
+    rng = np.random.RandomState(2)
+    df = pd.DataFrame({'cluster_id': rng.randint(1, 4, 600).astype(float),
+                       'reg_dist': rng.randint(1, 8, 600)*2.,
+                       'slope': rng.uniform(0, 0.5, 600)})
+    df['colour'] = df['cluster_id'].map({1: '#1b9e77', 2: '#d95f02', 3: '#7570b3'}).astype('category')
+    summary = pl.cluster_profile_summary(df)
+    rows = []
+    for cl_id in np.sort(df['cluster_id'].unique()):
+        this_df = df[df['cluster_id'] == cl_id]
+        for d in np.sort(this_df['reg_dist'].unique()):
+            slopes = this_df[this_df['reg_dist'] == d]['slope']
+            rows.append([cl_id, this_df['colour'].iloc[0], d, np.percentile(slopes, 25), np.median(slopes),
+                         np.percentile(slopes, 75), len(slopes)])
+    expected = pd.DataFrame(rows, columns=summary.columns)
+    pd.testing.assert_frame_equal(summary, expected, check_dtype=False)
+
+
+def test_profile_lines_one_segment_per_profile():
+    fig, ax = plt.subplots()
+    ids = np.repeat([3, 1, 2], [4, 2, 5])
+    x = np.arange(11.)
+    y = x**2
+    lines = pl.plot_profile_lines(ax, ids, x, y, color=['r', 'g', 'b'])
+    segments = lines.get_segments()
+    assert len(segments) == 3
+    for segment, these in zip(segments, (slice(0, 4), slice(4, 6), slice(6, 11))):
+        assert np.array_equal(segment, np.column_stack((x[these], y[these])))
+    assert np.allclose(lines.get_colors(), mcolors.to_rgba_array(['r', 'g', 'b']))
+    # without colours each profile gets the next one in the cycle, like ax.plot
+    cycle = mcolors.to_rgba_array(plt.rcParams['axes.prop_cycle'].by_key()['color'][:3])
+    assert np.allclose(pl.plot_profile_lines(ax, ids, x, y).get_colors(), cycle)
+    plt.close(fig)
+
+
+def test_density_image_on_log_axes():
+    rng = np.random.RandomState(3)
+    x = 10**rng.uniform(2, 6, 1000)
+    y = 10**rng.uniform(-3, 0, 1000)
+    # points that can't go on log axes are left out
+    x[:5] = 0
+    y[5:10] = np.nan
+    fig, ax = plt.subplots()
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    image = pl.plot_density(ax, x, y, 'r', gridsize=(8, 6))
+    keep = slice(10, None)
+    extent = (x[keep].min(), x[keep].max(), y[keep].min(), y[keep].max())
+    assert np.allclose(image.get_extent(), extent)
+    assert np.allclose(ax.get_xlim(), extent[:2]) and np.allclose(ax.get_ylim(), extent[2:])
+    # the cells are spaced evenly in log space, so the corners and the middle of the
+    # image go to the same place on the screen as the points there
+    trans = image.get_transform()
+    middle = (np.sqrt(extent[0]*extent[1]), np.sqrt(extent[2]*extent[3]))
+    for corner, point in (((extent[0], extent[2]), (extent[0], extent[2])),
+                          ((extent[1], extent[3]), (extent[1], extent[3])),
+                          (((extent[0]+extent[1])/2, (extent[2]+extent[3])/2), middle)):
+        assert np.allclose(trans.transform(corner), ax.transData.transform(point))
+    # the opacity of each cell shows the number of points in it
+    counts = np.histogram2d(np.log10(y[keep]), np.log10(x[keep]), bins=(6, 8))[0]
+    rgba = image.get_array()
+    assert np.allclose(rgba[counts > 0, :3], mcolors.to_rgb('r'))
+    alpha = np.where(counts > 0, 0.25 + 0.75*np.log1p(counts)/np.log1p(counts.max()), 0)
+    assert np.allclose(rgba[..., 3], alpha)
+    plt.close(fig)
+
+
+def test_trunk_channel_in_chunks(tmp_path):
+    rng = np.random.RandomState(5)
+    lengths = rng.randint(3, 30, 20)
+    lengths[13] = 40  # the longest channel, in a later chunk
+    df = pd.DataFrame({'id': np.repeat(np.arange(20), lengths),
+                       'distance_from_outlet': np.concatenate([np.arange(l)[::-1]*2. for l in lengths]),
+                       'elevation': rng.uniform(0, 40, lengths.sum())})
+    df.to_csv(str(tmp_path)+'/test_all_tribs.csv', index=False)
+    lines = []
+    for chunksize in (None, 25):
+        pl.PlotTrunkChannel(str(tmp_path)+'/', 'test', chunksize=chunksize)
+        lines.append(plt.gca().lines[0].get_xydata())
+        plt.close('all')
+    trunk = df[df['id'] == 13]
+    # the csv round trip of the elevations is only exact to rounding
+    assert np.allclose(lines[0], np.column_stack((78 - trunk['distance_from_outlet'], trunk['elevation'])), rtol=1e-12, atol=0)
+    assert np.array_equal(lines[1], lines[0])
@@ -0,0 +1,145 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profile_io as pio
+
+
+def profile_table(n=12, seed=0):
+    # profiles of different lengths, with the rows of each one together
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(1, 15, n)
+    return pd.DataFrame({'id': np.repeat(np.arange(n)*7 + 3, lengths),
+                         'node': np.arange(lengths.sum()),
+                         'distance_from_outlet': rng.uniform(0, 1000, lengths.sum()),
+                         'slope': rng.uniform(0, 0.5, lengths.sum())})
+
+
+def test_read_looks_for_binary_formats_first(tmp_path):
+    pytest.importorskip('pyarrow')
+    stem = str(tmp_path)+'/test_slopes'
+    # a different table in each format, written without write_table so they all stay
+    for i, fmt in enumerate(('csv', 'feather', 'parquet')):
+        df = pd.DataFrame({'id': [i]})
+        getattr(df, 'to_'+fmt)(stem+pio.EXTENSIONS[fmt], **({} if fmt == 'feather' else {'index': False}))
+    for i in (2, 1, 0):
+        # the path can be given with any extension
+        assert pio.read_table(stem+'.csv')['id'].tolist() == [i]
+        assert pio.read_table(stem+'.parquet')['id'].tolist() == [i]
+        os.remove(pio.find_table(stem+'.csv'))
+    assert pio.find_table(stem+'.csv') is None
+    with pytest.raises(IOError):
+        pio.read_table(stem+'.csv')
+
+
+def test_write_removes_other_formats(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path)+'/test_slopes.csv'
+    df = profile_table()
+    pio.write_table(df, path, 'csv')
+    for fmt in ('parquet', 'feather', 'csv'):
+        out = pio.write_table(df, path, fmt)
+        assert out == str(tmp_path)+'/test_slopes'+pio.EXTENSIONS[fmt]
+        assert os.listdir(str(tmp_path)) == [os.path.basename(out)]
+        pd.testing.assert_frame_equal(pio.read_table(path), df, check_dtype=False)
+        pio.remove_table(path)
+        assert os.listdir(str(tmp_path)) == []
+        pio.write_table(df, path, fmt)
+
+
+def test_csv_without_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(pio, 'HAVE_PYARROW', False)
+    monkeypatch.setattr(pio, 'table_format', 'csv')
+    path = str(tmp_path)+'/test_slopes.csv'
+    df = profile_table()
+    assert pio.write_table(df, path, 'parquet') == path
+    pio.set_table_format('feather')
+    assert pio.table_format == 'csv'
+    assert pio.write_table(df, path) == path
+    # a binary copy can't be read, so it isn't used
+    open(str(tmp_path)+'/test_slopes.parquet', 'wb').close()
+    assert pio.find_table(path) == path
+    pd.testing.assert_frame_equal(pio.read_table(path), df, check_dtype=False)
+    with pytest.raises(ValueError):
+        pio.set_table_format('excel')
+
+
+def formats():
+    # the binary formats need pyarrow
+    return ['csv'] + (['parquet', 'feather'] if pio.HAVE_PYARROW else [])
+
+
+@pytest.mark.parametrize('fmt', formats())
+def test_chunks_round_trip(tmp_path, fmt):
+    df = profile_table(n=40)
+    path = str(tmp_path)+'/test_all_tribs.csv'
+    # write in pieces that split profiles, so the batches in the file do too
+    with pio.TableWriter(path, fmt) as writer:
+        for start in range(0, len(df), 23):
+            writer.write(df.iloc[start:start+23])
+    assert os.listdir(str(tmp_path)) == [os.path.basename(writer.path)]
+    for chunksize in (1, 10, 37, len(df)+1):
+        chunks = list(pio.read_table_chunks(path, chunksize))
+        ids = [set(chunk['id']) for chunk in chunks]
+        # every profile is whole and in one chunk
+        assert sum(len(i) for i in ids) == df['id'].nunique()
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df, check_dtype=False)
+        if chunksize < len(df):
+            assert len(chunks) > 1
+    columns = list(pio.read_table_chunks(path, 10, columns=['id', 'slope']))
+    assert all(list(chunk.columns) == ['id', 'slope'] for chunk in columns)
+
+
+@pytest.mark.parametrize('fmt', formats())
+def test_profile_across_batches(tmp_path, fmt):
+    # one long profile that spans several batches, between two short ones
+    df = pd.DataFrame({'id': np.r_[1, 1, np.full(50, 2), 3], 'slope': np.arange(53.)})
+    path = str(tmp_path)+'/test_all_tribs.csv'
+    with pio.TableWriter(path, fmt) as writer:
+        for start in range(0, len(df), 8):
+            writer.write(df.iloc[start:start+8])
+    chunks = list(pio.read_table_chunks(path, 8))
+    assert [chunk['id'].unique().tolist() for chunk in chunks] == [[1], [2], [3]]
+    assert np.array_equal(chunks[1]['slope'], np.arange(2., 52.))
+
+
+@pytest.mark.parametrize('fmt', formats())
+def test_chunks_need_profiles_together(tmp_path, fmt):
+    df = pd.DataFrame({'id': [1, 1, 2, 2, 1, 3], 'slope': np.arange(6.)})
+    path = str(tmp_path)+'/test_all_tribs.csv'
+    pio.write_table(df, path, fmt)
+    for chunksize in (2, 10):
+        with pytest.raises(ValueError):
+            list(pio.read_table_chunks(path, chunksize))
+
+
+@pytest.mark.parametrize('fmt', formats())
+def test_narrow_dtypes(tmp_path, fmt):
+    df = profile_table()
+    df['elevation'] = np.linspace(100, 2000, len(df))
+    df['cluster_id'] = (df['id'] % 3 + 1).astype(float)
+    df['colour'] = df['cluster_id'].map({1: '#1b9e77', 2: '#d95f02', 3: '#7570b3'})
+    path = str(tmp_path)+'/test_profiles_clustered.csv'
+    pio.write_table(df, path, fmt)
+    read = pio.read_table(path)
+    assert read['id'].dtype == 'int32' and read['node'].dtype == 'int32'
+    assert read['slope'].dtype == 'float32'
+    assert read['cluster_id'].dtype == 'category' and read['colour'].dtype == 'category'
+    assert read['elevation'].dtype == 'float64' and read['distance_from_outlet'].dtype == 'float64'
+    # more precise than float32 could hold
+    assert np.allclose(read['elevation'], df['elevation'], rtol=1e-12, atol=0)
+    assert np.allclose(read['distance_from_outlet'], df['distance_from_outlet'], rtol=1e-12, atol=0)
+    assert np.array_equal(read['node'], df['node'])
+    assert np.allclose(read['slope'], df['slope'], rtol=1e-7)
+    assert read['colour'].astype(str).tolist() == df['colour'].tolist()
+
+    # node numbers that don't fit in 32 bits are kept as they are
+    df['node'] += 2**40
+    pio.write_table(df, path, fmt)
+    read = pio.read_table(path)
+    assert read['node'].dtype == 'int64' and read['id'].dtype == 'int32'
+    assert np.array_equal(read['node'], df['node'])
@@ -0,0 +1,127 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clustering as cl
+import profile_io as pio
+
+
+def make_network(n_sources=10, seed=0):
+    # a trunk channel with tributaries joining it. Each profile is listed going
+    # downstream, and the tributaries share the trunk nodes below their junction.
+    rng = np.random.RandomState(seed)
+    trunk_nodes = np.arange(60)
+    trunk_dist = np.cumsum(rng.uniform(1, 1.5, len(trunk_nodes)))
+    frames = []
+    for s in range(n_sources):
+        if s == 0:
+            nodes, dist = trunk_nodes[::-1], trunk_dist[::-1]
+        else:
+            join = rng.randint(0, len(trunk_nodes))
+            own_len = rng.randint(1, 30)
+            own_dist = trunk_dist[join] + np.cumsum(rng.uniform(1, 1.5, own_len))
+            nodes = np.r_[1000*s + np.arange(own_len)[::-1], trunk_nodes[:join+1][::-1]]
+            dist = np.r_[own_dist[::-1], trunk_dist[:join+1][::-1]]
+        frames.append(pd.DataFrame({'id': 10+s, 'node': nodes, 'distance_from_outlet': dist,
+                                    'slope': rng.uniform(0, 0.5, len(nodes)),
+                                    'stream_order': 1}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_resample_matches_nearest_node_loop():
+    df = make_network()
+    distances = df.groupby('id')['distance_from_outlet'].transform('max') - df['distance_from_outlet']
+    for step in (1, 2, 3):
+        thinned = cl.ResampleProfiles(df, distances.values, step)
+        # one profile and one regular distance at a time
+        rows, reg = [], []
+        for source in df['id'].unique():
+            these = np.flatnonzero(df['id'].values == source)
+            d = distances.values[these]
+            for r in np.arange(step, int(np.max(d)+step), step):
+                rows.append(these[cl.find_nearest_idx(d, r)])
+                reg.append(r)
+        assert np.array_equal(thinned['node'].values, df['node'].values[rows])
+        assert np.array_equal(thinned['id'].values, df['id'].values[rows])
+        assert np.array_equal(thinned['reg_dist'].values, np.asarray(reg, dtype=float))
+
+
+def test_longest_channels_match_node_loop():
+    df = make_network(n_sources=15, seed=1)
+    nodes = np.r_[df['node'].unique()[::7], 99999]
+    expected = []
+    for node in nodes:
+        these_ids = df.loc[df['node'] == node, 'id'].unique()
+        if len(these_ids) == 0:
+            continue
+        this_df = df[df['id'].isin(these_ids)]
+        expected.append(this_df.loc[this_df['distance_from_outlet'].idxmax(), 'id'])
+    assert set(cl.FindLongestChannelsThroughNodes(df, nodes)) == set(expected)
+
+
+def test_remove_non_unique_matches_pairwise_loop():
+    df = make_network(n_sources=12, seed=2)
+    # add a profile that doesn't share any nodes
+    df = pd.concat([df, pd.DataFrame({'id': 99, 'node': [50000, 50001], 'distance_from_outlet': [2., 1.],
+                                      'slope': 0.1, 'stream_order': 1})], ignore_index=True)
+    sources = df['id'].unique()
+    duplicates = []
+    for i in range(len(sources)):
+        for j in range(i+1, len(sources)):
+            nodes_i = df[df.id == sources[i]].node.tolist()
+            nodes_j = df[df.id == sources[j]].node.tolist()
+            if not set(nodes_i).isdisjoint(nodes_j):
+                duplicates.append(sources[j])
+    expected = df[~df['id'].isin(duplicates)]
+    pd.testing.assert_frame_equal(cl.RemoveNonUniqueProfiles(df), expected)
+
+
+def test_short_unique_section_matches_node_count_loop():
+    df = make_network(n_sources=12, seed=3)
+    all_nodes = df['node'].tolist()
+    for threshold_len in (0, 4, 10):
+        keep = []
+        for src in df['id'].unique():
+            unique_nodes = sum(all_nodes.count(node) < 2 for node in df.loc[df['id'] == src, 'node'])
+            if unique_nodes > threshold_len:
+                keep.append(src)
+        expected = df[df['id'].isin(keep)]
+        pd.testing.assert_frame_equal(cl.RemoveProfilesWithShortUniqueSection(df, threshold_len), expected)
+
+
+def test_regular_distance_matches_profile_loop(tmp_path):
+    df = make_network(n_sources=12, seed=4)
+    df.loc[df.index[::11], 'slope'] = np.nan
+    profile_len, step = 30, 2
+    thinned, data = cl.ProfilesRegularDistance(str(tmp_path)+'/', 'test', df, profile_len, step)
+
+    reg_dist = np.arange(step, profile_len, step)
+    expected_data, expected_nodes = [], []
+    for source in df['id'].unique():
+        this_df = df[(df['id'] == source) & df['slope'].notna()]
+        distances = this_df['distance_from_outlet'].values[::-1]
+        if this_df.empty or distances.max() < profile_len:
+            continue
+        idx = [cl.find_nearest_idx(distances, d) for d in reg_dist]
+        expected_data.append(this_df['slope'].values[::-1][idx])
+        expected_nodes.extend(this_df['node'].values[::-1][idx])
+    assert np.array_equal(data, np.asarray(expected_data))
+    assert np.array_equal(thinned['node'].values, expected_nodes)
+    assert np.array_equal(thinned['reg_dist'].values, np.tile(reg_dist, len(expected_data)).astype(float))
+
+
+def test_streamed_profiles_match_in_memory(tmp_path):
+    df = make_network(n_sources=12, seed=5)
+    slope_file = str(tmp_path)+'/test_slopes.csv'
+    df.to_csv(slope_file, index=False)
+    os.makedirs(str(tmp_path)+'/stream')
+    streamed = cl.StreamProfilesByStreamOrder(str(tmp_path)+'/stream/', 'test', slope_file, profile_len=30, chunksize=50)
+    thinned = cl.GetProfilesByStreamOrder(str(tmp_path)+'/', 'test', df)
+    expected = cl.RemoveProfilesShorterThanThresholdLength(thinned, 30)
+    pd.testing.assert_frame_equal(streamed, expected.reset_index(drop=True), check_dtype=False)
+    # both write every resampled profile, including the short ones
+    pd.testing.assert_frame_equal(pio.read_table(str(tmp_path)+'/stream/test_profiles_SO1.csv'),
+                                  pio.read_table(str(tmp_path)+'/test_profiles_SO1.csv'))
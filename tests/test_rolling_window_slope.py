@@ -0,0 +1,25 @@
+import os
+import sys
+
+import numpy as np
+from scipy import stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clustering as cl
+
+
+def test_long_profile_matches_linregress():
+    # a long trunk channel, where sums over the whole profile would lose precision
+    rng = np.random.RandomState(0)
+    n = 50000
+    x = np.cumsum(rng.uniform(1, 30, n))
+    y = 1000 - np.cumsum(rng.uniform(0, 0.5, n))
+    ids = np.zeros(n, dtype=int)
+    for window in (5, 25):
+        slopes = cl.RollingWindowSlope(ids, x, y, window)
+        slicer = (window - 1)//2
+        nodes = np.r_[0, 1, n-2, n-1, rng.randint(0, n, 200)]
+        for i in nodes:
+            lo, hi = max(i-slicer, 0), i+slicer+1
+            expected = abs(stats.linregress(x[lo:hi], y[lo:hi]).slope)
+            assert abs(slopes[i] - expected) <= 1e-9*expected
@@ -0,0 +1,87 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stage_cache as sc
+
+
+class Counter(object):
+    # a stage that counts how many times it was computed
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.result
+
+
+def test_key_changes_with_input_and_params(tmp_path):
+    tribs = tmp_path / 'test_all_tribs.csv'
+    tribs.write_text('id,node\n1,2\n')
+    input_key = sc.hash_files(str(tribs))
+    assert sc.hash_files(str(tribs)) == input_key
+    slopes_key = sc.stage_key(input_key, 'slopes', slope_window=3)
+    profiles_key = sc.stage_key(slopes_key, 'profiles', step=2, profile_len=100)
+    # the order of the parameters doesn't matter
+    assert sc.stage_key(slopes_key, 'profiles', profile_len=100, step=2) == profiles_key
+    assert sc.stage_key(input_key, 'slopes', slope_window=5) != slopes_key
+    assert sc.stage_key(slopes_key, 'profiles', step=2, profile_len=50) != profiles_key
+
+    # a change to the input changes the key of every stage
+    tribs.write_text('id,node\n1,3\n')
+    new_input_key = sc.hash_files(str(tribs))
+    assert new_input_key != input_key
+    new_slopes_key = sc.stage_key(new_input_key, 'slopes', slope_window=3)
+    assert new_slopes_key != slopes_key
+    assert sc.stage_key(new_slopes_key, 'profiles', step=2, profile_len=100) != profiles_key
+
+
+def test_new_key_recomputes(tmp_path):
+    cache = str(tmp_path)+'/cache/'
+    df = pd.DataFrame({'id': [1, 1, 2], 'slope': [0.1, 0.2, 0.3]})
+    compute = Counter(df)
+    key = sc.stage_key('input', 'slopes', slope_window=3)
+    result, cached = sc.cached_stage(cache, 'test', 'slopes', key, compute)
+    assert not cached and compute.calls == 1
+    result, cached = sc.cached_stage(cache, 'test', 'slopes', key, compute)
+    assert cached and compute.calls == 1
+    assert np.allclose(result['slope'], df['slope'])
+
+    new_key = sc.stage_key('input', 'slopes', slope_window=5)
+    result, cached = sc.cached_stage(cache, 'test', 'slopes', new_key, compute)
+    assert not cached and compute.calls == 2
+
+    ln = Counter(np.random.RandomState(0).rand(5, 4))
+    for calls in (1, 1):
+        result, _ = sc.cached_stage(cache, 'test', 'linkage', key, ln, kind='array')
+        assert ln.calls == calls
+        assert np.array_equal(result, ln.result)
+
+
+def test_interrupted_write_is_not_a_cache_hit(tmp_path, monkeypatch):
+    cache = str(tmp_path)+'/'
+    key = sc.stage_key('input', 'linkage', method='ward')
+    compute = Counter(np.arange(10.))
+
+    def interrupted_save(f, arr):
+        f.write(b'half a file')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(sc.np, 'save', interrupted_save)
+    with pytest.raises(KeyboardInterrupt):
+        sc.cached_stage(cache, 'test', 'linkage', key, compute, kind='array')
+    # only the temporary file was written
+    assert not os.path.isfile(sc.stage_path(cache, 'test', 'linkage', key, kind='array'))
+    assert any('.tmp' in f for f in os.listdir(cache))
+
+    monkeypatch.undo()
+    result, cached = sc.cached_stage(cache, 'test', 'linkage', key, compute, kind='array')
+    assert not cached and compute.calls == 2
+    assert np.array_equal(result, compute.result)
+    result, cached = sc.cached_stage(cache, 'test', 'linkage', key, compute, kind='array')
+    assert cached and compute.calls == 2